@@ -1,3 +1,4 @@
+import hmac
 import json
 import logging
 from multiprocessing import Pool, cpu_count, Manager
@@ -9,33 +10,68 @@ from utils.redis_util import RedisClient
 import common
 from common import runtime_env, conf
 from biz.user import user_mgr_ctx
+from sgs.cards.card import Card
+from sgs.heros import hero_mgr, watch_heros
+from utils import metrics
+from utils.lazy import warm_up
+from utils.log_util import request_context
+from utils.profiler import profiler
+from utils.process_pool import init_worker, preload
 
 app = Flask(__name__)
 runtime_env['debug'] = app.config.get('DEBUG')
 
 @app.route('/sgs/helper', methods=['GET', 'POST'])
 def sgs_main():
-    # print(request.args)
+    logger = logging.getLogger('request')
     if request.content_type.startswith('application/json'):
-        logger = logging.getLogger('request')
         data = request.get_json()
-        logger.debug('request: %s' % data)
-        if 'challenge' in data:
-            ret = {'challenge': data['challenge']}
-        elif 'event' in data and data.get('schema') == '2.0':
-            ret = process_event(**data['event'])
-        elif 'action' in data:
-            ret = process_action(data['open_message_id'], data['open_chat_id'], data['action'], data['token'], data['open_id'])
-        elif 'content' in data:
-            cmd = data.pop('content', '')
-            ret = {'success': True, 'message': route_todo(cmd, **data)}
-        else:
-            ret = {'success': False, 'message': f'unknown data.\n{data}'}
-        return json.dumps(ret)
+        # 飞书消息以message_id 作为request_id, 卡片回调用open_message_id, 其余生成一个
+        with request_context(data.get('event', {}).get('message', {}).get('message_id') or data.get('open_message_id')):
+            logger.debug('request: %s', data)
+            if 'challenge' in data:
+                ret = {'challenge': data['challenge']}
+            elif 'event' in data and data.get('schema') == '2.0':
+                ret = process_event(**data['event'])
+            elif 'action' in data:
+                ret = process_action(data['open_message_id'], data['open_chat_id'], data['action'], data['token'], data['open_id'])
+            elif 'content' in data:
+                cmd = data.pop('content', '')
+                ret = {'success': True, 'message': route_todo(cmd, **data)}
+            else:
+                ret = {'success': False, 'message': f'unknown data.\n{data}'}
+            return json.dumps(ret)
     elif request.content_type.startswith('application/form-data'):
-        print(request.form)
+        logger.info('form request: %s', request.form)
     else:
-        print(request.values)
+        logger.info('request: %s', request.values)
+
+
+@app.route('/metrics')
+def metrics_endpoint():
+    if not metrics.enabled:
+        return 'metrics disabled', 404
+    return metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+
+@app.route('/admin/profiles', methods=['GET', 'POST', 'DELETE'])
+def admin_profiles():
+    '''慢命令剖析的管理接口
+    GET: 当前配置和最近的慢命令(新的在前); POST json: 修改配置(enabled/mode/threshold_ms/keep); DELETE: 清空
+    需配置 [Profiler] AdminToken 并在X-Admin-Token 头中携带, 未配置时接口关闭
+    '''
+    if not (token := conf.get('Profiler', 'AdminToken', fallback='')):
+        return 'admin disabled', 404
+    if not hmac.compare_digest(request.headers.get('X-Admin-Token', '').encode(), token.encode()):
+        return 'forbidden', 403
+    if request.method == 'POST':
+        try:
+            profiler.configure(**request.get_json())
+        except (TypeError, ValueError) as e:
+            return str(e), 400
+    elif request.method == 'DELETE':
+        profiler.traces.clear()
+    return json.dumps({**profiler.settings(), 'traces': list(reversed(profiler.traces))}, ensure_ascii=False)
 
 
 def process_event(sender: dict, message: dict):
@@ -75,9 +111,18 @@ def process_action(msg_id, chat_id, action: dict, token: str, op_open_id: str):
 
 
 if __name__ == '__main__':
-    print('CPU count:', cpu_count())
+    logging.getLogger(__name__).info('CPU count: %d', cpu_count())
+    # 默认在fork 进程池前加载武将和牌库并gc.freeze, worker 共享这些内存页;
+    # 关闭PreloadBeforeFork 则在后台加载, 不阻塞启动, 但每个worker 会各自加载一份
+    preloads = (hero_mgr, Card.preload)
+    if conf.getboolean('Pool', 'PreloadBeforeFork', fallback=True):
+        preload(*preloads)
+    else:
+        warm_up(*preloads)
+    # 只有主进程监听武将md, worker 在执行任务前按主进程的版本同步
+    watch_heros()
     with (Manager() as manager,
-          Pool(4) as pool,
+          Pool(conf.getint('Pool', 'Workers', fallback=4), initializer=init_worker, initargs=preloads) as pool,
           user_mgr_ctx(conf['Local']['UserRcordPath'])):
         common.manager = manager
         common.process_pool = pool
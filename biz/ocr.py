@@ -0,0 +1,168 @@
+'''图片文字识别(飞书OCR)
+- 图片流式下载并同时计算sha256, 识别结果按图片内容缓存(同一截图再发不再识别), 按文本字节数限制大小, LRU 淘汰
+- 识别在有界的线程池中执行, 排队的任务数达到上限时拒绝; 同一图片正在识别时等待其结果, 不重复请求
+- 识别出的文本按武将名索引解析出其中的武将
+conf 中 [OCR]: Workers 线程数(默认2), MaxPending 排队上限(默认16), CacheBytes 缓存大小(默认4MB)
+'''
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+import contextvars
+from dataclasses import dataclass, field
+import logging
+import threading
+
+from common import conf
+from sgs.heros import hero_mgr
+from utils import fs_util
+from utils.metrics import cache_access
+
+
+class OcrBusy(RuntimeError):
+    pass
+
+
+@dataclass
+class OcrResult:
+    '''digest: 图片内容的sha256
+    texts: 识别出的文本行
+    heros: 文本中出现的武将名(按出现顺序去重)
+    cached: 是否来自缓存
+    '''
+    digest: str
+    texts: list
+    heros: list = field(default_factory=list)
+    cached: bool = False
+
+
+class OcrCache:
+    '''图片摘要 -> 文本行, 文本总字节数超过max_bytes 时淘汰最久未用的
+    '''
+    ENTRY_OVERHEAD = 128    # 每条的摘要、容器等的估计字节数
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()    # 摘要 -> (文本行, 字节数)
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, digest):
+        with self.lock:
+            if entry := self.entries.get(digest):
+                self.entries.move_to_end(digest)
+        cache_access('ocr', entry is not None)
+        return entry and entry[0]
+
+    def put(self, digest, texts):
+        size = sum(len(t.encode('utf-8')) for t in texts) + self.ENTRY_OVERHEAD
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if old := self.entries.pop(digest, None):
+                self.size -= old[1]
+            self.entries[digest] = (texts, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.size -= evicted
+
+
+def match_heros(texts, index=None):
+    '''从文本行中找出武将名: 每个位置取最长的匹配, 匹配上则跳过该名字
+    index: 武将名 -> 武将, 默认取hero_mgr.name_index
+    '''
+    index = hero_mgr.name_index if index is None else index
+    lengths = sorted({len(name) for name in index}, reverse=True)
+    found = {}
+    for line in texts:
+        i = 0
+        while i < len(line):
+            for n in lengths:
+                if (name := line[i:i + n]) in index:
+                    found[name] = None
+                    i += n
+                    break
+            else:
+                i += 1
+    return list(found)
+
+
+class OcrService:
+    def __init__(self, workers=2, max_pending=16, cache_bytes=4 << 20):
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix='ocr')
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.cache = OcrCache(cache_bytes)
+        self.inflight = {}      # 摘要 -> 正在识别的Future
+        self.lock = threading.Lock()
+
+    def recognize(self, msg_id, image_key) -> OcrResult:
+        '''同步识别(在调用线程中)
+        '''
+        digest, data = fs_util.download_image(msg_id, image_key)
+        if (texts := self.cache.get(digest)) is not None:
+            return OcrResult(digest, texts, match_heros(texts), True)
+        with self.lock:
+            future = self.inflight.get(digest)
+            owner = future is None
+            if owner:
+                future = self.inflight[digest] = Future()
+        if not owner:
+            texts = future.result()
+            return OcrResult(digest, texts, match_heros(texts), True)
+        try:
+            texts = fs_util.recognize_image(data)
+            self.cache.put(digest, texts)
+            future.set_result(texts)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                del self.inflight[digest]
+        return OcrResult(digest, texts, match_heros(texts))
+
+    def submit(self, msg_id, image_key, callback=None, error_callback=None) -> Future:
+        '''在线程池中识别, 完成后在该线程中调用callback(OcrResult), 识别或callback 失败时调用error_callback(异常)
+        排队的任务数达到MaxPending 时抛出OcrBusy; 任务沿用提交时的上下文(日志的request_id)
+        '''
+        if not self.slots.acquire(blocking=False):
+            raise OcrBusy('图片识别繁忙, 请稍后再试')
+        ctx = contextvars.copy_context()
+        try:
+            future = self.executor.submit(ctx.run, self._run, msg_id, image_key, callback, error_callback)
+        except BaseException:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda _: self.slots.release())
+        return future
+
+    def _run(self, msg_id, image_key, callback, error_callback):
+        '''Future 的结果无人读取, 识别或回调中的异常都在这里记录日志并交给error_callback
+        '''
+        try:
+            result = self.recognize(msg_id, image_key)
+        except Exception as e:
+            logging.getLogger(__name__).error('ocr %s failed %s', image_key, e, exc_info=True)
+            self._call(error_callback, e)
+            raise
+        if callback:
+            try:
+                callback(result)
+            except Exception as e:
+                logging.getLogger(__name__).error('ocr %s callback failed %s', image_key, e, exc_info=True)
+                self._call(error_callback, e)
+        return result
+
+    @staticmethod
+    def _call(error_callback, e):
+        if error_callback:
+            try:
+                error_callback(e)
+            except Exception as ee:
+                logging.getLogger(__name__).error('ocr error_callback failed %s', ee, exc_info=True)
+
+ocr_service = OcrService(conf.getint('OCR', 'Workers', fallback=2),
+                         conf.getint('OCR', 'MaxPending', fallback=16),
+                         conf.getint('OCR', 'CacheBytes', fallback=4 << 20))
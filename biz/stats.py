@@ -0,0 +1,199 @@
+from collections import Counter
+from datetime import datetime
+
+from utils.serializer import serializable
+
+
+class _Bucket:
+    '''计数相同的key 组成一个桶, 桶按计数从高到低串成双向链表
+    keys 用dict 保持插入顺序: 同计数下先达到的排在前面
+    '''
+    __slots__ = ('n', 'keys', 'higher', 'lower')
+
+    def __init__(self, n, higher=None, lower=None):
+        self.n = n
+        self.keys = {}
+        self.higher = higher
+        self.lower = lower
+
+
+class Leaderboard:
+    '''只增不减的计数排行榜(LFU 式的计数桶链表)
+    incr 只会把key 移到相邻的桶, O(1); top(k) 从最高的桶往下走, 每个桶至少产出一个key, O(k)
+    counts: key -> 计数
+    '''
+    def __init__(self):
+        self.counts = {}
+        self._buckets = {}      # 计数 -> 桶, 只保存非空桶
+        self._head = None       # 计数最高的桶
+        self._tail = None       # 计数最低的桶
+
+    def __len__(self):
+        return len(self.counts)
+
+    def __getitem__(self, key):
+        return self.counts.get(key, 0)
+
+    def incr(self, key):
+        n = self.counts.get(key, 0)
+        cur = self._buckets.get(n)
+        if cur:
+            del cur.keys[key]
+        # 新计数n+1 的桶要么已存在, 要么紧挨着插在cur 之上(key 是新的时插在链表尾部)
+        if (up := self._buckets.get(n + 1)) is None:
+            if cur:
+                up = _Bucket(n + 1, cur.higher, cur)
+            else:
+                up = _Bucket(n + 1, self._tail, None)
+            self._link(up)
+        up.keys[key] = None
+        self.counts[key] = n + 1
+        if cur and not cur.keys:
+            self._unlink(cur)
+        return n + 1
+
+    def top(self, k):
+        '''返回前k 个(key, 计数)
+        '''
+        ranked = []
+        bucket = self._head
+        while bucket and len(ranked) < k:
+            for key in bucket.keys:
+                ranked.append((key, bucket.n))
+                if len(ranked) == k:
+                    break
+            bucket = bucket.lower
+        return ranked
+
+    def rank(self, key):
+        '''key 的名次(并列取最高名次), 没有计数返回None; 耗时与比它高的桶数成正比
+        '''
+        if not (n := self.counts.get(key)):
+            return None
+        ahead = 0
+        bucket = self._head
+        while bucket.n > n:
+            ahead += len(bucket.keys)
+            bucket = bucket.lower
+        return ahead + 1
+
+    def _link(self, bucket):
+        self._buckets[bucket.n] = bucket
+        if bucket.higher:
+            bucket.higher.lower = bucket
+        else:
+            self._head = bucket
+        if bucket.lower:
+            bucket.lower.higher = bucket
+        else:
+            self._tail = bucket
+
+    def _unlink(self, bucket):
+        del self._buckets[bucket.n]
+        if bucket.higher:
+            bucket.higher.lower = bucket.lower
+        else:
+            self._head = bucket.lower
+        if bucket.lower:
+            bucket.lower.higher = bucket.higher
+        else:
+            self._tail = bucket.higher
+
+    def items(self):
+        '''按排名顺序生成(key, 计数)
+        '''
+        bucket = self._head
+        while bucket:
+            for key in bucket.keys:
+                yield key, bucket.n
+            bucket = bucket.lower
+
+    @classmethod
+    def from_items(cls, items):
+        '''items: 按排名顺序的(key, 计数)
+        '''
+        board = cls()
+        lower = None
+        for key, n in items:
+            if lower is None or lower.n != n:
+                lower = _Bucket(n, lower, None)
+                board._link(lower)
+            lower.keys[key] = None
+            board.counts[key] = n
+        return board
+
+
+@serializable(40)
+class WinStats:
+    '''获胜记录的增量聚合, 每次获胜时更新, 查询不再扫描用户的records
+    获胜次数按每次记录累计, 与User.records(同一模式同一角色只保留一条, 且会合并掉已消费的) 不同
+    total: 用户 -> 总获胜次数 的排行榜
+    weekly: 周(周一的日期序数) -> 用户本周获胜次数的排行榜, 只保留最近KEEP_WEEKS 周
+    modes/roles: 游戏模式/角色 -> 获胜次数 的排行榜
+    user_modes/user_roles: 用户 -> 各游戏模式/角色的获胜次数
+
+    KEEP_WEEKS: 保留的周榜个数
+    '''
+    KEEP_WEEKS = 4
+
+    def __init__(self):
+        self.total = Leaderboard()
+        self.weekly = {}
+        self.modes = Leaderboard()
+        self.roles = Leaderboard()
+        self.user_modes = {}
+        self.user_roles = {}
+
+    @staticmethod
+    def week_of(r_time: datetime):
+        return r_time.toordinal() - r_time.weekday()
+
+    def add(self, name, record):
+        self.total.incr(name)
+        self.modes.incr(record.game_mode)
+        self.roles.incr(record.role)
+        self.user_modes.setdefault(name, Counter())[record.game_mode] += 1
+        self.user_roles.setdefault(name, Counter())[record.role] += 1
+        week = self.week_of(record.r_time)
+        if (board := self.weekly.get(week)) is None:
+            if len(self.weekly) >= self.KEEP_WEEKS and week < min(self.weekly):
+                return      # 早于保留范围的记录(如重放很旧的日志) 不计入周榜
+            board = self.weekly[week] = Leaderboard()
+            for old in sorted(self.weekly)[:-self.KEEP_WEEKS]:
+                del self.weekly[old]
+        board.incr(name)
+
+    def week_board(self, r_time=None) -> Leaderboard:
+        return self.weekly.get(self.week_of(r_time or datetime.now())) or Leaderboard()
+
+    @classmethod
+    def from_users(cls, users):
+        '''早期快照没有聚合数据, 用现存的记录近似重建
+        '''
+        stats = cls()
+        for user in users:
+            for record in sorted(user.records.values(), key=lambda r: r.r_time):
+                stats.add(user.name, record)
+        return stats
+
+    def to_record(self):
+        '''排行榜按排名顺序保存, 加载时不需要排序
+        '''
+        return [list(self.total.items()),
+                [[week, list(board.items())] for week, board in self.weekly.items()],
+                list(self.modes.items()),
+                list(self.roles.items()),
+                self.user_modes,
+                self.user_roles]
+
+    @classmethod
+    def from_record(cls, record, version):
+        total, weekly, modes, roles, user_modes, user_roles = record
+        stats = cls()
+        stats.total = Leaderboard.from_items(total)
+        stats.weekly = {week: Leaderboard.from_items(items) for week, items in weekly}
+        stats.modes = Leaderboard.from_items(modes)
+        stats.roles = Leaderboard.from_items(roles)
+        stats.user_modes = {name: Counter(c) for name, c in user_modes.items()}
+        stats.user_roles = {name: Counter(c) for name, c in user_roles.items()}
+        return stats
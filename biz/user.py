@@ -1,50 +1,83 @@
+from collections import Counter, OrderedDict
 from contextlib import contextmanager
 from dataclasses import dataclass, field
 from datetime import datetime, timedelta
-from functools import cached_property
+from functools import lru_cache
+import gc
 import hashlib
+import logging
+from operator import attrgetter
 import os
 import pickle
-from typing import MappingView, Optional
+from sys import intern
+import threading
+from typing import Optional
 
+from biz.stats import WinStats
+from common import conf
+from utils import serializer
+from utils.redis_util import RedisClient
+from utils.serializer import serializable
 
-@dataclass
+
+@lru_cache(maxsize=4096)
+def record_key(game_mode, role):
+    '''同一模式同一角色的记录共用一个r_key, 不同用户间大量重复, 缓存md5 结果
+    '''
+    return hashlib.md5(f'{game_mode}\t{role}'.encode('utf8')).hexdigest()
+
+
+@dataclass(slots=True)
 class Record:
     '''一条游戏记录
     游戏模式; 游戏角色; 记录时间
     '''
     game_mode: str
     role: str
-    r_time: datetime = datetime.now()
+    r_time: datetime = field(default_factory=datetime.now)
 
-    @cached_property
+    @property
     def r_key(self):
-        m = hashlib.md5(f'{self.game_mode}\t{self.role}'.encode('utf8'))
-        return m.hexdigest()
+        return record_key(self.game_mode, self.role)
+
+    def __setstate__(self, state):
+        '''早期pickle 的Record 带__dict__(含缓存的r_key)
+        '''
+        if isinstance(state, tuple):
+            state = state[1]
+        for name in self.__slots__:
+            setattr(self, name, state[name])
 
 
+@serializable(30, version=2)
 @dataclass
 class User:
     '''用户的相关记录：
-    records: r_key -> Record 的映射
+    records: r_key -> Record 的有序映射, 按记录时间从早到晚(重复的r_key 会移到末尾)
     last_record_time: 最近一次记录时间
     luck_consumed: 已消费的手气卡数量
     rep_consumed: 已消费的换将卡数量
     '''
     name: str
-    records: dict = field(default_factory=dict)
+    records: OrderedDict = field(default_factory=OrderedDict)
     last_record_time: Optional[datetime] = None
     luck_consumed: int = 0
     rep_consumed: int = 0
 
     def add_record(self, game_mode, role):
+        '''返回新增的Record, 距上次记录不足5分钟则返回None
+        '''
         record = Record(game_mode, role)
         if not self.last_record_time or (record.r_time - self.last_record_time) > timedelta(minutes=5):
-            self.records[record.r_key] = record
-            self.last_record_time = record.r_time
-            return True
-        else:
-            return False
+            self.put_record(record)
+            return record
+
+    def put_record(self, record):
+        '''不做时间检查直接记录(用于日志重放)
+        '''
+        self.records[record.r_key] = record
+        self.records.move_to_end(record.r_key)
+        self.last_record_time = record.r_time
         
     @property
     def luck_num(self):
@@ -57,41 +90,457 @@ class User:
         '''换将卡数量 = 获胜记录数 - 已消费的换将卡数
         '''
         return len(self.records) - self.rep_consumed
-    
-    def __get_state__(self):
+
+    def compact(self):
+        '''移除两种卡都已消费掉的最早的记录, 返回移除的r_key 列表
+        记录按时间有序, 从头弹出即可, 耗时与移除的条数成正比
+        '''
+        remove_num = min(self.luck_consumed, self.rep_consumed, len(self.records))
+        self.luck_consumed -= remove_num
+        self.rep_consumed -= remove_num
+        return [self.records.popitem(last=False)[0] for _ in range(remove_num)]
+
+    def __getstate__(self):
         dump_dict = vars(self).copy()
-        remove_num = min(self.luck_consumed, self.rep_consumed)
-        if remove_num:
-            sorted_records = sorted(self.records.values(), key=lambda x: x.r_time)
-            dump_dict['records'] = list(sorted_records)[remove_num:]
-            dump_dict['luck_consumed'] -= remove_num
-            dump_dict['rep_consumed'] -= remove_num
-        else:
-            dump_dict['records'] = self.records.values()
+        dump_dict['records'] = list(self.records.values())
         return dump_dict
     
-    def __set_state__(self, state):
-        super().__setattr__(state)
-        if isinstance(self.records, (list, MappingView)):
-            self.records = {r.r_key: r for r in self.records}
+    def __setstate__(self, state):
+        '''早期dump 的records 是dict(未必按时间有序) 或Record 序列
+        '''
+        vars(self).update(state)
+        records = self.records.values() if isinstance(self.records, dict) else self.records
+        self.records = self.ordered_records(records)
+
+    @staticmethod
+    def ordered_records(records):
+        '''按时间排序(已有序时timsort 为线性) 后以r_key 建立有序映射
+        '''
+        return OrderedDict((r.r_key, r) for r in sorted(records, key=attrgetter('r_time')))
+
+    def to_record(self):
+        '''Record 内联为 [game_mode, role, 时间戳], 按时间从早到晚
+        '''
+        return [self.name,
+                [[r.game_mode, r.role, r.r_time.timestamp()] for r in self.records.values()],
+                self.last_record_time.timestamp() if self.last_record_time else None,
+                self.luck_consumed,
+                self.rep_consumed]
+
+    @classmethod
+    def from_record(cls, record, version):
+        '''version 1 的记录未必按时间有序, 需要排序; 之后的版本按dump 时的顺序直接建立映射
+        模式和角色在用户间大量重复, intern 后共用同一个字符串
+        '''
+        name, records, last_ts, luck_consumed, rep_consumed = record
+        fromtimestamp = datetime.fromtimestamp
+        records = (Record(intern(mode), intern(role), fromtimestamp(ts)) for mode, role, ts in records)
+        return cls(name,
+                   cls.ordered_records(records) if version < 2 else OrderedDict((r.r_key, r) for r in records),
+                   fromtimestamp(last_ts) if last_ts is not None else None,
+                   luck_consumed,
+                   rep_consumed)
+
+
+class UserLedger:
+    '''Redis 中的用户计数账本, 所有进程和节点共享, 每个命令一次往返(Lua 脚本保证原子性)
+    counter_key: 计数hash, 字段 wins(获胜记录数)、luck_consumed、rep_consumed、last_ts(最近获胜时间戳)
+    wins_key: 获胜记录r_key 的集合(同一模式同一角色只计一次, 同User.records)
+
+    WIN_INTERVAL: 两次获胜记录的最小间隔秒数
+    '''
+    counter_key = 'uc_%s'
+    wins_key = 'uw_%s'
+    WIN_INTERVAL = 300
+
+    # KEYS: 计数hash, r_key 集合; ARGV: r_key, 时间戳, 最小间隔
+    WIN_SCRIPT = '''
+local last = tonumber(redis.call('HGET', KEYS[1], 'last_ts') or '0')
+if last > 0 and tonumber(ARGV[2]) - last <= tonumber(ARGV[3]) then
+    return 0
+end
+if redis.call('SADD', KEYS[2], ARGV[1]) == 1 then
+    redis.call('HINCRBY', KEYS[1], 'wins', 1)
+end
+redis.call('HSET', KEYS[1], 'last_ts', ARGV[2])
+return 1
+'''
+    # KEYS: 计数hash; ARGV: 消费字段; 剩余(wins - 已消费) 大于0 才消费, 返回消费后的剩余, 否则返回-1
+    CONSUME_SCRIPT = '''
+local vals = redis.call('HMGET', KEYS[1], 'wins', ARGV[1])
+local left = tonumber(vals[1] or '0') - tonumber(vals[2] or '0')
+if left <= 0 then
+    return -1
+end
+redis.call('HINCRBY', KEYS[1], ARGV[1], 1)
+return left - 1
+'''
+    # KEYS: 计数hash, r_key 集合; ARGV: wins, luck_consumed, rep_consumed, last_ts, r_key...; 已存在则不覆盖
+    SEED_SCRIPT = '''
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return 0
+end
+redis.call('HSET', KEYS[1], 'wins', ARGV[1], 'luck_consumed', ARGV[2], 'rep_consumed', ARGV[3], 'last_ts', ARGV[4])
+for i = 5, #ARGV do
+    redis.call('SADD', KEYS[2], ARGV[i])
+end
+return 1
+'''
+
+    # KEYS: 计数hash, r_key 集合; ARGV: 要移除的r_key...
+    # 最多移除min(luck_consumed, rep_consumed) 条, wins 和两种已消费数同减, 剩余卡数不变; 返回移除的条数
+    TRIM_SCRIPT = '''
+local vals = redis.call('HMGET', KEYS[1], 'luck_consumed', 'rep_consumed')
+local limit = math.min(tonumber(vals[1] or '0'), tonumber(vals[2] or '0'))
+local removed = 0
+for i = 1, #ARGV do
+    if removed >= limit then
+        break
+    end
+    removed = removed + redis.call('SREM', KEYS[2], ARGV[i])
+end
+if removed > 0 then
+    redis.call('HINCRBY', KEYS[1], 'wins', -removed)
+    redis.call('HINCRBY', KEYS[1], 'luck_consumed', -removed)
+    redis.call('HINCRBY', KEYS[1], 'rep_consumed', -removed)
+end
+return removed
+'''
+
+    def __init__(self, client=None):
+        self.client = client or RedisClient().client
+        self._win = self.client.register_script(self.WIN_SCRIPT)
+        self._consume = self.client.register_script(self.CONSUME_SCRIPT)
+        self._seed = self.client.register_script(self.SEED_SCRIPT)
+        self._trim = self.client.register_script(self.TRIM_SCRIPT)
+
+    def keys(self, name):
+        return [self.counter_key % name, self.wins_key % name]
+
+    def win(self, name, record: Record) -> bool:
+        return bool(self._win(self.keys(name), [record.r_key, record.r_time.timestamp(), self.WIN_INTERVAL]))
+
+    def consume(self, name, kind) -> int:
+        '''kind: luck/rep, 返回消费后的剩余数, 没有可消费的返回-1
+        '''
+        return self._consume(self.keys(name)[:1], [f'{kind}_consumed'])
+
+    def left(self, name, kind) -> int:
+        wins, consumed = self.client.hmget(self.counter_key % name, 'wins', f'{kind}_consumed')
+        return int(wins or 0) - int(consumed or 0)
+
+    def trim(self, users, batch=1000):
+        '''users: (用户名, 本地合并掉的r_key 列表), 同步移除账本中的记录, 按batch 个用户一次往返
+        '''
+        with self.client.pipeline(transaction=False) as pipe:
+            for i, (name, r_keys) in enumerate(users, 1):
+                self._trim(self.keys(name), r_keys, client=pipe)
+                if i % batch == 0:
+                    pipe.execute()
+            pipe.execute()
+
+    def seed(self, users, batch=1000):
+        '''将本地记录写入账本中还没有的用户(首次启用账本时迁移), 返回写入的用户数
+        每batch 个用户先一次往返批量EXISTS, 只发送账本中没有的用户的记录; 正常重启时只有EXISTS 的往返
+        '''
+        users = list(users)
+        seeded = 0
+        with self.client.pipeline(transaction=False) as pipe:
+            for begin in range(0, len(users), batch):
+                chunk = users[begin:begin + batch]
+                for user in chunk:
+                    pipe.exists(self.counter_key % user.name)
+                missing = [user for user, exists in zip(chunk, pipe.execute()) if not exists]
+                if not missing:
+                    continue
+                for user in missing:
+                    last_ts = user.last_record_time.timestamp() if user.last_record_time else 0
+                    self._seed(self.keys(user.name),
+                               [len(user.records), user.luck_consumed, user.rep_consumed, last_ts, *user.records],
+                               client=pipe)
+                seeded += sum(pipe.execute())
+        return seeded
 
 
 class UserMgr:
+    '''用户记录管理
+    user_dict: 用户名 -> User
+    持久化为快照(file_path) + 追加写的日志(file_path.wal):
+    每次获胜/消费只向日志追加一帧并fsync, 启动时加载快照再重放日志, 日志达到COMPACT_EVERY 条时合并为新快照
+    日志帧为 [seq, op, name, *args], 快照记录其包含的最后seq, 重放时跳过已并入快照的帧
+    合并时当前日志轮转为file_path.wal.old, 新快照在后台线程中写出, 完成后删除.old; 写快照失败则.old 保留,
+    下次轮转时追加到其后, 启动时先重放.old 再重放当前日志
+    lock: 请求线程并发调用, 判定+修改+写日志、快照的序列化和日志轮转都在锁内, seq 不重复, 快照不会读到修改中的数据
+    ledger: 给定时以Redis 账本为准做获胜/消费的判定, 本地记录只做镜像; 日志只由load 的进程写入
+    dirty: 上次合并后消费过卡的用户名, 合并快照时只对这些用户移除已消费的记录
+    stats: 获胜记录的聚合(排行榜、各模式/角色的获胜次数), 随获胜增量更新, 和用户一起存入快照
+
+    WAL_SUFFIX: 日志文件后缀
+    COMPACT_EVERY: 触发合并的日志条数
+    '''
     user_dict = {}
+    file_path = None
+    wal = None
+    seq = 0
+    wal_cnt = 0
+    ledger = None
+    pid = None
+    dirty = set()
+    stats = WinStats()
+    lock = threading.RLock()
+    snapshot_thread = None
+
+    WAL_SUFFIX = '.wal'
+    OLD_SUFFIX = '.old'
+    COMPACT_EVERY = 1000
 
     @classmethod
-    def load(cls, file_path:str):
+    def load(cls, file_path:str, ledger: Optional[UserLedger] = None):
+        '''加载快照时暂停gc: 百万级的Record 会反复触发全量回收, 而此时生成的对象都不是垃圾
+        早期快照中的记录从未合并过, 有两种卡都消费过的用户全部标记为dirty
+        '''
+        cls.file_path = file_path
+        cls.seq = 0
+        stats = None
         if os.path.exists(file_path):
             with open(file_path, 'rb') as f:
-                user_list = pickle.load(f)
-                cls.user_dict = {u.name: u for u in user_list}
+                data = f.read()
+            gc.disable()
+            try:
+                # 兼容早期的pickle 文件
+                snapshot = serializer.loads(data) if serializer.is_packed(data) else pickle.loads(data)
+            finally:
+                gc.enable()
+            if isinstance(snapshot, dict):
+                cls.seq = snapshot['seq']
+                stats = snapshot.get('stats')
+                snapshot = snapshot['users']
+            cls.user_dict = {u.name: u for u in snapshot}
+        cls.stats = stats or WinStats.from_users(cls.user_dict.values())
+        cls.dirty = {name for name, u in cls.user_dict.items() if u.luck_consumed and u.rep_consumed}
+        wal_path = file_path + cls.WAL_SUFFIX
+        cls.wal_cnt = cls.replay(wal_path + cls.OLD_SUFFIX) + cls.replay(wal_path)
+        cls.wal = open(wal_path, 'ab')
+        cls.pid = os.getpid()
+        if ledger:
+            ledger.seed(cls.user_dict.values())
+        cls.ledger = ledger
+
+    @classmethod
+    def replay(cls, wal_path:str):
+        '''重放日志, 截掉末尾写了一半的帧, 返回日志中的帧数
+        '''
+        if not os.path.exists(wal_path):
+            return 0
+        cnt = offset = 0
+        with open(wal_path, 'r+b') as f:
+            for (seq, op, name, *args), offset in serializer.iter_frames(f):
+                cnt += 1
+                if seq > cls.seq:
+                    cls.apply(op, cls.get_user(name), *args)
+                    cls.seq = seq
+            f.truncate(offset)
+        return cnt
+
+    @staticmethod
+    def apply(op, user, *args):
+        match op:
+            case 'win':
+                mode, role, ts = args
+                record = Record(mode, role, datetime.fromtimestamp(ts))
+                user.put_record(record)
+                UserMgr.stats.add(user.name, record)
+            case 'luck':
+                user.luck_consumed += 1
+                UserMgr.dirty.add(user.name)
+            case 'rep':
+                user.rep_consumed += 1
+                UserMgr.dirty.add(user.name)
+            case _:
+                raise ValueError(f'unknown op {op}')
+
+    @classmethod
+    def log(cls, op, name, *args):
+        '''追加一帧日志, 未load 时(如脚本中直接使用) 只改内存; fork 出的子进程不写日志
+        '''
+        if cls.wal is None or os.getpid() != cls.pid:
+            return
+        with cls.lock:
+            cls.seq += 1
+            cls.wal.write(serializer.frame([cls.seq, op, name, *args]))
+            cls.wal.flush()
+            os.fsync(cls.wal.fileno())
+            cls.wal_cnt += 1
+            if cls.wal_cnt >= cls.COMPACT_EVERY:
+                cls.compact(background=True)
+
+    @classmethod
+    def add_record(cls, name, game_mode, role):
+        '''记录一次获胜, 返回是否记录成功
+        '''
+        with cls.lock:
+            user = cls.get_user(name)
+            if cls.ledger:
+                record = Record(game_mode, role)
+                if not cls.ledger.win(name, record):
+                    return False
+                user.put_record(record)
+            elif not (record := user.add_record(game_mode, role)):
+                return False
+            cls.stats.add(name, record)
+            cls.log('win', name, game_mode, role, record.r_time.timestamp())
+            return True
+
+    @classmethod
+    def consume(cls, name, kind):
+        '''消耗一张手气卡(luck) 或换将卡(rep), 没有可用的卡返回False
+        '''
+        with cls.lock:
+            user = cls.get_user(name)
+            if cls.ledger:
+                if cls.ledger.consume(name, kind) < 0:
+                    return False
+            elif cls.card_num(name, kind) <= 0:
+                return False
+            setattr(user, f'{kind}_consumed', getattr(user, f'{kind}_consumed') + 1)
+            cls.dirty.add(name)
+            cls.log(kind, name)
+            return True
+
+    @classmethod
+    def card_num(cls, name, kind):
+        '''手气卡(luck)/换将卡(rep) 的剩余数量
+        '''
+        if cls.ledger:
+            return cls.ledger.left(name, kind)
+        return getattr(cls.get_user(name), f'{kind}_num')
+
+    @classmethod
+    def compact(cls, background=False):
+        '''移除dirty 用户已消费的记录, 轮转日志, 再写新快照(先写临时文件再原子替换) 后删除轮转出的日志
+        替换后、删除前崩溃也无妨: 轮转出的帧seq 都不大于快照的seq, 重放时会跳过
+        移除记录不改变剩余卡数, 账本与快照谁先完成都不影响判定
+        background: 在后台线程中写快照, 调用方(触发合并的请求) 只做轮转; 上一次的快照还没写完则跳过本次
+        '''
+        if not background and cls.snapshot_thread:
+            cls.snapshot_thread.join()
+        with cls.lock:
+            if cls.snapshot_thread and cls.snapshot_thread.is_alive():
+                return
+            trimmed = cls.trim()
+            cls.rotate()
+            if background:
+                cls.snapshot_thread = threading.Thread(target=cls._background_snapshot, args=(trimmed,),
+                                                       name='user_snapshot', daemon=True)
+                cls.snapshot_thread.start()
+                return
+        cls.snapshot(trimmed)
+
+    @classmethod
+    def rotate(cls):
+        '''当前日志移到.old(已有.old 则追加到其后), 重新开始写空日志; 调用方持有lock
+        '''
+        if cls.wal is None:
+            return
+        wal_path = cls.file_path + cls.WAL_SUFFIX
+        old_path = wal_path + cls.OLD_SUFFIX
+        cls.wal.close()
+        if os.path.exists(old_path):
+            with open(wal_path, 'rb') as src, open(old_path, 'ab') as dst:
+                dst.write(src.read())
+                dst.flush()
+                os.fsync(dst.fileno())
+            os.remove(wal_path)
+        else:
+            os.replace(wal_path, old_path)
+        cls.wal = open(wal_path, 'ab')
+        cls.wal_cnt = 0
+
+    @classmethod
+    def snapshot(cls, trimmed):
+        '''锁内序列化(只占用内存操作的时间), 锁外写文件和fsync
+        '''
+        cls.write_snapshot(cls.file_path, cls.dumps())
+        if cls.ledger and trimmed:
+            cls.ledger.trim(trimmed)
+        old_path = cls.file_path + cls.WAL_SUFFIX + cls.OLD_SUFFIX
+        if os.path.exists(old_path):
+            os.remove(old_path)
+
+    @classmethod
+    def _background_snapshot(cls, trimmed):
+        try:
+            cls.snapshot(trimmed)
+        except Exception as e:
+            logging.getLogger(__name__).error('snapshot %s failed %s', cls.file_path, e, exc_info=True)
+
+    @classmethod
+    def trim(cls):
+        '''返回[(用户名, 移除的r_key 列表)]
+        '''
+        trimmed = [(name, r_keys) for name in cls.dirty if (r_keys := cls.user_dict[name].compact())]
+        cls.dirty = set()
+        return trimmed
+
+    @classmethod
+    def dumps(cls):
+        with cls.lock:
+            return serializer.dumps({'seq': cls.seq, 'users': list(cls.user_dict.values()), 'stats': cls.stats})
 
     @classmethod
     def dump(cls, file_path:str):
-        with open(file_path, 'wb') as f:
-            pickle.dump(list(cls.user_dict.values()), f)
-        print('dump done')
+        cls.write_snapshot(file_path, cls.dumps())
+
+    @classmethod
+    def write_snapshot(cls, file_path, data):
+        tmp_path = file_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, file_path)
+        logging.getLogger(__name__).info('dump %d users to %s', len(cls.user_dict), file_path)
+
+    @classmethod
+    def close(cls):
+        cls.compact()
+        if cls.wal is not None:
+            cls.wal.close()
+            cls.wal = None
     
+    @classmethod
+    def leaderboard(cls, board='week', k=10):
+        '''board: week(本周)/all(总榜)/mode(游戏模式)/role(角色), 返回前k 个(key, 获胜次数)
+        '''
+        with cls.lock:
+            match board:
+                case 'week':
+                    return cls.stats.week_board().top(k)
+                case 'all':
+                    return cls.stats.total.top(k)
+                case 'mode':
+                    return cls.stats.modes.top(k)
+                case 'role':
+                    return cls.stats.roles.top(k)
+                case _:
+                    raise ValueError(f'unknown leaderboard {board}')
+
+    @classmethod
+    def user_stats(cls, name, k=3):
+        '''用户的总获胜次数、本周获胜次数和名次、获胜最多的k 个模式和角色
+        '''
+        with cls.lock:
+            stats = cls.stats
+            week = stats.week_board()
+            return {
+                'total': stats.total[name],
+                'rank': stats.total.rank(name),
+                'week': week[name],
+                'week_rank': week.rank(name),
+                'modes': stats.user_modes.get(name, Counter()).most_common(k),
+                'roles': stats.user_roles.get(name, Counter()).most_common(k),
+            }
+
     @classmethod
     def get_user(cls, name) -> User:
         return cls.user_dict.setdefault(name, User(name))
@@ -99,9 +548,14 @@ class UserMgr:
 
 @contextmanager
 def user_mgr_ctx(file_path:str):
-    UserMgr.load(file_path)
-    yield
-    UserMgr.dump(file_path)
+    '''conf 中 [Local] UserLedger=1 时以Redis 账本做获胜/消费的判定, 多进程/多节点部署时必须开启;
+    默认只用本进程的本地记录
+    '''
+    UserMgr.load(file_path, UserLedger() if conf.getboolean('Local', 'UserLedger', fallback=False) else None)
+    try:
+        yield
+    finally:
+        UserMgr.close()
 
 
 if __name__ == '__main__':
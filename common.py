@@ -9,6 +9,10 @@ conf.optionxform = str
 conf.read(root_path / 'conf.ini')
 
 logging.config.fileConfig(root_path / 'log/log_conf.ini')
+from utils import log_util
+log_util.setup(conf.getboolean('Log', 'Async', fallback=True),
+               conf.getint('Log', 'BusySize', fallback=1000),
+               conf.get('Log', 'SampleRates', fallback='DEBUG:0.01,INFO:0.1'))
 
 process_pool = None
 manager = None
@@ -1,7 +1,8 @@
 import random
+from biz.ocr import OcrBusy, ocr_service
 from utils.router import route, MatchType as MT
 from utils.robot_adapter import robot
-from utils.fs_util import send_msg, get_image_stream
+from utils.fs_util import send_msg
 
 @route('我是谁', MT.KEYWORD)
 def whoami(content, ctx, *args, **kwargs):
@@ -21,5 +22,17 @@ def roll(cmd, ctx, *args, **kwargs):
 
 @route('get image text', MT.FULL_MATCH)
 def get_image_text(cmd, ctx, *args, **kwargs):
-    texts = get_image_stream(kwargs['msg_id'], kwargs['image_key'])
-    return send_msg(kwargs.get('chat_id'), '\n'.join(texts))
\ No newline at end of file
+    '''图片在OCR 线程池中识别, 识别完再回复, 不阻塞请求线程
+    '''
+    chat_id = kwargs.get('chat_id')
+    def reply(result):
+        lines = result.texts
+        if result.heros:
+            lines = [*lines, '', '武将: ' + ', '.join(result.heros)]
+        send_msg(chat_id, '\n'.join(lines))
+    try:
+        ocr_service.submit(kwargs['msg_id'], kwargs['image_key'], reply,
+                           lambda e: send_msg(chat_id, f'识别失败: {e}'))
+    except OcrBusy as e:
+        return send_msg(chat_id, str(e))
+    return kwargs['image_key']
\ No newline at end of file
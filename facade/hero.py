@@ -1,12 +1,19 @@
-import random
 from sgs.heros import hero_mgr
-import common
 from sgs.room import Room
 from utils.fs_template.cards import simple_card
-from utils.robot_adapter import robot
+from utils.robot_adapter import robot, robot_client
 from utils.router import route, MatchType as MT
 
-from sgs.events import event_err_handler
+
+def sample_heros(n, *conds):
+    '''随机取n 个符合条件的武将, 不够时返回(None, 符合条件的武将数)
+    '''
+    pools = hero_mgr.pools
+    try:
+        return pools.sample(n, *conds), None
+    except ValueError:
+        return None, len(pools.filter(*conds))
+
 
 @route('roll master', MT.PREFIX)
 def rollmaster(content, ctx, *args, **kwargs):
@@ -14,38 +21,58 @@ def rollmaster(content, ctx, *args, **kwargs):
         n = int(ctx[0])
     except ValueError:
         n = 2
-    robot(', '.join(random.sample(hero_mgr.monarchs, n)), kwargs.get('sender'))
+    if n < 1:
+        robot('主公个数需大于0', kwargs.get('sender'))
+        return 0
+    heros, size = sample_heros(n, hero_mgr.pools.MONARCH_COND)
+    if heros is None:
+        robot(f'主公只有{size}个', kwargs.get('sender'))
+        return 0
+    robot(', '.join(hero.name for hero in heros), kwargs.get('sender'))
     return n
 
 
 @route('roll hero', MT.PREFIX)
 def rollhero(content, ctx, *args, **kwargs):
+    '''roll hero [n] [条件...]
+    条件可以是势力、武将包或主公, 如 roll hero 3 魏 界
+    '''
     sender = kwargs.get('sender')
+    n, *conds = ctx[0].split() or ['']
     try:
-        n = int(ctx[0])
-        robot(', '.join(random.sample(hero_mgr.all_heros, n)), sender)
-        return n
+        n = int(n)
     except ValueError:
-        robot(random.choice(hero_mgr.heros).crawl_by_name(), sender)
-        return 1
+        conds.insert(0, n)
+        n = None
+    if n is not None and n < 1:
+        robot('武将个数需大于0', sender)
+        return 0
+    heros, size = sample_heros(1 if n is None else n, *filter(None, conds))
+    if heros is None:
+        robot(f'符合条件的武将只有{size}个' if size else '没有符合条件的武将', sender)
+        return 0
+    if n is not None:
+        robot(', '.join(hero.uni_name for hero in heros), sender)
+        return n
+    robot(heros[0].crawl_by_name(), sender)
+    return 1
 
 
 @route(lambda cmd, *a, **kv: (len(cs := cmd.split(' ')) < 3, cs), MT.TEST)
 def search_hero(cmd, ctx, *a, **kv):
-    for hero in hero_mgr.search(*ctx[0]):
-        robot(hero)
+    robot_client.send_many(hero_mgr.search(*ctx[0]))
     return ctx[0][0]
 
 
 @route('pick_hero', MT.FULL_MATCH)
 def pick(cmd, ctx, *args, **kwargs):
+    '''选将卡片的回调, 只把hero_id 交给房间的事件进程, 由其按座位校验并取回武将
+    按钮没有hero_id(以武将名生成的卡片) 时按uname 查找
+    '''
     room_id = kwargs.get('room_id')
-    op_open_id = kwargs.get('op_open_id')
-    hero_uname = kwargs['uname']
-    name, _, pack = hero_uname.partition('@')
-    def set_role_hero(heros):
-        Room.rooms_queue[room_id].put((op_open_id, heros[0]))
-    common.process_pool.apply_async(hero_mgr.search, (name, pack),
-                                    callback=set_role_hero, error_callback=event_err_handler)
-    return simple_card(room_id, f'你已选择{hero_uname}, 请等待其他玩家选择完毕')
-    
+    if (hero_id := kwargs.get('hero_id')) is not None:
+        hero_id = int(hero_id)
+    elif (hero_id := hero_mgr.pools.ids.get(kwargs.get('uname'))) is None:
+        return simple_card(room_id, f'没有找到武将{kwargs.get("uname")}, 请重新选择')
+    Room.rooms_queue[room_id].put((kwargs.get('op_open_id'), hero_id))
+    return simple_card(room_id, f'你已选择{kwargs["uname"]}, 请等待其他玩家选择完毕')
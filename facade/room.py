@@ -1,3 +1,4 @@
+import logging
 import random
 import time
 
@@ -17,7 +18,7 @@ def make_room(cmd, ctx, *args, **kwargs):
     room = Room(f'{time.time()}{random.random()}', user_cnt, int(cnt) if cnt else 1)
     assert room.cache() == user_cnt
     res = send_card(kwargs.get('chat_id'), 'ctp_AAy5FDrz9DNP', room_id=room.room_id)
-    print(res)
+    logging.getLogger(__name__).debug('room %s card sent: %s', room.room_id, res)
     return room.room_id
 
 @route('get_role', MT.FULL_MATCH)
@@ -36,5 +37,5 @@ def get_position(cmd, ctx, *args, **kwargs):
     msg = '\n'.join(f'{i} {ur.user_id} {ur.role.value} ({", ".join(map(str, ur.own_region))})'
                     for i, ur in enumerate(Room.rooms_map[room_id]))
     ret = send_msg(open_id, msg, 'open_id')
-    print(ret)
+    logging.getLogger(__name__).debug('position sent: %s', ret)
     return ret
\ No newline at end of file
@@ -10,8 +10,7 @@ from utils.router import route, MatchType as MT
 @route(r'win ([^+]+)\+(.+)', MT.REGEX)
 def win(cmd, ctx, *args, **kwargs):
     if sender := kwargs.get('sender'):
-        user = UserMgr.get_user(sender)
-        if user.add_record(*ctx[0].group(1, 2)):
+        if UserMgr.add_record(sender, *ctx[0].group(1, 2)):
             robot('已记录获胜')
             return True
         else:
@@ -25,8 +24,7 @@ def win(cmd, ctx, *args, **kwargs):
 @route('rep count', MT.FULL_MATCH)
 def rep_count(cmd, ctx, *args, **kwargs):
     if sender := kwargs.get('sender'):
-        user = UserMgr.get_user(sender)
-        robot(user.rep_num)
+        robot(UserMgr.card_num(sender, 'rep'))
         return True
     else:
         robot('Invalid user ' + sender)
@@ -35,8 +33,7 @@ def rep_count(cmd, ctx, *args, **kwargs):
 @route('luck count', MT.FULL_MATCH)
 def luck_count(cmd, ctx, *args, **kwargs):
     if sender := kwargs.get('sender'):
-        user = UserMgr.get_user(sender)
-        robot(user.luck_num)
+        robot(UserMgr.card_num(sender, 'luck'))
         return True
     else:
         robot('Invalid user ' + sender)
@@ -45,17 +42,14 @@ def luck_count(cmd, ctx, *args, **kwargs):
 @route('cost ', MT.PREFIX)
 def cost(cmd, ctx, *args, **kwargs):
     if sender := kwargs.get('sender'):
-        user = UserMgr.get_user(sender)
         match ctx[0]:
             case 'luck':
-                if user.luck_num > 0:
-                    user.luck_consumed += 1
+                if UserMgr.consume(sender, 'luck'):
                     robot('消耗一个手气卡')
                 else:
                     robot('已经没有手气卡')
             case 'rep':
-                if user.rep_num > 0:
-                    user.rep_consumed += 1
+                if UserMgr.consume(sender, 'rep'):
                     robot('消耗一次换将卡')
                 else:
                     robot('已经没有换将卡')
@@ -65,3 +59,35 @@ def cost(cmd, ctx, *args, **kwargs):
     else:
         robot('Invalid user ' + sender)
         return False
+
+
+LEADERBOARD_NAMES = {'week': '本周获胜榜', 'all': '总获胜榜', 'mode': '模式获胜榜', 'role': '角色获胜榜'}
+
+@route(r'^rank(?: (week|all|mode|role))?(?: (\d+))?$', MT.REGEX)
+def rank(cmd, ctx, *args, **kwargs):
+    '''rank [week|all|mode|role] [k], 默认本周前10
+    '''
+    board, k = ctx[0].groups()
+    board = board or 'week'
+    ranked = UserMgr.leaderboard(board, int(k or 10))
+    lines = [f'{i}. {key}: {n}' for i, (key, n) in enumerate(ranked, 1)]
+    robot('\n'.join([LEADERBOARD_NAMES[board], *lines]) if lines else '还没有获胜记录')
+    return True
+
+
+@route('my stats', MT.FULL_MATCH)
+def my_stats(cmd, ctx, *args, **kwargs):
+    if sender := kwargs.get('sender'):
+        stats = UserMgr.user_stats(sender)
+        rank_str = lambda r: f'第{r}名' if r else '未上榜'
+        top_str = lambda items: ', '.join(f'{key}({n})' for key, n in items) or '无'
+        robot('\n'.join([
+            f'总获胜: {stats["total"]} ({rank_str(stats["rank"])})',
+            f'本周获胜: {stats["week"]} ({rank_str(stats["week_rank"])})',
+            f'常胜模式: {top_str(stats["modes"])}',
+            f'常胜角色: {top_str(stats["roles"])}',
+        ]))
+        return True
+    else:
+        robot('Invalid user ' + sender)
+        return False
@@ -9,7 +9,12 @@ import string
 import sys
 from typing import Any
 
-from utils import classproperty
+from utils import classproperty, serializer
+from utils.metrics import cache_access
+from utils.serializer import serializable
+
+# 已加载的牌库: collection -> 牌的元组
+_libraries = {}
 
 
 @unique
@@ -32,6 +37,7 @@ class CardType(IntFlag):
             return super().__eq__(other)
 
 
+@serializable(20)
 @dataclass
 class Card:
     card_id: str
@@ -49,12 +55,10 @@ class Card:
     
     @classmethod
     def load(cls, collection='all'):
-        '''从缓存或文档加载牌库
-        返回Card 的生成器
+        '''从内存、缓存或文档加载牌库
+        返回Card 的生成器; 牌在对局中不会被修改, 各牌堆共享同一份已加载的牌
         '''
-        from .card_conf import doc_id, table_ids
-        from common import conf
-        from utils.fs_util import get_doc_table
+        from .card_conf import table_ids
         match collection:
             case 'all':
                 colls = table_ids.keys()
@@ -68,29 +72,56 @@ class Card:
             case _:
                 raise KeyError(f'unknown collection {collection}')
         for coll in colls:
-            p = Path(f"{conf['Local']['CardDumpPath']}{coll}.pickle")
-            if p.is_file():
-                with p.open('rb') as f:
-                    yield from pickle.load(f)
-            else:
-                cards = []
-                for table_id in table_ids[coll]:
-                    d = get_doc_table(doc_id, table_id)
-                    for color, ids in d.items():
-                        color_key = color.rsplit('(', 2)[1].split(')', 2)[0]
-                        assert len(color_key) == 1
-                        for n, name in ids.items():
-                            if '|' in name:
-                                for i, sub_name in enumerate(name.split('|')):
-                                    if sn := sub_name.strip():
-                                        card = cls.sub_cls_mapping[sn].make(color_key*(i+1) + n)
-                                        cards.append(card)
-                            elif sn := name.strip():
-                                card = cls.sub_cls_mapping[sn].make(color_key + n)
+            cache_access('card_library', (cards := _libraries.get(coll)) is not None)
+            if cards is None:
+                cards = _libraries.setdefault(coll, tuple(cls.load_collection(coll)))
+            yield from cards
+
+    @classmethod
+    def preload(cls, collection='all'):
+        '''提前把牌库加载到内存(如启动时在后台warm up)
+        '''
+        for _ in cls.load(collection):
+            pass
+
+    @classmethod
+    def load_collection(cls, coll):
+        from .card_conf import doc_id, table_ids
+        from common import conf
+        from utils.fs_util import get_doc_table
+        p = Path(f"{conf['Local']['CardDumpPath']}{coll}.msgpack")
+        legacy_p = p.with_suffix('.pickle')
+        if p.is_file():
+            return serializer.loads(p.read_bytes())
+        elif legacy_p.is_file():
+            with legacy_p.open('rb') as f:
+                return pickle.load(f)
+        cards = []
+        for table_id in table_ids[coll]:
+            d = get_doc_table(doc_id, table_id)
+            for color, ids in d.items():
+                color_key = color.rsplit('(', 2)[1].split(')', 2)[0]
+                assert len(color_key) == 1
+                for n, name in ids.items():
+                    if '|' in name:
+                        for i, sub_name in enumerate(name.split('|')):
+                            if sn := sub_name.strip():
+                                card = cls.sub_cls_mapping[sn].make(color_key*(i+1) + n)
                                 cards.append(card)
-                with p.open('wb') as f:
-                    pickle.dump(cards, f)
-                yield from cards
+                    elif sn := name.strip():
+                        card = cls.sub_cls_mapping[sn].make(color_key + n)
+                        cards.append(card)
+        p.write_bytes(serializer.dumps(cards))
+        return cards
+
+    def to_record(self):
+        return [self.card_id, self.name]
+
+    @classmethod
+    def from_record(cls, record, version):
+        card_id, name = record
+        sub_cls = Card.sub_cls_mapping[name]
+        return sub_cls(card_id, name, sub_cls.card_type)
 
     @classproperty(1)
     def sub_cls_mapping(cls) -> dict:
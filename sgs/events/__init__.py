@@ -17,11 +17,11 @@ class Event(ABC):
 
 class EventCenter:
 
-    def __init__(self, room_id, role_cycle):
+    def __init__(self, room_id, role_cycle, queue=None):
         self.room_id = room_id
         self.role_cycle = role_cycle
         self.cur_idx = 0
-        self.queue = common.manager.Queue()
+        self.queue = common.manager.Queue() if queue is None else queue
         # self.process_pool = common.process_pool   不能传pool
 
     def start(self):
@@ -37,6 +37,17 @@ class EventCenter:
             event.each(user_role, i+1)
 
 
+def run_game(room_id, collection, seats, queue):
+    '''worker 中执行一局游戏
+    只传房间id、牌库名、座位[(user_id, 身份值)] 和选将队列, 房间和角色在worker 中重建
+    '''
+    from ..role import Role
+    from ..room import Room
+    room = Room(room_id, collection=collection)
+    role_cycle = [UserRole(user_id, Role(role), room) for user_id, role in seats]
+    return EventCenter(room_id, role_cycle, queue).start()
+
+
 def event_err_handler(e):
     logger = logging.getLogger('event')
     logger.exception('event exception: %s', e)
\ No newline at end of file
@@ -1,37 +1,59 @@
-import random
+import logging
+
 from sgs.cards.region import UserRole
-from utils.fs_template.cards import pick_hero_card
+from utils.fs_template.cards import pick_hero_contents
 from utils.fs_util import send_card, send_msg
 from . import Event
 from ..heros import hero_mgr
+from ..heros.pool import PickAllocator
+from common import conf
 
 
 class GameStartEvent(Event):
     def __init__(self, event_center):
         super().__init__(event_center)
-        self.monarch_pool = random.sample(hero_mgr.monarchs, 3)
-        user_cnt = len(event_center.role_cycle)
-        self.hero_pool = random.sample(hero_mgr.all_heros, user_cnt*3-1)
+        self.allocator = PickAllocator(
+            hero_mgr.pools, len(event_center.role_cycle),
+            seat_size=conf.getint('Room', 'SeatPickSize', fallback=3),
+            lord_monarchs=conf.getint('Room', 'LordMonarchPickSize', fallback=3),
+            lord_heros=conf.getint('Room', 'LordHeroPickSize', fallback=2),
+            bans=conf.get('Room', 'BanHeros', fallback='').split())
 
     def trigger(self):
+        # 所有座位的选将卡片按模板一次渲染好, each 中只发送
+        self.cards = pick_hero_contents(self.event_center.room_id,
+                                        [self.allocator.candidates(pos)
+                                         for pos in range(1, len(self.event_center.role_cycle) + 1)])
         self.event_center.settle_cycle(self)
-        for i in range(len(self.event_center.role_cycle)):
-            self.set_role_hero(*self.event_center.queue.get())
+        picked = {}
+        while len(picked) < len(self.event_center.role_cycle):
+            self.pick_hero(picked, *self.event_center.queue.get())
+        # 所有座位选完后再抓取, 选将期间不阻塞读取队列
+        for pos, ur in enumerate(self.event_center.role_cycle, 1):
+            ur.set_hero(picked[pos].crawl_by_name())
         # TODO: 更新个人消息，展示初始手牌
         # TODO: 更新群消息，展示每个位次的武将
         # TODO: 触发游戏开始时机的技能
 
     def each(self, user_role: UserRole, pos: int):
-        if pos == 1:
-            heros = self.monarch_pool + self.hero_pool[-2:]
-        else:
-            heros = self.hero_pool[(pos-2)*3 : (pos-1)*3]
-        send_card(user_role.user_id, pick_hero_card(self.event_center.room_id, pos, heros), 'open_id')
+        send_card(user_role.user_id, self.cards[pos - 1], 'open_id')
 
-    def set_role_hero(self, user_id, hero):
-        for ur in self.event_center.role_cycle:
+    def pick_hero(self, picked, user_id, hero_id):
+        '''按座位校验选择的武将, 记入picked(座位 -> 武将)
+        不在房间中、已选过或武将不是该座位候选(过期/伪造的卡片)的选择不计入, 提示后继续等待
+        '''
+        for pos, ur in enumerate(self.event_center.role_cycle, 1):
             if ur.user_id == user_id:
-                return ur.set_hero(hero)
+                break
+        else:
+            return
+        if pos in picked:
+            return send_msg(user_id, f'你已选择{picked[pos].uni_name}', 'open_id')
+        try:
+            picked[pos] = self.allocator.resolve(pos, hero_id)
+        except ValueError as e:
+            logging.getLogger('event').warning('room %s: %s', self.event_center.room_id, e)
+            send_msg(user_id, '所选武将不在你的候选中, 请在本局的选将卡片中选择', 'open_id')
 
 
 class GameCycleEvent(Event):
@@ -43,7 +65,7 @@ class GameCycleEvent(Event):
             break
 
     def each(self, user_role: UserRole, pos: int):
-        print(pos, user_role.user_id, user_role.hero_name, user_role.hero_pack)
+        logging.getLogger('event').debug('round %d: %s %s %s', pos, user_role.user_id, user_role.hero_name, user_role.hero_pack)
         GameRoundEvent(self.event_center).trigger()
         self.event_center.cur_idx += 1
 
@@ -1,36 +1,77 @@
 from dataclasses import dataclass, field
 from functools import cached_property
-import json
+import hashlib
+import logging
+import os
 import re
+import threading
+import time
 from typing import List
 
-import mistletoe
-from mistletoe.ast_renderer import get_ast
-
 from .crawler import GeneralBlock, Text, UList
 from .hero import Hero
-from common import root_path, conf
+from common import conf
+from utils import classproperty
+from utils.lazy import LazyProxy, is_resolved, on_resolve
+from utils.metrics import cache_access
+from utils.process_pool import sync_state
+
+
+HEADING_PATTERN = re.compile(r' {0,3}(#{1,6})(?:[ \t]+(.*?))?(?:[ \t]+#+)?[ \t]*$')
+FENCE_PATTERN = re.compile(r' {0,3}(```|~~~)')
+
+def split_sections(lines, valid_heading):
+    '''按行将md 切分为武将段落(从### 标题到下一个不低于三级的标题), 生成(包名, 段落的行列表)
+    只保留标题为valid_heading 的一级类目下的段落, 其他类目只做行匹配, 不会被解析
+    包名下、武将前的内容与武将无关, 同样忽略
+    '''
+    valid = True
+    pack = ''
+    section = None
+    in_fence = False
+    for line in lines:
+        if FENCE_PATTERN.match(line):
+            in_fence = not in_fence
+        elif not in_fence and (m := HEADING_PATTERN.match(line)) and len(m.group(1)) <= 3:
+            if section:
+                yield pack, section
+                section = None
+            match len(m.group(1)):
+                case 1:
+                    valid = m.group(2) == valid_heading
+                case 2 if valid:
+                    pack = m.group(2) or ''
+                case 3 if valid:
+                    section = []
+        if section is not None:
+            section.append(line)
+    if section:
+        yield pack, section
+
 
 @dataclass
 class HeroMgr:
     '''加载武将的md 文件，获取武将全集
     heros: 武将列表
-    level: 当前的md 层级(以header层级为准)
-    cur_pack: 当前武将的所属武将包
-    status: 是否处理当前节点的非正文子节点的状态开关(正文子节点始终遍历)
     line_prefix: 当前的md 列表前缀字符(用以表示当前正文是列表)
+    file_path: 加载的md 文件
+    mtime: 加载时md 文件的修改时间(ns)
+    sections: 武将段落的摘要 -> 该段落解析出的武将列表, 用于增量重新加载
 
     VALID_HEADING: md 中有效的一级节点
     MONARCH_TAG: 判断是否是主公的标识
     HP_PATTERN: md 中的体力值正则
     str_patterns: hero 的字段正则
+    BLOCK_PROCESSORS: 正文块token 类型 -> 处理器 的静态分发表
+
+    mistletoe 在import 时会扫描全部unicode 字符(约200ms), 只在解析时导入
     '''
     heros: List[Hero] = field(default_factory=list)
 
-    level: int = 1
-    cur_pack: str = ''
-    status: bool = True
     line_prefix: str = ''
+    file_path: str = ''
+    mtime: int = 0
+    sections: dict = field(default_factory=dict, repr=False)
 
     VALID_HEADING = '武将牌'
     MONARCH_TAG = '主公技'
@@ -40,76 +81,97 @@ class HeroMgr:
     }
 
     @classmethod
-    def load(cls, file_path):
-        '''加载并解析md 文件
+    def load(cls, file_path, origin=None):
+        '''流式加载并解析md 文件
+        逐行切分出武将段落后逐段解析; 给定origin 时, 内容没有变化的段落直接复用origin 中的武将(保留已抓取的内容)
         '''
         with open(file_path) as fin:
-            doc = mistletoe.Document(fin)
-            struct = get_ast(doc)
-            (root_path / 'page_cache/md.json').write_text(json.dumps(struct, indent=2))
-            mgr = cls()
-            for node in struct['children']:
-                mgr.process_node(node)
-            return mgr
-
-    def pre_process(self, node):
-        '''节点处理的前置拦截
-        遇到同级、高级、未知级别的节点则直接放行(只有header 有level 正文段落是没有level)
-        遇到子节点取决于状态开关
-        '''
-        if node.get('level', self.level+1) <= self.level:
-            return True
-        return self.status or 'level' not in node
-
-    def post_process(self):
-        pass
+            mgr = cls(file_path=file_path, mtime=os.fstat(fin.fileno()).st_mtime_ns)
+            reuse = dict(origin.sections) if origin else {}
+            for pack, lines in split_sections(fin, cls.VALID_HEADING):
+                key = hashlib.blake2b(f'{pack}\n{"".join(lines)}'.encode(), digest_size=16).digest()
+                cache_access('md_section', (heros := reuse.pop(key, None)) is not None)
+                if heros is None:
+                    heros = cls.parse(lines, pack)
+                mgr.sections[key] = heros
+                mgr.heros.extend(heros)
+        return mgr
 
-    def process_node(self, node):
-        '''有level 属于header, 则更新level
-        没有level 属于正文段落, 仅在第一个段落level增一, 然后关掉开关, 避免下个段落再增
+    @classmethod
+    def parse(cls, lines, pack):
+        '''解析pack 包下的一个武将段落, 返回武将列表
+        首个token 是### 武将名标题, 标题不是纯文本的段落不产生武将; 其后的token 都是正文块
+        直接遍历mistletoe 的token, 不再转换为ast dict
         '''
-        if self.pre_process(node):
-            if level := node.get('level', None):
-                self.level = level
-                self.status = True
-            elif self.status:
-                self.level += 1
-                self.status = False
-            getattr(self, f'process_level_{self.level}')(node)
-        self.post_process()
-
-    def process_level_1(self, node):
-        '''处理一级类目节点
+        from mistletoe import Document, span_token
+        mgr = cls()
+        tokens = iter(Document(lines).children)
+        heading = next(tokens)
+        if heading.children and isinstance(child := heading.children[0], span_token.RawText):
+            mgr.heros.append(Hero(pack, child.content))
+            for token in tokens:
+                mgr.process_block(token)
+        return mgr.heros
+
+    def refresh(self):
+        '''md 文件有修改时增量重新加载, 返回是否有更新
+        新的heros/monarchs/all_heros/pools 全部就绪后, 整体替换实例的__dict__, 读者不会看到新旧混合的视图
         '''
-        if node['type'] != 'Heading' or node['children'][0]['content'] != self.VALID_HEADING:
-            self.status = False
+        try:
+            mtime = os.stat(self.file_path).st_mtime_ns
+        except OSError:
+            return False
+        if mtime == self.mtime:
+            return False
+        new = self.load(self.file_path, origin=self)
+        new.monarchs, new.all_heros, new.name_index, new.pools      # 替换前先算好视图
+        if watcher := vars(self).get('_watcher'):
+            vars(new)['_watcher'] = watcher
+        reused = sum(1 for key in new.sections if key in self.sections)
+        self.__dict__ = vars(new)
+        logging.getLogger(__name__).info('reload %s: %d sections, %d reparsed, %d heros',
+                                         self.file_path, len(self.sections),
+                                         len(self.sections) - reused, len(self.heros))
+        return True
 
-    def process_level_2(self, node):
-        '''处理二级包名节点
+    def watch(self, interval=2):
+        '''启动后台线程, 每interval 秒检查一次md 文件并refresh
+        只在主进程中监听, 进程池的worker 在执行任务前按主进程的mtime 同步(见sync_heros)
         '''
-        if node['type'] == 'Heading':
-            self.cur_pack = node['children'][0]['content']
+        if (watcher := vars(self).get('_watcher')) and watcher.is_alive():
+            return
+        def loop():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.refresh()
+                except Exception as e:
+                    logging.getLogger(__name__).error('reload %s failed %s', self.file_path, e, exc_info=True)
+        self._watcher = threading.Thread(target=loop, name='hero_mgr_watcher', daemon=True)
+        self._watcher.start()
 
-    def process_level_3(self, node):
-        '''处理三级武将名节点
+    def __getstate__(self):
+        '''watcher 线程不能pickle
         '''
-        if node['type'] == 'Heading':
-            child = node['children'][0]
-            if child['type'] == 'RawText':
-                self.heros.append(Hero(self.cur_pack, child['content']))
-            else:
-                self.status = False
-
-    def process_level_4(self, node):
-        '''处理四级正文节点，转发给对应节点类型的处理器
+        state = vars(self).copy()
+        state.pop('_watcher', None)
+        return state
+
+    def process_block(self, token):
+        '''正文块处理器, 按token 类型查分发表
         '''
-        getattr(self, f'process_{node["type"]}')(node)
+        try:
+            processor = self.BLOCK_PROCESSORS[type(token)]
+        except KeyError:
+            raise TypeError(type(token).__name__) from None
+        processor(self, token)
 
-    def process_Paragraph(self, node):
+    def process_Paragraph(self, token):
         '''段落节点处理器
         识别段落子节点类型并处理之
         lines 就是hero.content 中的一个段落
         '''
+        from mistletoe import span_token
         cur_strs = []
         lines = []
         def add_to_lines():
@@ -139,32 +201,39 @@ class HeroMgr:
                 else:
                     lines.append(block)
 
-        for cont_node in node['children']:
-            match cont_node['type']:
-                case 'Strong' | 'Emphasis' as t:
-                    cont = Text(cont_node['children'][0]['content'], t)
-                    cur_strs.append(cont)
-                case 'RawText':
-                    cur_strs.append(cont_node['content'])
-                case 'LineBreak':
+        for span in token.children:
+            match span:
+                case span_token.Strong() | span_token.Emphasis():
+                    cur_strs.append(Text(span.children[0].content, type(span).__name__))
+                case span_token.RawText():
+                    cur_strs.append(span.content)
+                case span_token.LineBreak():
                     add_to_lines()
                     cur_strs.clear()
-                case _ as t:
-                    raise TypeError(t)
+                case _:
+                    raise TypeError(type(span).__name__)
         add_to_lines()
         if lines:
             self.heros[-1].contents.append(GeneralBlock('p', UList.list_collect(lines)))
     
-    def process_List(self, node):
+    def process_List(self, token):
         '''处理正文中的list 段落
         将子元素按正文一样处理(用以支持list的嵌套)
         '''
-        for item in node['children']:
-            self.line_prefix = item['leader']
-            for child in item['children']:
-                self.process_node(child)
+        for item in token.children:
+            self.line_prefix = item.leader
+            for child in item.children:
+                self.process_block(child)
             self.line_prefix = ''
 
+    @classproperty(1)
+    def BLOCK_PROCESSORS(cls):
+        from mistletoe import block_token
+        return {
+            block_token.Paragraph: cls.process_Paragraph,
+            block_token.List: cls.process_List,
+        }
+
     # @cached_property
     # def packs(self):
     #     return {hero.pack for hero in self.heroes}
@@ -183,4 +252,41 @@ class HeroMgr:
     def all_heros(self):
         return [hero.uni_name for hero in self.heros]  # if hero.contents
 
-hero_mgr = HeroMgr.load(conf['Local']['MarkDownPath'])
\ No newline at end of file
+    @cached_property
+    def name_index(self):
+        '''武将名 -> 同名武将列表(各武将包)
+        '''
+        index = {}
+        for hero in self.heros:
+            index.setdefault(hero.name, []).append(hero)
+        return index
+
+    @cached_property
+    def pools(self):
+        '''按武将包/势力/主公 的随机选取池
+        '''
+        from .pool import HeroPools
+        return HeroPools(self.heros)
+
+def load_heros():
+    return HeroMgr.load(conf['Local']['MarkDownPath'])
+
+# 首次使用或warm_up 时才解析md
+hero_mgr = LazyProxy(load_heros, 'hero_mgr')
+
+def watch_heros():
+    '''武将加载完成后在主进程中监听md 文件
+    '''
+    on_resolve(hero_mgr, HeroMgr.watch)
+
+def heros_version():
+    return hero_mgr.mtime if is_resolved(hero_mgr) else 0
+
+def sync_heros(mtime):
+    '''worker 执行任务前调用: 主进程已重新加载(mtime 与worker 的不同) 时, worker 随之增量重新加载
+    worker 尚未加载时首次使用会直接读取当前的md
+    '''
+    if mtime and is_resolved(hero_mgr) and hero_mgr.mtime != mtime:
+        hero_mgr.refresh()
+
+sync_state(heros_version, sync_heros)
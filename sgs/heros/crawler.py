@@ -1,34 +1,84 @@
 from abc import ABC, abstractmethod
-from collections import deque
 from collections.abc import Iterator
 from functools import cached_property
-from itertools import tee
 import sys
 import inspect
+import logging
 
 import requests
 from bs4 import BeautifulSoup, NavigableString, Tag
 
 from common import root_path
 from utils import classproperty
+from utils.metrics import cache_access
+from utils.serializer import serializable
+
+from .table_grid import RowView, TableGrid
 
 class Markdown:
     '''支持markdown 格式化的基类
     '''
+    __slots__ = ()
+
     def md_format(self, **kwargs):
         return str(self)
 
+    def __setstate__(self, state):
+        '''兼容实例带__dict__ 时dump 的pickle(state 为dict)
+        '''
+        if isinstance(state, tuple):
+            state = state[1]
+        for name, val in state.items():
+            setattr(self, name, val)
+
+@serializable(1)
 class Text(str, Markdown):
     '''文本类型的基类
-    在构造时, 会根据name决定返回的具体子类
+    在构造时, 会根据name决定返回的具体子类; 没有对应子类的name, 返回以name 命名的轻量子类
+    文本节点数量大, 实例不带__dict__, 标签名__name__ 是类属性(类自身的名字仍是type.__name__)
     '''
+    __slots__ = ()
+    __name__ = ''
+    _named = {}
+
     def __new__(cls, text='', name='', *args, **kwargs):
-        cls = cls.local_subclasses.get(name, cls)
+        if name:
+            cls = cls.local_subclasses.get(name) or cls.named_subclass(name)
         return super().__new__(cls, text)
-    
-    def __init__(self, text='', name='', **kwargs):
-        self.__name__ = name
-        self.attrs = kwargs
+
+    @classmethod
+    def named_subclass(cls, name):
+        '''按(基类, name) 缓存的子类, 只多一个类属性__name__
+        '''
+        key = (cls, name)
+        if key not in cls._named:
+            cls._named[key] = type(cls.__name__, (cls,),
+                                   {'__slots__': (), '__name__': name, '__module__': cls.__module__})
+        return cls._named[key]
+
+    def __reduce__(self):
+        '''动态子类无法按类名pickle, 经由其基类按name 重建
+        '''
+        cls = type(self)
+        if self._named.get((cls.__base__, self.__name__)) is cls:
+            cls = cls.__base__
+        return cls, (str(self), self.__name__), getattr(self, '__dict__', None) or None
+
+    def __setstate__(self, state):
+        '''兼容实例带__dict__ 时dump 的pickle: __name__ 转为对应的子类, 只有Font 保留attrs
+        '''
+        if (name := state.get('__name__')) and name != self.__name__:
+            self.__class__ = type(self).named_subclass(name)
+        if hasattr(self, '__dict__'):
+            self.attrs = state.get('attrs', {})
+
+    def to_record(self):
+        return [str(self), self.__name__, getattr(self, 'attrs', {})]
+
+    @classmethod
+    def from_record(cls, record, version):
+        text, name, attrs = record
+        return cls(text, name, **attrs)
 
     @classproperty(1)
     def local_subclasses(cls) -> dict:
@@ -45,6 +95,9 @@ class Text(str, Markdown):
 class I(Text):
     '''斜体文本
     '''
+    __slots__ = ()
+    __name__ = 'i'
+
     def md_format(self, **kwargs):
         s = super().md_format(**kwargs)
         return f'*{s}*' if s else ''
@@ -52,7 +105,13 @@ class I(Text):
     
 class Font(Text):
     '''带格式的文本
+    保留__dict__ 存放attrs
     '''
+    __name__ = 'font'
+
+    def __init__(self, text='', name='', **attrs):
+        self.attrs = attrs
+
     def md_format(self, **kwargs):
         t = Tag(name=self.__name__, attrs=self.attrs)
         t.append(BeautifulSoup().new_string(super().md_format(**kwargs)))
@@ -62,6 +121,9 @@ class Font(Text):
 class B(Text):
     '''粗体文本
     '''
+    __slots__ = ()
+    __name__ = 'b'
+
     def md_format(self, **kwargs):
         s = super().md_format(**kwargs)
         return f'**{s}**' if s else ''
@@ -70,6 +132,9 @@ class B(Text):
 class Header(Text):
     '''标题文本
     '''
+    __slots__ = ()
+    __name__ = 'header'
+
     def md_format(self, **kwargs):
         level = kwargs.pop('level', 1)
         return '#' * level + ' ' + super().md_format(**kwargs)
@@ -77,11 +142,14 @@ class Header(Text):
 class Caption(Text):
     '''表格标题文本
     '''
-    pass
+    __slots__ = ()
+    __name__ = 'caption'
 
+@serializable(2)
 class Img(Markdown):
     '''img 标签
     '''
+    __slots__ = ('img_src_set', 'data_src', 'alt', 'author')
     DEFAULT_SRC = '1x'
     def __init__(self, tag:Tag|dict, author=None):
         self.img_src_set = {self.DEFAULT_SRC: tag["src"]}
@@ -93,6 +161,15 @@ class Img(Markdown):
         self.alt = tag.get("alt")
         self.author = author
 
+    def to_record(self):
+        return [self.img_src_set, self.data_src, self.alt, self.author]
+
+    @classmethod
+    def from_record(cls, record, version):
+        ins = cls.__new__(cls)
+        ins.img_src_set, ins.data_src, ins.alt, ins.author = record
+        return ins
+
     def img_src(self, src_key=None):
         if src_key is None:
             src_key = self.DEFAULT_SRC
@@ -109,6 +186,7 @@ class Img(Markdown):
         return f'![{self.alt}]({self.img_src(src_key)})'
 
 
+@serializable(3)
 class GeneralBlock(Markdown):
     '''通用块标签
     BLACK_NAMES: 忽略的标签名
@@ -118,6 +196,8 @@ class GeneralBlock(Markdown):
     BLACK_NAMES = {'style', 'script', 'sup', 'rp', 'rt'}
     WHITE_NAMES = {'div', 'p', 'span', 'hr', 'h2', 'h3', 'a', 'ruby', 'rb'}
     BLACK_CLASSES = {'btn', 'desc-color', 'wiki-bot'}
+    __slots__ = ('__name__', 'contents', 'classes')
+
     def __init__(self, name, contents, classes=()):
         if name in self.BLACK_NAMES or self.BLACK_CLASSES.intersection(classes):
             raise KeyError(name + str(classes))
@@ -129,11 +209,10 @@ class GeneralBlock(Markdown):
     def __iter__(self):
         '''可重用迭代contents
         不要直接使用contents 遍历, 因为迭代器或生成器, 无法重复使用
+        首次迭代时将迭代器收集为list(tee 会为每个块常驻一份缓冲)
         '''
         if inspect.isgenerator(self.contents) or isinstance(self.contents, Iterator):
-            a, b = tee(self.contents)
-            self.contents = a
-            return b
+            self.contents = list(self.contents)
         return iter(self.contents)
 
     def __str__(self) -> str:
@@ -143,7 +222,20 @@ class GeneralBlock(Markdown):
         '''pickle.dump 会序列化contents
         '''
         self.contents = list(self.contents)
-        return vars(self)
+        return None, {name: getattr(self, name)
+                      for c in type(self).__mro__ for name in getattr(c, '__slots__', ())
+                      if hasattr(self, name)}
+
+    def to_record(self):
+        return [self.__name__, list(self), self.classes]
+
+    @classmethod
+    def from_record(cls, record, version):
+        name, contents, classes = record
+        ins = cls.empty(name)
+        ins.contents = contents
+        ins.classes = classes
+        return ins
     
     def md_format(self, **kwargs):
         '''使用line_break 将contents 串联起来
@@ -163,14 +255,28 @@ class GeneralBlock(Markdown):
         return ins
 
 
+@serializable(4)
 class UList(GeneralBlock):
     '''无序列表块
     '''
     WHITE_NAMES = {'ul', 'li'}
+    __slots__ = ('leader',)
+
     def __init__(self, name, contents, leader='+'):
         super().__init__(name, contents)
         self.leader = leader
 
+    def to_record(self):
+        return [self.__name__, list(self), self.leader]
+
+    @classmethod
+    def from_record(cls, record, version):
+        name, contents, leader = record
+        ins = cls.empty(name)
+        ins.contents = contents
+        ins.leader = leader
+        return ins
+
     def __str__(self):
         if self.__name__ == 'ul':
             return str(list(self))
@@ -212,75 +318,70 @@ class UList(GeneralBlock):
             yield cls('ul', lis)
 
 
+@serializable(5)
 class Table(GeneralBlock):
     '''table 块内的相关元素
     '''
     WHITE_NAMES = {'table', 'thead', 'tbody', 'tr', 'th', 'td'}
+    __slots__ = ('attrd', 'headers', 'records')
+
     def __init__(self, name, contents, **kwargs):
         classes = kwargs.pop('class', ())
         super().__init__(name, contents, classes)
         self.attrd = kwargs
         if name == 'table':
-            self.headers = []
-            self.records = []
-            self.record = []
-            self.rowspan_cache = deque()
-            self.iter_children(contents)
+            self.iter_children(self)
+
+    def to_record(self):
+        return [self.__name__, list(self), self.classes, self.attrd]
+
+    @classmethod
+    def from_record(cls, record, version):
+        '''table 不保存headers/records, 由contents 重新收集
+        '''
+        name, contents, classes, attrd = record
+        ins = cls.empty(name)
+        ins.contents = contents
+        ins.classes = classes
+        ins.attrd = attrd
+        if name == 'table':
+            ins.iter_children(contents)
+        return ins
 
     def iter_children(self, children):
         '''将单元格每一格th 和 td 的内容放入headers 和 records
         only table tag to run
-        支持rowspan和colspan(缓存内容实例, 并放到span的每一个位置)
-        not_consumed_cache 是为了解决tr 标签中没有内容的问题(前面的行中rowspan比较多)
+        rowspan和colspan 交给TableGrid 一次展开(单元格实例放到span的每一个位置)
         '''
-        col_idx = 0
-        not_consumed_cache = True
+        grid = TableGrid()
+        self._collect_rows(children, grid)
+        self.headers = grid.headers
+        self.records = grid.rows
+
+    @classmethod
+    def _collect_rows(cls, children, grid):
         for cont in children:
             match cont:
-                case Table(__name__='thead') | Table(__name__='tbody') | Table(__name__='tr'):
-                    if self.record:
-                        self.records.append(self.record)
-                        self.record = []
-                        col_idx = 0
-                    if self.iter_children(cont) and self.rowspan_cache:
-                        for rc in self.rowspan_cache:
-                            rc.cache_cnt -= 1
-                        self.rowspan_cache = deque(rc for rc in self.rowspan_cache if rc.cache_cnt)
-                case Table(__name__='th'):
-                    if (colspan := int(cont.attrd.get('colspan', 1))) > 1:
-                        self.headers.extend([cont]*colspan)
-                    else:
-                        self.headers.append(cont)
-                case Table(__name__='td'):
-                    not_consumed_cache = False
-                    col_idx = self._add_rowspan_cols(col_idx)
-                    if cache_cnt := (int(cont.attrd.get('rowspan', 1)) - 1):
-                        cont.cache_cnt = cache_cnt
-                        cont.idx = col_idx
-                        self.rowspan_cache.append(cont)
-                    colspan = int(cont.attrd.get('colspan', 1))
-                    if colspan > 1:
-                        self.record.extend([cont]*colspan)
-                    else:
-                        self.record.append(cont)
-                    col_idx = self._add_rowspan_cols(col_idx + colspan)
-        if self.record:
-            self.records.append(self.record)
-            self.record = []
-        return not_consumed_cache
-
-    def _add_rowspan_cols(self, col_idx):
-        '''应用rowspan 缓存, 左侧队列头, 右侧队列尾
+                case Table(__name__='thead') | Table(__name__='tbody'):
+                    cls._collect_rows(cont, grid)
+                case Table(__name__='tr'):
+                    cells = []
+                    for cell in cont:
+                        match cell:
+                            case Table(__name__='th'):
+                                grid.add_header(cell, int(cell.attrd.get('colspan', 1)))
+                            case Table(__name__='td'):
+                                cells.append((cell, int(cell.attrd.get('rowspan', 1)),
+                                              int(cell.attrd.get('colspan', 1))))
+                    grid.add_row(cells)
+
+    def select(self, cols=None, where=None):
+        '''按where 过滤records, 按cols 中的列号投影, 返回RowView 的生成器(不复制行)
+        cols 为None 时保留整行
         '''
-        while self.rowspan_cache and (top := self.rowspan_cache[0]).idx == col_idx:
-            self.record.append(top)
-            if top.cache_cnt > 1:
-                top.cache_cnt -= 1
-                self.rowspan_cache.rotate(-1)
-            else:
-                self.rowspan_cache.popleft()
-            col_idx += 1
-        return col_idx
+        for row in self.records:
+            if where is None or where(row):
+                yield RowView(row, range(len(row)) if cols is None else cols)
 
     @classmethod
     def empty(cls, name):
@@ -288,27 +389,33 @@ class Table(GeneralBlock):
         当内容填充完毕后, 手动调用iter_children
         '''
         ins = super().empty(name)
+        ins.attrd = {}
         if name == 'table':
             ins.headers = []
             ins.records = []
-            ins.record = []
-            ins.rowspan_cache = deque()
         return ins
 
 html_parser = 'html.parser'
+request_timeout = 8
 
-def crawl(name, ver='sgs'):
-    '''biligame 抓取器, 并做页面缓存
-    通过recur_node 将关注的tag 转换为内部类型的生成器
+def bili_fetch(name, ver='sgs') -> BeautifulSoup:
+    '''biligame 页面获取, 并做页面缓存
     '''
     f = root_path / f'page_cache/biligame/{ver}/{name}.html'
-    if f.is_file():
-        bs = BeautifulSoup(f.read_text(), html_parser)
-    else:
-        resp = requests.get(f'https://wiki.biligame.com/{ver}/{name}')
-        resp.raise_for_status()
-        bs = BeautifulSoup(resp.text, html_parser)
-        f.write_text(bs.prettify())
+    cache_access('page_biligame', hit := f.is_file())
+    if hit:
+        return BeautifulSoup(f.read_text(), html_parser)
+    resp = requests.get(f'https://wiki.biligame.com/{ver}/{name}', timeout=request_timeout)
+    resp.raise_for_status()
+    bs = BeautifulSoup(resp.text, html_parser)
+    f.write_text(bs.prettify())
+    return bs
+
+
+def crawl(bs: BeautifulSoup):
+    '''biligame 抓取器
+    通过recur_node 将关注的tag 转换为内部类型的生成器
+    '''
     yield from recur_node(bs.find('div', id='mw-content-text').div.find('div', class_='col-direction'))
 
 
@@ -338,15 +445,15 @@ def recur_node(node:Tag):
                 try:
                     yield GeneralBlock(block.name, recur_node(block), block.get('class', ()))
                 except KeyError as e:
-                    print(f'skip block {e}')
+                    logging.getLogger(__name__).debug('skip block %s', e)
 
 
-def baike_crawl(name):
-    '''baidu baike 抓取器, 并做页面缓存(缓存的是三国杀武将页，而不是默认人物页)
-    依次生成基本信息(dict)、锚点头(Header)、锚点体(table)
+def baike_fetch(name) -> BeautifulSoup:
+    '''baidu baike 页面获取, 并做页面缓存(缓存的是三国杀武将页，而不是默认人物页)
     '''
     f = root_path / f'page_cache/baidu_baike/{name}.html'
-    if f.is_file():
+    cache_access('page_baidu_baike', hit := f.is_file())
+    if hit:
         bs = BeautifulSoup(f.read_text(), html_parser)
     else:
         host = 'https://baike.baidu.com'
@@ -355,9 +462,9 @@ def baike_crawl(name):
             'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.7',
             # 'Cookie': ''
         }
-        resp = requests.get(f'{host}/item/{name}', headers=headers)
+        resp = requests.get(f'{host}/item/{name}', headers=headers, timeout=request_timeout)
         resp.raise_for_status()
-        print(resp.encoding)
+        logging.getLogger(__name__).debug('baike %s encoding %s', name, resp.encoding)
         bs = BeautifulSoup(resp.text, html_parser)
         ulist = bs.find('ul', class_='polysemantList-wrapper')
         cond = lambda c: c and '三国杀' in c and '武将牌' in c
@@ -366,10 +473,17 @@ def baike_crawl(name):
         else:
             a = bs.find('a', string=cond)
         if a:
-            resp = requests.get(f'{host}{a["href"]}', headers=headers)
+            resp = requests.get(f'{host}{a["href"]}', headers=headers, timeout=request_timeout)
             resp.raise_for_status()
             bs = BeautifulSoup(resp.text, html_parser)
         f.write_text(bs.prettify())
+    return bs
+
+
+def baike_crawl(bs: BeautifulSoup):
+    '''baidu baike 抓取器
+    依次生成基本信息(dict)、锚点头(Header)、锚点体(table)
+    '''
     yield baike_basic_info(bs.find('div', class_=('basic-info', 'J-basic-info')))
     baike_anchor:BaikeAnchor = BaikeAnchor.detect_anchor(bs)
     while baike_anchor and (header := baike_anchor.get_title_block()):
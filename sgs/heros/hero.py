@@ -1,13 +1,14 @@
 from enum import Enum
 from dataclasses import dataclass, field, fields
 from functools import cached_property
-import glob
 import pickle
 from typing import List, Optional
 
 from .crawler import GeneralBlock, Img
 from . import parser
+from .store import HeroStore
 from utils import classproperty
+from utils.serializer import serializable
 from common import conf
 
 class Camp(Enum):
@@ -37,6 +38,7 @@ def hero_parsers(name, bases, attrd):
     return type(name, bases+tuple(valid_parsers), attrd)
 
 
+@serializable(10)
 @dataclass
 class Hero(metaclass=hero_parsers):
     '''武将模型
@@ -67,19 +69,22 @@ class Hero(metaclass=hero_parsers):
         
     def crawl_by_name(self):
         '''使用parser 进行抓取解析
+        有新的抓取结果时, 清除渲染缓存card_cache, 并重新解析体力值
         '''
-        if isinstance(self, parser.Parser):
-            self.crawl_parse(self.name)
+        if isinstance(self, parser.Parser) and self.crawl_parse(self.name):
+            self.__dict__.pop('card_cache', None)
+            self.resolve_hp()
         return self
-    
-    def __getattribute__(self, name):
-        mapper = {
-            'hp': min, 'hp_max': max,
-        }
-        v = super().__getattribute__(name)
-        if name in mapper and v == 0 and isinstance(self, parser.Parser):
-            return mapper[name](self.hps)
-        return v
+
+    def resolve_hp(self):
+        '''md 中没有体力值时, 用parser 抓取到的非零体力值兜底(hp 取最小, hp_max 取最大)
+        只在抓取后解析一次, 不再在每次属性访问时计算
+        '''
+        if hps := [hp for hp in self.hps if hp]:
+            if not self.hp:
+                self.hp = min(hps)
+            if not self.hp_max:
+                self.hp_max = max(hps)
 
     def __getattr__(self, name):
         '''当没有继承parser, 而又需要访问其抽象属性, 提供兜底返回
@@ -119,29 +124,51 @@ class Hero(metaclass=hero_parsers):
         return f'{self.name}@{self.pack}'
     
     def __getstate__(self):
-        '''cached_property 是个mapping_proxy 无法dump 所以需要先移除
+        '''渲染缓存card_cache 无需dump
         '''
-        d = self.__dict__
-        if isinstance(self, parser.Parser):
-            d = d.copy()
-            if 'alias_mapper' in d:
-                del d['alias_mapper']
-            if 'hps' in d:
-                del d['hps']
+        d = self.__dict__.copy()
+        d.pop('card_cache', None)
         return d
 
+    def __setstate__(self, state):
+        '''早期dump 的武将没有解析过体力值
+        '''
+        self.__dict__.update(state)
+        if isinstance(self, parser.Parser):
+            self.resolve_hp()
+
+    def to_record(self):
+        '''按字段名保存, 字段增减不影响旧数据加载
+        '''
+        d = vars(self)
+        record = {fd.name: d[fd.name] for fd in fields(self) if fd.name in d}
+        record['camp'] = self.camp.value
+        return record
+
+    @classmethod
+    def from_record(cls, record, version):
+        hero = cls(record.pop('pack'), record.pop('name'))
+        record['camp'] = Camp(record.get('camp', Camp.UNKNOWN.value))
+        for fd in fields(cls):
+            if fd.name in record:
+                setattr(hero, fd.name, record[fd.name])
+        if isinstance(hero, parser.Parser):
+            hero.resolve_hp()
+        return hero
+
     def dump(self, file_path: str):
-        if not file_path.endswith('.pickle'):
-            file_path += self.uni_name + '.pickle'
-        with open(file_path, 'wb') as wf:
-            pickle.dump(self, wf)
+        '''file_path 是.pickle 文件则单独dump, 否则写入该目录下的HeroStore
+        '''
+        if file_path.endswith('.pickle'):
+            with open(file_path, 'wb') as wf:
+                pickle.dump(self, wf)
+        else:
+            HeroStore.open(file_path).put(self)
 
     @staticmethod
     def load(file_path, name, pack=None):
-        filename = ('',)
-        if not file_path.endswith('.pickle'):
-            filename = (f'{name}@{pack}.pickle',) if pack else \
-                glob.iglob(name + '@*.pickle', root_dir=file_path)
-        for fn in filename:
-            with open(file_path + fn, 'rb') as rf:
-                yield pickle.load(rf)
\ No newline at end of file
+        if file_path.endswith('.pickle'):
+            with open(file_path, 'rb') as rf:
+                yield pickle.load(rf)
+        else:
+            yield from HeroStore.open(file_path).load(name, pack)
@@ -1,22 +1,112 @@
 from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
 from contextlib import contextmanager
 from dataclasses import Field, dataclass, field, fields
-from functools import cached_property
 import logging
+import os
+import time
 from typing import List, _GenericAlias, _SpecialGenericAlias
 
-from utils import classproperty
+from utils import classproperty, metrics
 
-from .crawler import B, UList, crawl, baike_crawl, Img, GeneralBlock, Text, Table, Header, Caption
+from .crawler import B, UList, bili_fetch, crawl, baike_fetch, request_timeout, baike_crawl, Img, GeneralBlock, Text, Table, Header, Caption
 
 def both_in_or_not(s, a, b):
     if isinstance(s, (list, tuple)):
         return all(both_in_or_not(ss, a, b) for ss in s)
     return (s in a) == (s in b)
 
+
+CRAWL_LATENCY = metrics.histogram('sgs_crawl_seconds', '武将各站点的抓取(fetch)/解析(parse) 耗时', ('site', 'phase'))
+CRAWL_FAILURES = metrics.counter('sgs_crawl_failures_total', '武将抓取失败次数', ('site', 'reason'))
+
+def timed(timer, func, *args):
+    with timer:
+        return func(*args)
+
+
+def fetch_executor() -> ThreadPoolExecutor:
+    '''各parser 抓取阶段共享的线程池
+    导入时创建(线程在提交任务时才启动), 线程不能跨fork, 子进程中重新创建
+    '''
+    return _fetch_executor
+
+def _reset_fetch_executor():
+    global _fetch_executor
+    _fetch_executor = ThreadPoolExecutor(thread_name_prefix='hero_fetch')
+
+_reset_fetch_executor()
+os.register_at_fork(after_in_child=_reset_fetch_executor)
+
+
+class AliasMapper(dict):
+    '''别名到field 的映射, 附带按包含关系编译的匹配表
+    roots: 不包含其他别名的别名(如 技能、模式)
+    supers: 别名 -> 包含它的更长别名(如 技能 -> 技能名称、技能描述...)
+    行中不含某个root 时, 包含它的别名也必然不在行中, 因此大多数行只需检查roots
+    '''
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.order = {alias: i for i, alias in enumerate(self)}
+        self.supers = {alias: [s for s in self if s != alias and alias in s] for alias in self}
+        self.roots = [alias for alias in self if not any(a != alias and a in alias for a in self)]
+
+    def match(self, line):
+        '''返回line 中包含的映射顺序最靠前的(别名, field), 没有则返回None
+        与按映射顺序逐个判断子串的结果一致
+        '''
+        order = self.order
+        best = None
+        for alias in self.roots:
+            if alias in line:
+                for s in self.supers[alias]:
+                    if s in line and (best is None or order[s] < order[best]):
+                        best = s
+                if best is None or order[alias] < order[best]:
+                    best = alias
+        if best is not None:
+            return best, self[best]
+
+
 class Parser(ABC):
+    '''fetch_timeout: 抓取阶段的超时秒数, 超时则本次跳过该parser; 按fetch 中依次发出的请求数 * request_timeout 再留出余量
+    '''
+    fetch_timeout = request_timeout + 2
+
     @abstractmethod
-    def crawl_parse(self, name): ...
+    def fetch(self, name):
+        '''抓取阶段(IO), 与其他parser 并发执行, 不要修改self
+        返回交给parse 的页面, 无需抓取(已解析过)返回None
+        '''
+    @abstractmethod
+    def parse(self, name, page) -> bool:
+        '''解析阶段, 按MRO 顺序串行执行, 返回是否有新的抓取结果
+        '''
+
+    def crawl_parse(self, name) -> bool:
+        '''并发执行各parser 的fetch, 再按MRO 顺序依次parse, 保证合并结果确定
+        单个parser 的fetch 失败或超时只跳过该parser(超时的页面缓存仍由后台线程写完, 下次命中)
+        返回是否有新的抓取结果
+        '''
+        start = time.monotonic()
+        futures = [(p, fetch_executor().submit(timed, CRAWL_LATENCY.time(p.__name__, 'fetch'), p.fetch, self, name))
+                   for p in type(self).__mro__ if p in Parser.__subclasses__()]
+        parsed = False
+        for p, future in futures:
+            try:
+                page = future.result(max(0, start + p.fetch_timeout - time.monotonic()))
+            except FutureTimeout:
+                logging.getLogger(__name__).warning('%s fetch %s timeout', p.__name__, name)
+                CRAWL_FAILURES.labels(p.__name__, 'timeout').inc()
+                continue
+            except Exception as e:
+                logging.getLogger(__name__).error('%s fetch %s failed %s', p.__name__, name, e, exc_info=True)
+                CRAWL_FAILURES.labels(p.__name__, 'error').inc()
+                continue
+            if page is not None:
+                with CRAWL_LATENCY.time(p.__name__, 'parse'):
+                    parsed = p.parse(self, name, page) or parsed
+        return parsed
     @property
     @abstractmethod
     def skills(self): yield
@@ -29,18 +119,19 @@ class Parser(ABC):
     @abstractmethod
     def get_pack(self) -> str: ...
 
-    @cached_property
-    def alias_mapper(self):
+    @classproperty(1)
+    def alias_mapper(cls) -> AliasMapper:
         '''别名到field 的映射, 支持多个别名
+        每个类各自只构建一次, 该类的实例共享
         '''
         d = {}
-        for fd in fields(self):
+        for fd in fields(cls):
             if alias := fd.metadata.get('alias'):
                 if isinstance(alias, tuple):
                     d.update({alias_item:fd for alias_item in alias})
                 else:
                     d[alias] = fd
-        return d
+        return AliasMapper(d)
     
     def set_field(self, fd:Field, val):
         '''field 赋值器, 支持值转换函数
@@ -56,13 +147,15 @@ class Parser(ABC):
         else:
             setattr(self, fd.name, val)
 
-    @cached_property
+    @classproperty(1)
+    def hp_fields(cls):
+        '''各parser 的体力字段名
+        '''
+        return [fd.name for fd in fields(cls) if fd.name.endswith('_hp')]
+
+    @property
     def hps(self):
-        return [
-            fv for sub_p in Parser.__subclasses__()
-            for fname in vars(sub_p)
-            if fname.endswith('_hp') and isinstance(fv := getattr(self, fname), int)
-        ]
+        return [fv for fname in self.hp_fields if isinstance(fv := getattr(self, fname), int)]
 
 
 @dataclass(init=False, eq=False, match_args=False)
@@ -81,6 +174,7 @@ class BaiduBaikeParser(Parser):
     baike_image_ver: str = field(default='', init=False, metadata={'md_key': ''})
 
     name = '百度百科'
+    fetch_timeout = 2 * request_timeout + 2    # 默认词条页 + 三国杀武将牌义项页
 
     @property
     def skills(self):
@@ -119,63 +213,67 @@ class BaiduBaikeParser(Parser):
                 for key_type, key_tuple in keys.items()
                 for key in key_tuple}
 
-    def crawl_parse(self, name):
+    def fetch(self, name):
+        '''通过baike_skill_names 做幂等
+        '''
+        if self.baike_key != 'none' and not self.baike_skill_names:
+            return baike_fetch(self.baike_key if self.baike_key else name)
+
+    def parse(self, name, page):
         '''处理baike_crawl 抓取的每个节点, 分成两步:
         1. 处理基本信息 & 做模块映射(module_name -> module table)
         2. 逐模块(table)处理: 通过版本指示来决定生效行
-
-        通过baike_skill_names 做幂等
         '''
-        if self.baike_key != 'none' and not self.baike_skill_names:
-            self.sub_mod_name = ''
-            self.sub_module = {}
-            # fill sub_module
-            for node in baike_crawl(self.baike_key if self.baike_key else name):
-                if node:
-                    match node:
-                        case dict():
-                            self.parse_basic_info(node)
-                        case Header(t) | Caption(t):
-                            self.new_sub_mod(t)
-                        case Table() if self.sub_mod_name in self.sub_module:
-                            self.sub_module[self.sub_mod_name].contents.append(node)
-            self.new_sub_mod('')
-            # consume sub_module
-            for mod_name, table in self.sub_module.items():
-                if (f_verkey := self.module_parsers.get(mod_name)) and table.records:
-                    f, ver_key = f_verkey
-                    if getattr(self, ver_key) == 'none':
-                        continue
-                    headers = [str(h) for h in table.headers] if table.headers else ()
-                    len_header = len(headers)
-                    if ver_key != 'baike_skill_ver':
-                        remove_col_idx = [i for i, h in enumerate(headers) if '技能' in h]
-                        for i in remove_col_idx:
-                            headers.pop(i)
-                    self.remove_keys_prefix(headers)
-                    ver = getattr(self, ver_key)
-                    if ver:
-                        try:
-                            ver_col_idx = headers.index('扩展包')
-                        except ValueError:
-                            ver_col_idx = 0
-                        vers = ver.split('|')
-                        if headers:
-                            headers = headers[ver_col_idx+len(vers):]
-                    for record in table.records:
-                        if len_header:
-                            assert len(record) == len_header
-                        if not ver or all(ver in (record_ver := str(record[ver_col_idx+i])) and \
-                                       both_in_or_not(('国战', '界'), ver, record_ver) for i, ver in enumerate(vers)):
-                            if ver_key != 'baike_skill_ver':
-                                for i in remove_col_idx:
-                                    record.pop(i)
-                            if ver:
-                                record = record[ver_col_idx+len(vers):]
-                            # f(headers, cols)(self)
-                            f(self, headers, record)
-            del self.sub_mod_name, self.sub_module
-        return super().crawl_parse(name)
+        self.sub_mod_name = ''
+        self.sub_module = {}
+        # fill sub_module
+        for node in baike_crawl(page):
+            if node:
+                match node:
+                    case dict():
+                        self.parse_basic_info(node)
+                    case Header(t) | Caption(t):
+                        self.new_sub_mod(t)
+                    case Table() if self.sub_mod_name in self.sub_module:
+                        self.sub_module[self.sub_mod_name].contents.append(node)
+        self.new_sub_mod('')
+        # consume sub_module
+        for mod_name, table in self.sub_module.items():
+            if (f_verkey := self.module_parsers.get(mod_name)) and table.records:
+                f, ver_key = f_verkey
+                if getattr(self, ver_key) == 'none':
+                    continue
+                headers = [str(h) for h in table.headers]
+                len_header = len(headers)
+                # 列投影: 非技能模块去掉技能列, 再去掉版本列及其左侧的列
+                cols = [i for i, h in enumerate(headers)
+                        if ver_key == 'baike_skill_ver' or '技能' not in h]
+                headers = [headers[i] for i in cols]
+                self.remove_keys_prefix(headers)
+                ver = getattr(self, ver_key)
+                if ver:
+                    try:
+                        ver_col_idx = headers.index('扩展包')
+                    except ValueError:
+                        ver_col_idx = 0
+                    vers = ver.split('|')
+                    start = ver_col_idx + len(vers)
+                    ver_cols = cols[ver_col_idx:start] if len_header else range(ver_col_idx, start)
+                    headers = headers[start:]
+                    cols = cols[start:]
+                else:
+                    start = 0
+                def hit(record):
+                    if len_header:
+                        assert len(record) == len_header
+                    return not ver or all(ver in (record_ver := str(record[c])) and \
+                                          both_in_or_not(('国战', '界'), ver, record_ver)
+                                          for c, ver in zip(ver_cols, vers))
+                for record in table.select(cols if len_header else None, hit):
+                    # f(headers, cols)(self)
+                    f(self, headers, record if len_header else record[start:])
+        del self.sub_mod_name, self.sub_module
+        return True
     
     @staticmethod
     def remove_keys_prefix(headers):
@@ -261,8 +359,7 @@ class BaiduBaikeParser(Parser):
         '''皮肤模块table 处理器
         TODO: Implement
         '''
-        print(f'image header len: {len(headers)} {headers}')
-        print(f'\trecord len: {len(cols)}')
+        logging.getLogger(__name__).debug('image header len: %d %s, record len: %d', len(headers), headers, len(cols))
 
 
 @dataclass(init=False, eq=False, match_args=False)
@@ -317,25 +414,28 @@ class BiligameParser(Parser):
             secs.append(UList('li', sec))
         return UList('ul', secs)
 
-    def crawl_parse(self, name):
+    def fetch(self, name):
+        '''通过biligame_pack做幂等
+        '''
+        if not self.biligame_pack and self.biligame_key != 'none':
+            return bili_fetch(self.biligame_key if self.biligame_key else name, self.biligame_ver)
+
+    def parse(self, name, page):
         '''先解析表头, 再解析指定版本的表体
         缓存是否已解析过表头, 避免重复调用parse_header
-
-        通过biligame_pack做幂等
         '''
-        if not self.biligame_pack and self.biligame_key != 'none':
-            not_p_header = True
-            try:
-                for line in crawl(self.biligame_key if self.biligame_key else name, self.biligame_ver):
-                    if line and isinstance(line, GeneralBlock):
-                        if not_p_header:
-                            not_p_header = self.parse_header(line)
-                        elif not self.parse_module(line):
-                            break
-            except Exception as e:
-                logger = logging.getLogger('biligameCrawler')
-                logger.error('crawl biligame failed %s', e, exc_info=True, stack_info=True)
-        return super().crawl_parse(name)
+        not_p_header = True
+        try:
+            for line in crawl(page):
+                if line and isinstance(line, GeneralBlock):
+                    if not_p_header:
+                        not_p_header = self.parse_header(line)
+                    elif not self.parse_module(line):
+                        break
+        except Exception as e:
+            logger = logging.getLogger('biligameCrawler')
+            logger.error('crawl biligame failed %s', e, exc_info=True, stack_info=True)
+        return True
     
     def clear_alias_key(self):
         del self.key, self.hit_alias, self.anchor
@@ -358,14 +458,13 @@ class BiligameParser(Parser):
                     setattr(self, fd.name, sline)
                     self.clear_alias_key()
             case _:
-                for alias, fd in self.alias_mapper.items():
-                    if alias in sline:
-                        self.key = fd
-                        self.hit_alias = sline
-                        self.anchor = Anchor(fd.metadata.get('anchor_num', -1),
-                                             getattr(self, fd.name),
-                                             fd.metadata.get('sections'))
-                        break
+                if hit := self.alias_mapper.match(sline):
+                    fd = hit[1]
+                    self.key = fd
+                    self.hit_alias = sline
+                    self.anchor = Anchor(fd.metadata.get('anchor_num', -1),
+                                         getattr(self, fd.name),
+                                         fd.metadata.get('sections'))
 
     def parse_header(self, headers):
         '''解析表头
@@ -0,0 +1,175 @@
+from array import array
+import random
+
+from .hero import Camp
+from utils.metrics import cache_access
+
+
+class HeroPools:
+    '''预先计算的武将随机选取池
+    池中存放武将在heros 中的下标(hero id), 用array 紧凑存放, 抽取时按下标随机, 不构造临时列表
+    heros: 建池时的武将列表, hero id 只对这份列表有效
+    all: 全部武将
+    packs: 武将包 -> 池
+    camps: 势力 -> 池
+    monarchs: 主公池(同名武将只保留第一个)
+    ids: uni_name -> hero id
+    names: 武将名 -> 同名武将的hero id
+
+    MONARCH_COND: 过滤条件中表示主公池的关键字
+    CAMP_CONDS: 过滤条件中表示势力的关键字(与势力名完全相同, 如 群英 仍按武将包匹配)
+    '''
+    MONARCH_COND = '主公'
+    CAMP_CONDS = {camp.value: camp for camp in Camp if camp is not Camp.UNKNOWN}
+
+    def __init__(self, heros):
+        self.heros = heros
+        self.all = array('I', range(len(heros)))
+        self.packs = {}
+        self.camps = {}
+        self.monarchs = array('I')
+        self.ids = {}
+        self.names = {}
+        monarch_names = set()
+        for hid, hero in enumerate(heros):
+            self.ids[hero.uni_name] = hid
+            self.names.setdefault(hero.name, array('I')).append(hid)
+            self.packs.setdefault(hero.pack, array('I')).append(hid)
+            self.camps.setdefault(hero.camp, array('I')).append(hid)
+            if hero.is_monarch and hero.name not in monarch_names:
+                monarch_names.add(hero.name)
+                self.monarchs.append(hid)
+        self._filtered = {}
+
+    def filter(self, *conds):
+        '''按条件过滤出的池, 结果按条件集合缓存
+        每个条件匹配主公、势力(与势力名完全相同, 如 魏)或武将包(子串匹配, 同HeroMgr.search); 同类条件取并集, 不同类取交集
+        '''
+        key = frozenset(conds)
+        if not key:
+            return self.all
+        cache_access('hero_pool_filter', (pool := self._filtered.get(key)) is not None)
+        if pool is None:
+            selected = None
+            for ids in self._cond_sets(key):
+                selected = ids if selected is None else selected & ids
+            self._filtered[key] = pool = array('I', sorted(selected))
+        return pool
+
+    def _cond_sets(self, conds):
+        camps = set()
+        packs = []
+        for cond in conds:
+            if cond == self.MONARCH_COND:
+                yield set(self.monarchs)
+            elif (camp := self.CAMP_CONDS.get(cond)) is not None:
+                camps.add(camp)
+            else:
+                packs.append(cond)
+        if camps:
+            yield {hid for camp in camps for hid in self.camps.get(camp, ())}
+        if packs:
+            yield {hid for pack, ids in self.packs.items() if any(p in pack for p in packs) for hid in ids}
+
+    @staticmethod
+    def draw(pool, k, taken=None, group=None):
+        '''从pool 中不放回地随机取k 个hero id
+        taken: 已被取走的id 集合(如同一房间), 会跳过并把本次取到的id 加进去
+        group: hero id -> 与之互斥的id 序列(如同名武将), 取到一个后整组标记为已取
+        taken 相对pool 很小时拒绝采样期望O(k), 连续拒绝过多才退化为过滤剩余的id
+        '''
+        if taken is None:
+            return [pool[i] for i in random.sample(range(len(pool)), k)]
+        picked = []
+        def take(hid):
+            picked.append(hid)
+            if group:
+                taken.update(group(hid))
+            else:
+                taken.add(hid)
+        rejects = 0
+        while pool and len(picked) < k and rejects <= k:
+            hid = pool[random.randrange(len(pool))]
+            if hid in taken:
+                rejects += 1
+            else:
+                take(hid)
+        if len(picked) < k:
+            rest = [hid for hid in pool if hid not in taken]
+            random.shuffle(rest)
+            for hid in rest:
+                if len(picked) == k:
+                    break
+                if hid not in taken:
+                    take(hid)
+            if len(picked) < k:
+                raise ValueError('Sample larger than population')
+        return picked
+
+    def same_name(self, hid):
+        return self.names[self.heros[hid].name]
+
+    def sample(self, k, *conds):
+        '''过滤后随机取k 个武将
+        '''
+        return [self.heros[hid] for hid in self.draw(self.filter(*conds), k)]
+
+    def room_draw(self):
+        return RoomDraw(self)
+
+
+class RoomDraw:
+    '''一个房间内的不放回抽取, 房间内各次抽取的武将不重复(同名武将也只会出现一个)
+    '''
+    def __init__(self, pools: HeroPools):
+        self.pools = pools
+        self.taken = set()
+
+    def ban(self, bans):
+        '''bans: uni_name 或武将名, 武将名会禁用所有同名武将
+        '''
+        pools = self.pools
+        for ban in bans:
+            if (hid := pools.ids.get(ban)) is not None:
+                self.taken.add(hid)
+            self.taken.update(pools.names.get(ban, ()))
+
+    def draw(self, k, *conds):
+        '''返回hero id 列表
+        '''
+        return self.pools.draw(self.pools.filter(*conds), k, self.taken, self.pools.same_name)
+
+    def draw_monarchs(self, k):
+        return self.draw(k, self.pools.MONARCH_COND)
+
+    def heros(self, ids):
+        return [self.pools.heros[hid] for hid in ids]
+
+
+class PickAllocator:
+    '''房间的选将池分配
+    为每个座位一次性分配互不相交的候选武将(hero id), 选将时按(座位, hero id) O(1) 校验并取回武将
+    seats: 座位(1号位为主公)的候选hero id 列表
+    owner: hero id -> 座位号
+    '''
+    def __init__(self, pools: HeroPools, seat_cnt, seat_size=3, lord_monarchs=3, lord_heros=2, bans=()):
+        '''seat_size: 非主公座位的候选数
+        lord_monarchs, lord_heros: 主公座位的主公候选数和普通候选数
+        bans: 禁用的uni_name 或武将名
+        '''
+        self.pools = pools
+        room = pools.room_draw()
+        room.ban(bans)
+        self.seats = [room.draw_monarchs(lord_monarchs) + room.draw(lord_heros)]
+        self.seats.extend(room.draw(seat_size) for _ in range(seat_cnt - 1))
+        self.owner = {hid: pos for pos, ids in enumerate(self.seats, 1) for hid in ids}
+
+    def candidates(self, pos):
+        '''返回(hero id, uni_name) 列表
+        '''
+        return [(hid, self.pools.heros[hid].uni_name) for hid in self.seats[pos-1]]
+
+    def resolve(self, pos, hero_id):
+        if self.owner.get(hero_id) != pos:
+            raise ValueError(f'hero {hero_id} is not a candidate of seat {pos}')
+        return self.pools.heros[hero_id]
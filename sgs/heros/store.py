@@ -0,0 +1,113 @@
+import glob
+import os
+import pickle
+import sqlite3
+import threading
+
+from utils import serializer
+
+
+class HeroStore:
+    '''单文件的武将存储(sqlite), 取代每个武将一个pickle 文件
+    uni_name 唯一索引, 支持按uni_name 直接加载, 按武将名前缀列出
+    开启mmap 读, 使进程池中的各个worker 共享同一份page cache
+
+    STORE_NAME: 给定目录时, 目录下使用的库文件名
+    MMAP_SIZE: mmap 映射的最大字节数
+    '''
+    STORE_NAME = 'heros.db'
+    MMAP_SIZE = 1 << 28
+    _stores = {}
+
+    def __init__(self, file_path: str):
+        if not file_path.endswith('.db'):
+            file_path = os.path.join(file_path, self.STORE_NAME)
+        self.file_path = file_path
+        self._local = threading.local()
+
+    @classmethod
+    def open(cls, file_path: str):
+        '''同一路径复用同一个store 实例
+        '''
+        if file_path not in cls._stores:
+            cls._stores[file_path] = cls(file_path)
+        return cls._stores[file_path]
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        '''sqlite 连接不能跨线程和fork 使用, 按(进程, 线程)惰性建立
+        '''
+        local = self._local
+        if getattr(local, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(self.file_path, isolation_level=None)
+            conn.execute(f'PRAGMA mmap_size={self.MMAP_SIZE}')
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('''CREATE TABLE IF NOT EXISTS hero (
+                uni_name TEXT PRIMARY KEY,
+                name TEXT NOT NULL,
+                pack TEXT NOT NULL,
+                data BLOB NOT NULL)''')
+            conn.execute('CREATE INDEX IF NOT EXISTS hero_name ON hero (name)')
+            local.conn, local.pid = conn, os.getpid()
+        return local.conn
+
+    def put(self, hero):
+        self.conn.execute('INSERT OR REPLACE INTO hero VALUES (?, ?, ?, ?)',
+                          (hero.uni_name, hero.name, hero.pack, serializer.dumps(hero)))
+
+    def get(self, uni_name):
+        '''按uni_name 加载, 不存在返回None
+        '''
+        row = self.conn.execute('SELECT data FROM hero WHERE uni_name = ?', (uni_name,)).fetchone()
+        return self.loads(row[0]) if row else None
+
+    def __contains__(self, uni_name):
+        return self.conn.execute('SELECT 1 FROM hero WHERE uni_name = ?', (uni_name,)).fetchone() is not None
+
+    def __len__(self):
+        return self.conn.execute('SELECT count(*) FROM hero').fetchone()[0]
+
+    def load(self, name, pack=None):
+        '''指定pack 则按uni_name 加载, 否则加载所有同名武将
+        返回Hero 的生成器
+        '''
+        if pack:
+            if hero := self.get(f'{name}@{pack}'):
+                yield hero
+        else:
+            for row in self.conn.execute('SELECT data FROM hero WHERE name = ?', (name,)):
+                yield self.loads(row[0])
+
+    @staticmethod
+    def loads(data: bytes):
+        '''兼容早期以pickle 写入的记录
+        '''
+        return serializer.loads(data) if serializer.is_packed(data) else pickle.loads(data)
+
+    def names(self, prefix=''):
+        '''按武将名前缀列出uni_name(走name 索引的范围查询)
+        '''
+        if prefix:
+            rows = self.conn.execute('SELECT uni_name FROM hero WHERE name >= ? AND name < ? ORDER BY name',
+                                     (prefix, prefix + '\U0010ffff'))
+        else:
+            rows = self.conn.execute('SELECT uni_name FROM hero ORDER BY name')
+        return [row[0] for row in rows]
+
+    def import_pickles(self, dir_path: str):
+        '''将旧的 name@pack.pickle 逐个导入
+        '''
+        cnt = 0
+        for fn in glob.iglob('*@*.pickle', root_dir=dir_path):
+            with open(os.path.join(dir_path, fn), 'rb') as rf:
+                self.put(pickle.load(rf))
+            cnt += 1
+        return cnt
+
+
+if __name__ == '__main__':
+    from common import conf
+    dump_dir = conf['Local']['HeroDumpPath']
+    store = HeroStore.open(dump_dir)
+    print('imported:', store.import_pickles(dump_dir))
+    print('total:', len(store))
@@ -0,0 +1,77 @@
+from collections.abc import Sequence
+
+
+class TableGrid:
+    '''将带rowspan/colspan 的表格行展开为稠密网格
+    逐行一次遍历, 耗时与展开后的单元格数成线性关系
+    headers: th 按colspan 展开后的表头
+    rows: td 按rowspan/colspan 展开后的记录行, 同一单元格实例出现在span 的每一个位置
+
+    pending: 按列号索引的 [单元格, 剩余行数], 记录向下延伸的rowspan
+    '''
+    def __init__(self):
+        self.headers = []
+        self.rows = []
+        self.pending = []
+
+    def add_header(self, cell, colspan=1):
+        self.headers.extend([cell] * colspan)
+
+    def add_row(self, cells):
+        '''cells: (单元格, rowspan, colspan) 的序列
+        没有td 的行(前面行的rowspan 过大导致的空tr) 只消耗一行rowspan, 不产生记录
+        '''
+        pending = self.pending
+        if not cells:
+            for col, span in enumerate(pending):
+                if span:
+                    self._consume(col, span)
+            return
+        row = []
+        col = 0
+        for cell, rowspan, colspan in cells:
+            while col < len(pending) and (span := pending[col]):
+                row.append(span[0])
+                self._consume(col, span)
+                col += 1
+            if rowspan > 1 and len(pending) < col + colspan:
+                pending.extend([None] * (col + colspan - len(pending)))
+            for i in range(col, col + colspan):
+                row.append(cell)
+                if rowspan > 1:
+                    pending[i] = [cell, rowspan - 1]
+            col += colspan
+        # td 之后剩余的rowspan 列, 依列号补在行尾
+        for i in range(col, len(pending)):
+            if span := pending[i]:
+                row.append(span[0])
+                self._consume(i, span)
+        self.rows.append(row)
+
+    def _consume(self, col, span):
+        if span[1] > 1:
+            span[1] -= 1
+        else:
+            self.pending[col] = None
+
+
+class RowView(Sequence):
+    '''行的列投影视图, 按cols 中的列号访问原始行, 不复制行
+    '''
+    __slots__ = ('row', 'cols')
+
+    def __init__(self, row, cols):
+        self.row = row
+        self.cols = cols
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return RowView(self.row, self.cols[i])
+        return self.row[self.cols[i]]
+
+    def __len__(self):
+        return len(self.cols)
+
+    def __iter__(self):
+        row = self.row
+        return (row[c] for c in self.cols)
@@ -1,6 +1,7 @@
 import logging
 import random
 
+from utils.process_pool import submit
 from utils.redis_util import RedisClient
 import common
 from .role import Role
@@ -62,39 +63,24 @@ class Room:
         else:
             role = self.role_queue.pop()
             value = role.value.encode()
-        ret = client.hset(redis_key, user_id, value)
-        print(f'cache user {user_id} role {role} return {ret}')
-        ret = client.expire(redis_key, self.expire_sec)
-        print(f'refresh user {user_id}, return {ret}')
+        cached = client.hset(redis_key, user_id, value)
+        refreshed = client.expire(redis_key, self.expire_sec)
+        logging.getLogger(__name__).debug('room %s cache user %s role %s: %s, refresh: %s',
+                                          self.room_id, user_id, role, cached, refreshed)
         self.lock = common.manager.Lock()
-        common.process_pool.apply_async(self.check_all_seat, callback=self.all_seat_done, error_callback=self.check_seat_error)   # call_it, (self,)
+        submit(check_all_seat, self.room_id, self.lock, callback=self.all_seat_done, error_callback=self.check_seat_error)
         return role
 
-    def check_all_seat(self):
-        if len(self) == 0 and self.room_id not in self.rooms_queue:
-            rc = RedisClient()
-            redis_key = self.role_user_key % self.room_id
-            if self.lock.acquire(timeout=3):
-                if self.room_id in self.rooms_queue:
-                    return ()
-                from .cards.region import UserRole
-                role_cycle = [
-                    UserRole(field.decode(), Role(value.decode()), self)
-                    for field, value in rc.client.hscan_iter(redis_key)
-                ]
-                random.shuffle(role_cycle)
-                for i, uc in enumerate(role_cycle):
-                    if uc.role is Role.Lord:
-                        return role_cycle[i:] + role_cycle[0:i]
-                return ()
-
-    def all_seat_done(self, role_cycle):
-        if role_cycle:
-            from .events import EventCenter, event_err_handler
-            ec = EventCenter(self.room_id, role_cycle)
-            self.rooms_queue[self.room_id] = ec.queue
-            common.process_pool.apply_async(ec.start, callback=self.game_end, error_callback=event_err_handler)
-        if role_cycle is not None:
+    def all_seat_done(self, seats):
+        '''主进程中执行(进程池的回调): 座位齐了则为本房间建立选将队列并在worker 中开始游戏
+        '''
+        if seats and self.room_id not in self.rooms_queue:
+            from .events import event_err_handler, run_game
+            queue = common.manager.Queue()
+            self.rooms_queue[self.room_id] = queue
+            submit(run_game, self.room_id, self.collection, seats, queue,
+                   callback=self.game_end, error_callback=event_err_handler)
+        if seats is not None:
             self.lock.release()
         del self.lock
 
@@ -105,7 +91,7 @@ class Room:
         del self.lock
 
     def game_end(self, res):
-        print(f'房间{self.room_id} 游戏结束')
+        logging.getLogger(__name__).info('房间%s 游戏结束', self.room_id)
         self.offline()
 
     def __len__(self):
@@ -127,10 +113,26 @@ class Room:
         ret = client.rpush(redis_key,
                            *(item.value.encode() for item in self.role_queue))
         rsp = client.expire(redis_key, self.expire_sec)
-        print('redis expired response:', rsp)
+        logging.getLogger(__name__).debug('room %s redis expire response: %s', self.room_id, rsp)
         return ret
 
 
+def check_all_seat(room_id, lock):
+    '''worker 中执行: 身份都已领取完时, 返回从主公开始的座位 [(user_id, 身份值)]
+    只传房间id 和锁, 座位从redis 中读取
+    '''
+    if len(Room(room_id)) == 0:
+        redis_key = Room.role_user_key % room_id
+        if lock.acquire(timeout=3):
+            seats = [(field.decode(), value.decode())
+                     for field, value in Room.redis_client.client.hscan_iter(redis_key)]
+            random.shuffle(seats)
+            for i, (_, role) in enumerate(seats):
+                if role == Role.Lord.value:
+                    return seats[i:] + seats[0:i]
+            return ()
+
+
 if __name__ == '__main__':
     r = Room('test_room_id', 8)
     print(r.cache())
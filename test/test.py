@@ -27,8 +27,10 @@ def show_hero(hero: Hero):
 
 def check_hero(name=None):
     from sgs.heros import HeroMgr
+    from sgs.heros.store import HeroStore
     mgr = HeroMgr.load(conf['Local']['MarkDownPath'])
     dump_dir = conf['Local']['HeroDumpPath']
+    store = HeroStore.open(dump_dir)
     print('Total:', len(mgr.heros))
     print(mgr.monarchs)
     if name:
@@ -36,7 +38,7 @@ def check_hero(name=None):
     else:
         heros = mgr.heros
     for hero in heros:
-        if not os.path.isfile(dump_dir + hero.uni_name + '.pickle'):
+        if hero.uni_name not in store:
             show_hero(hero.crawl_by_name())     # 测试幂等
             robot(hero)
             if input('dump (y/n)?') == 'y':
@@ -50,6 +52,595 @@ def load_hero(name):
         robot(hero)
 
 
+def bench_serializer(number=10):
+    '''对比pickle 与serializer 在全量武将上的dump/load 耗时和体积
+    优先使用HeroStore 中已抓取的武将
+    '''
+    import pickle
+    import timeit
+    from sgs.heros import hero_mgr
+    from sgs.heros.store import HeroStore
+    from utils import serializer
+    store = HeroStore.open(conf['Local']['HeroDumpPath'])
+    heros = [store.get(hero.uni_name) or hero for hero in hero_mgr.heros]
+    print('Total:', len(heros))
+    for name, dumps, loads in (('pickle', pickle.dumps, pickle.loads),
+                               ('serializer', serializer.dumps, serializer.loads)):
+        blobs = [dumps(hero) for hero in heros]
+        t_dump = timeit.timeit(lambda: [dumps(hero) for hero in heros], number=number) / number
+        t_load = timeit.timeit(lambda: [loads(b) for b in blobs], number=number) / number
+        print(f'{name:>10}: dump {t_dump*1000:.2f}ms, load {t_load*1000:.2f}ms, size {sum(map(len, blobs))}B')
+
+
+def bench_table(rows=2000, number=5):
+    '''表格展开耗时: page_cache 中百度百科页面的全部表格, 以及一个rows 行的合成大表(带rowspan/colspan)
+    '''
+    import glob
+    import time
+    from bs4 import BeautifulSoup
+    from common import root_path
+    from sgs.heros.crawler import Table, html_parser, recur_node
+    html = ''.join(
+        f'<tr><td rowspan="3">包{i}</td><td>技能{i}</td><td colspan="2">台词{i}</td></tr>'
+        f'<tr><td>技能{i}b</td><td rowspan="2" colspan="2">台词{i}b</td></tr><tr><td>技能{i}c</td></tr>'
+        for i in range(rows // 3))
+    pages = {'synthetic': f'<table><tr><th>扩展包</th><th>技能</th><th colspan="2">台词</th></tr>{html}</table>'}
+    for fn in glob.iglob(str(root_path / 'page_cache/baidu_baike/*.html')):
+        with open(fn) as f:
+            pages[os.path.basename(fn)] = f.read()
+    for name, page in pages.items():
+        bs = BeautifulSoup(page, html_parser)
+        tables = [list(recur_node(t)) for t in bs.find_all('table')]
+        if not tables:
+            continue
+        begin = time.perf_counter()
+        for i in range(number):
+            built = []
+            for children in tables:
+                table = Table.empty('table')
+                table.iter_children(children)
+                built.append(table)
+        cost = (time.perf_counter() - begin) / number
+        cells = sum(len(r) for table in built for r in table.records)
+        print(f'{name}: {len(tables)} tables, {cells} cells, {cost*1000:.2f}ms')
+
+
+def bench_hero_attr(number=20):
+    '''全量武将的属性访问耗时(HeroMgr 中search/monarchs/all_heros 等循环的主要开销)
+    '''
+    import timeit
+    from sgs.heros import hero_mgr
+    heros = hero_mgr.heros
+    def visit():
+        for hero in heros:
+            hero.name, hero.pack, hero.hp, hero.hp_max, hero.is_monarch, hero.uni_name
+    cost = timeit.timeit(visit, number=number) / number
+    print(f'{len(heros)} heros, {cost*1000:.3f}ms per pass, {cost/len(heros)/6*1e9:.0f}ns per attr')
+
+
+def mem_report(top=10):
+    '''tracemalloc 统计全量武将(md 加HeroStore 中已抓取的内容) 的常驻内存, 并列出分配最多的代码行
+    '''
+    import gc
+    import tracemalloc
+    from sgs.heros import HeroMgr
+    from sgs.heros.store import HeroStore
+    store = HeroStore.open(conf['Local']['HeroDumpPath'])
+    tracemalloc.start()
+    mgr = HeroMgr.load(conf['Local']['MarkDownPath'])
+    heros = [store.get(hero.uni_name) or hero for hero in mgr.heros]
+    gc.collect()
+    snapshot = tracemalloc.take_snapshot()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f'{len(heros)} heros, current {current/1024:.0f}KiB, peak {peak/1024:.0f}KiB')
+    for stat in snapshot.statistics('lineno')[:top]:
+        print(stat)
+
+
+def bench_md_load(heros=5000):
+    '''HeroMgr.load 在合成的heros 个武将md 文件上的耗时和内存峰值(含一个需要跳过的非武将牌类目)
+    '''
+    import tempfile
+    import time
+    import tracemalloc
+    from sgs.heros import HeroMgr
+    packs = ['标准版', '界限突破', 'SP', '一将成名', '山', '林', '火', '风']
+    with tempfile.NamedTemporaryFile('w', suffix='.md') as f:
+        f.write('# 说明\n## 无关\n' + '### 无关\nHP=3\n\n' * heros + '# 武将牌\n')
+        for pack in packs:
+            f.write(f'## {pack}\n')
+            for i in range(heros // len(packs)):
+                f.write(f'### 武将{i}\nHP={3 + i % 2}\nbaike_key: 武将{i}\n'
+                        f'**技能{i}**: 出牌阶段限一次，你可以弃置一张手牌{"，主公技" if i % 20 == 0 else ""}\n'
+                        f'**锁定技{i}**: 你的手牌上限+1\n\n- 列表一\n- 列表二 *斜体*\n\n')
+        f.flush()
+        begin = time.perf_counter()
+        mgr = HeroMgr.load(f.name)
+        cost = time.perf_counter() - begin
+        tracemalloc.start()
+        HeroMgr.load(f.name)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    print(f'{len(mgr.heros)} heros, {cost*1000:.0f}ms, peak {peak/1024:.0f}KiB')
+
+
+def test_hero_reload(path='/tmp/test_heros.md'):
+    '''武将md 的增量重新加载: 未变的段落复用原武将对象, 修改/新增的重新解析, 删除的移除;
+    以及worker 在任务开始前按主进程的版本同步(sync_state)
+    '''
+    from multiprocessing import Pool
+    import common
+    from sgs.heros import HeroMgr
+    from utils import process_pool
+    def section(name, hp, pack_heading=''):
+        return f'{pack_heading}### {name}\nHP={hp}\nbaike_key: {name}\n**技能**: 你的手牌上限+1\n\n'
+    def write(*sections, mtime=None):
+        with open(path, 'w') as f:
+            f.write('# 说明\n## 无关\n### 无关\nHP=9\n\n# 武将牌\n' + ''.join(sections))
+        st = os.stat(path)
+        os.utime(path, ns=(st.st_atime_ns, mtime or st.st_mtime_ns))
+    write(section('甲', 3, '## 标准版\n'), section('乙', 4), section('丙', 3), section('丁', 4, '## 风\n'), mtime=10**18)
+    mgr = HeroMgr.load(path)
+    before = {hero.uni_name: hero for hero in mgr.heros}
+    assert sorted(before) == ['丁@风', '丙@标准版', '乙@标准版', '甲@标准版']
+    assert mgr.pools.ids.keys() == before.keys()
+    assert not mgr.refresh()
+    write(section('甲', 3, '## 标准版\n'), section('乙', 5), section('戊', 3), section('丁', 4, '## 风\n'), mtime=10**18 + 10**9)
+    assert mgr.refresh() and mgr.mtime == 10**18 + 10**9
+    after = {hero.uni_name: hero for hero in mgr.heros}
+    assert sorted(after) == ['丁@风', '乙@标准版', '戊@标准版', '甲@标准版']
+    assert after['甲@标准版'] is before['甲@标准版'] and after['丁@风'] is before['丁@风']
+    assert after['乙@标准版'] is not before['乙@标准版'] and after['乙@标准版'].hp == 5
+    assert mgr.pools.ids.keys() == after.keys() and mgr.name_index.keys() == {'甲', '乙', '戊', '丁'}
+    # 包标题变化时其下未变的武将段落也重新解析
+    write(section('甲', 3, '## 标准版\n'), section('乙', 5), section('戊', 3), section('丁', 4, '## 火\n'), mtime=10**18 + 2 * 10**9)
+    assert mgr.refresh() and '丁@火' in mgr.pools.ids and mgr.heros[0] is after['甲@标准版']
+    os.remove(path)
+
+    version = [1]
+    process_pool.sync_state(lambda: version[0], _record_version)
+    try:
+        with Pool(1) as pool:
+            common.process_pool = pool
+            assert process_pool.submit(_synced_version).get() == 1
+            version[0] = 2
+            assert process_pool.submit(_synced_version).get() == 2
+    finally:
+        process_pool._synced.pop()
+    print('hero reload ok')
+
+
+_worker_version = None
+
+def _record_version(version):
+    global _worker_version
+    _worker_version = version
+
+def _synced_version():
+    return _worker_version
+
+
+def bench_pick_alloc(seats=10, number=1000):
+    '''seats 人房间的选将池分配, 以及按hero id 取回所选武将 对比 按名字search(不含抓取)
+    '''
+    import timeit
+    from sgs.heros import hero_mgr
+    from sgs.heros.pool import PickAllocator
+    pools = hero_mgr.pools
+    bans = [hero.name for hero in pools.sample(5)]
+    allocator = PickAllocator(pools, seats, bans=bans)
+    picks = [(pos, ids[0]) for pos, ids in enumerate(allocator.seats, 1)]
+    t_alloc = timeit.timeit(lambda: PickAllocator(pools, seats, bans=bans), number=number) / number
+    t_resolve = timeit.timeit(lambda: [allocator.resolve(pos, hid) for pos, hid in picks], number=number) / number
+    unames = [pools.heros[hid].uni_name.partition('@') for _, hid in picks]
+    t_search = timeit.timeit(lambda: [[hero for hero in hero_mgr.heros if pack in hero.pack and name in hero.name]
+                                      for name, _, pack in unames], number=10) / 10
+    print(f'{len(pools.heros)} heros, {seats} seats: alloc {t_alloc*1e6:.1f}us, '
+          f'resolve {t_resolve*1e6:.1f}us, search {t_search*1e6:.1f}us')
+
+
+def test_hero_pools(rounds=200):
+    '''固定的小武将表上校验HeroPools 的过滤条件和不放回抽取
+    '''
+    import random
+    from types import SimpleNamespace
+    from sgs.heros.hero import Camp
+    from sgs.heros.pool import HeroPools, PickAllocator
+    roster = [('刘备', '标准版', Camp.SHU, True), ('曹操', '标准版', Camp.WEI, True), ('孙权', '标准版', Camp.WU, True),
+              ('关羽', '标准版', Camp.SHU, False), ('甄姬', '标准版', Camp.WEI, False), ('曹操', '界限突破', Camp.WEI, True),
+              ('关羽', '界限突破', Camp.SHU, False), ('华雄', '群英荟萃', Camp.QUN, False), ('张角', '群英荟萃', Camp.QUN, True),
+              ('司马懿', '魏晋风流', Camp.JIN, False), ('羊祜', '魏晋风流', Camp.JIN, False)]
+    pools = HeroPools([SimpleNamespace(name=name, pack=pack, uni_name=f'{name}@{pack}', camp=camp, is_monarch=monarch)
+                       for name, pack, camp, monarch in roster])
+    def unames(*conds):
+        return {pools.heros[hid].uni_name for hid in pools.filter(*conds)}
+    assert len(pools.filter()) == len(roster)
+    assert unames('魏') == {'曹操@标准版', '甄姬@标准版', '曹操@界限突破'}
+    assert unames('群') == {'华雄@群英荟萃', '张角@群英荟萃'}
+    # 以势力名开头的词按武将包匹配
+    assert unames('群英') == {'华雄@群英荟萃', '张角@群英荟萃'}
+    assert unames('魏晋') == {'司马懿@魏晋风流', '羊祜@魏晋风流'}
+    assert unames('魏国') == set()
+    assert unames('蜀', '魏') == unames('蜀') | unames('魏')
+    assert unames('标准', '界限') == unames('标准') | unames('界限')
+    assert unames('标准', '蜀') == {'刘备@标准版', '关羽@标准版'}
+    assert unames('主公') == {'刘备@标准版', '曹操@标准版', '孙权@标准版', '张角@群英荟萃'}
+    assert unames('主公', '魏') == {'曹操@标准版'}
+    assert unames('typo') == set()
+    assert pools.filter('魏', '标准') is pools.filter('标准', '魏')
+    for k in range(len(roster) + 1):
+        assert len(set(pools.draw(pools.all, k))) == k
+    for pool, k in ((pools.all, len(roster) + 1), (pools.filter('typo'), 1)):
+        try:
+            pools.draw(pool, k)
+        except ValueError:
+            pass
+        else:
+            assert False, 'draw more than the pool should raise'
+    names = len({name for name, *_ in roster})
+    for seed in range(rounds):
+        random.seed(seed)
+        taken = {pools.ids['甄姬@标准版']}
+        picked = pools.draw(pools.all, names - 1, taken, pools.same_name)
+        assert len(picked) == names - 1 and pools.ids['甄姬@标准版'] not in picked
+        assert len({pools.heros[hid].name for hid in picked}) == len(picked)
+        assert all(hid in taken for hid in picked) and set(pools.names['关羽']) <= taken
+        try:
+            pools.draw(pools.all, 1, taken, pools.same_name)
+        except ValueError:
+            pass
+        else:
+            assert False, 'all names are taken'
+        room = pools.room_draw()
+        room.ban(['曹操', '华雄@群英荟萃'])
+        drawn = room.draw(1, '魏') + room.draw(names - 3)
+        assert drawn[0] == pools.ids['甄姬@标准版']
+        assert {pools.heros[hid].name for hid in drawn}.isdisjoint({'曹操', '华雄'})
+        assert len({pools.heros[hid].name for hid in drawn}) == len(drawn)
+        allocator = PickAllocator(pools, 3, seat_size=2, lord_monarchs=2, lord_heros=1)
+        for pos, ids in enumerate(allocator.seats, 1):
+            assert all(allocator.resolve(pos, hid) is pools.heros[hid] for hid in ids)
+            other = allocator.seats[pos % 3][0]
+            try:
+                allocator.resolve(pos, other)
+            except ValueError:
+                pass
+            else:
+                assert False, 'resolve another seat\'s hero should raise'
+        assert all(pools.heros[hid].is_monarch for hid in allocator.seats[0][:2])
+    print(f'hero pools: {len(roster)} heros, {rounds} rounds ok')
+
+
+def bench_user_store(users=20000):
+    '''UserMgr 快照 + 日志: 每次获胜的追加耗时(含fsync)、重放日志的启动耗时、合并快照耗时
+    '''
+    import tempfile
+    import time
+    from biz.user import UserMgr
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        file_path = os.path.join(tmp_dir, 'users')
+        UserMgr.user_dict = {}
+        UserMgr.load(file_path)
+        UserMgr.COMPACT_EVERY = users + 1
+        begin = time.perf_counter()
+        for i in range(users):
+            UserMgr.add_record(f'user{i}', '3v3', '庞德')
+        t_append = (time.perf_counter() - begin) / users
+        UserMgr.wal.close()
+        UserMgr.user_dict = {}
+        begin = time.perf_counter()
+        UserMgr.load(file_path)
+        t_replay = time.perf_counter() - begin
+        begin = time.perf_counter()
+        UserMgr.close()
+        t_compact = time.perf_counter() - begin
+        UserMgr.user_dict = {}
+        begin = time.perf_counter()
+        UserMgr.load(file_path)
+        t_load = time.perf_counter() - begin
+        UserMgr.close()
+    print(f'{len(UserMgr.user_dict)} users: append {t_append*1e6:.0f}us/win, replay {t_replay*1000:.0f}ms, '
+          f'compact {t_compact*1000:.0f}ms, snapshot load {t_load*1000:.0f}ms')
+
+
+def bench_user_compact(users=100000, records=20, consumed=(10, 8), dirty=1000):
+    '''users 个用户, 每人records 条获胜记录且消费了consumed 张手气卡/换将卡: 快照的dump/load,
+    首次合并全部已消费记录, 以及之后只有dirty 个用户消费过卡时的合并耗时
+    '''
+    import tempfile
+    import time
+    from datetime import datetime, timedelta
+    from biz.user import Record, UserMgr
+    begin_time = datetime(2024, 1, 1)
+    UserMgr.user_dict = {}
+    for i in range(users):
+        user = UserMgr.get_user(f'user{i}')
+        for j in range(records):
+            user.put_record(Record('3v3', f'武将{j}', begin_time + timedelta(minutes=10*j)))
+        user.luck_consumed, user.rep_consumed = consumed
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        file_path = os.path.join(tmp_dir, 'users')
+        begin = time.perf_counter()
+        UserMgr.dump(file_path)
+        t_dump = time.perf_counter() - begin
+        begin = time.perf_counter()
+        UserMgr.load(file_path)
+        t_load = time.perf_counter() - begin
+        size = os.path.getsize(file_path)
+        UserMgr.COMPACT_EVERY = dirty * 2 + 1
+        begin = time.perf_counter()
+        trimmed = sum(len(r_keys) for _, r_keys in UserMgr.trim())
+        t_trim = time.perf_counter() - begin
+        for i in range(dirty):
+            UserMgr.consume(f'user{i}', 'luck')
+            UserMgr.consume(f'user{i}', 'rep')
+        begin = time.perf_counter()
+        dirty_trimmed = sum(len(r_keys) for _, r_keys in UserMgr.trim())
+        t_dirty = time.perf_counter() - begin
+        UserMgr.wal.close()
+        UserMgr.wal = None
+    print(f'{users} users x {records} records: dump {t_dump*1000:.0f}ms, load {t_load*1000:.0f}ms, '
+          f'size {size/1024/1024:.1f}MiB, trim {trimmed} records {t_trim*1000:.0f}ms, '
+          f'trim {dirty} dirty users ({dirty_trimmed} records) {t_dirty*1000:.2f}ms')
+
+
+def test_user_ledger(client=None, users=50, ops=5000, seed=1):
+    '''UserLedger 的Lua 脚本与本地User 的判定逐步对比: 随机的获胜(含5 分钟内重复)、消费、合并、重新seed
+    client: redis 客户端, 默认用fakeredis(需安装fakeredis 和lupa 以支持Lua); 会清空其db, 真实Redis 请用空闲的db, 如redis.Redis(db=15)
+    '''
+    import random
+    from datetime import datetime, timedelta
+    from biz.user import Record, User, UserLedger
+    if client is None:
+        import fakeredis
+        client = fakeredis.FakeRedis()
+    client.flushdb()
+    ledger = UserLedger(client)
+    rnd = random.Random(seed)
+    local = {f'user{i}': User(f'user{i}') for i in range(users)}
+    now = datetime(2024, 1, 1)
+    # 一半用户先只在本地有记录, 验证seed 迁移
+    for name in list(local)[:users // 2]:
+        user = local[name]
+        for j in range(rnd.randint(0, 5)):
+            user.put_record(Record('3v3', f'武将{j}', now + timedelta(minutes=10 * j)))
+        user.luck_consumed = rnd.randint(0, len(user.records))
+    now += timedelta(days=1)
+    assert ledger.seed(local.values(), batch=7) == users
+    assert ledger.seed(local.values(), batch=7) == 0
+    for _ in range(ops):
+        name = rnd.choice(list(local))
+        user = local[name]
+        match rnd.random():
+            case r if r < 0.5:
+                now += timedelta(seconds=rnd.choice((60, 299, 300, 301, 900)))
+                record = Record(rnd.choice(('3v3', '身份')), f'武将{rnd.randint(0, 30)}', now)
+                expect = not user.last_record_time or record.r_time - user.last_record_time > timedelta(minutes=5)
+                assert ledger.win(name, record) == expect, (name, record)
+                if expect:
+                    user.put_record(record)
+            case r if r < 0.9:
+                kind = rnd.choice(('luck', 'rep'))
+                left = getattr(user, f'{kind}_num')
+                assert ledger.consume(name, kind) == (left - 1 if left > 0 else -1)
+                if left > 0:
+                    setattr(user, f'{kind}_consumed', getattr(user, f'{kind}_consumed') + 1)
+            case _:
+                ledger.trim([(name, user.compact())], batch=3)
+        for kind in ('luck', 'rep'):
+            assert ledger.left(name, kind) == getattr(user, f'{kind}_num'), (name, kind)
+        assert client.scard(UserLedger.wins_key % name) == len(user.records)
+    print(f'ledger matches local records: {users} users, {ops} ops')
+
+
+def bench_leaderboard(users=100000, wins=2000000, k=10):
+    '''wins 次获胜(按Zipf 分布落在users 个用户上) 的增量聚合耗时, 以及top k/个人名次 对比 扫描全部用户计数
+    '''
+    import heapq
+    import random
+    import time
+    import timeit
+    from datetime import datetime
+    from biz.stats import WinStats
+    from biz.user import Record
+    names = [f'user{i}' for i in range(users)]
+    weights = [1 / (i + 1) for i in range(users)]
+    records = [Record(random.choice(['3v3', '身份', '国战']), f'武将{random.randrange(500)}', datetime.now())
+               for _ in range(1000)]
+    winners = random.choices(names, weights, k=wins)
+    stats = WinStats()
+    begin = time.perf_counter()
+    for i, name in enumerate(winners):
+        stats.add(name, records[i % len(records)])
+    t_add = (time.perf_counter() - begin) / wins
+    counts = stats.total.counts
+    t_top = timeit.timeit(lambda: stats.week_board().top(k), number=100) / 100
+    t_scan = timeit.timeit(lambda: heapq.nlargest(k, counts.items(), key=lambda kv: kv[1]), number=3) / 3
+    me = names[users // 2]
+    t_rank = timeit.timeit(lambda: stats.total.rank(me), number=100) / 100
+    t_rank_scan = timeit.timeit(lambda: sum(1 for n in counts.values() if n > counts[me]), number=3) / 3
+    print(f'{wins} wins over {len(counts)} users: add {t_add*1e6:.2f}us, top{k} {t_top*1e6:.1f}us '
+          f'(scan {t_scan*1000:.1f}ms), rank {t_rank*1e6:.1f}us (scan {t_rank_scan*1000:.1f}ms)')
+
+
+def bench_worker_pool(seats=10, workers=4):
+    '''进程池任务的序列化字节数: 旧的绑定方法(带Room/EventCenter 对象图) 对比 按id 提交;
+    以及fork 前预加载武将后, worker 做一次全量gc 后的内存(有无gc.freeze)
+    '''
+    import gc
+    from multiprocessing import Manager, Pool
+    from multiprocessing.reduction import ForkingPickler
+    from sgs.cards.region import UserRole
+    from sgs.events import EventCenter, run_game
+    from sgs.heros import hero_mgr
+    from sgs.role import Role
+    from sgs.room import Room, check_all_seat
+    from utils.process_pool import preload, worker_memory
+    with Manager() as manager:
+        room = Room.__new__(Room)
+        room.room_id, room.collection, room.lock = 'oc_0123456789abcdef', 'all', manager.Lock()
+        room.role_queue = list(Room.gen_role_seq(seats))
+        seat_list = [(f'ou_{i:032x}', role.value) for i, role in enumerate(room.role_queue)]
+        ec = EventCenter(room.room_id, [UserRole(uid, Role(role), room) for uid, role in seat_list], manager.Queue())
+        sizes = {
+            'seat check (bound method)': ForkingPickler.dumps((room.all_seat_done, ())),
+            'seat check (ids)': ForkingPickler.dumps((check_all_seat, (room.room_id, room.lock))),
+            'game (bound method)': ForkingPickler.dumps((ec.start, ())),
+            'game (ids)': ForkingPickler.dumps((run_game, (room.room_id, room.collection, seat_list, ec.queue))),
+        }
+    for name, data in sizes.items():
+        print(f'{name:>26}: {len(data)}B')
+    hero_mgr.pools
+    for freeze in (False, True):
+        if freeze:
+            preload(hero_mgr)
+        with Pool(workers) as pool:
+            pool.map(gc.collect, [2] * workers * 4)
+            mem = list(worker_memory(pool).values())
+        print(f'gc.freeze={freeze}: {len(hero_mgr.heros)} heros, worker avg private {sum(m["private"] for m in mem)/len(mem):.0f}KiB, '
+              f'shared {sum(m["shared"] for m in mem)/len(mem):.0f}KiB, pss {sum(m["pss"] for m in mem)/len(mem):.0f}KiB')
+    gc.unfreeze()
+
+
+def bench_metrics(number=200000):
+    '''埋点的单次开销: 关闭时的空操作 对比 开启时的计数和计时(不受conf 影响, 直接构造指标)
+    '''
+    import timeit
+    from utils import metrics
+    hist = metrics.Histogram('bench_seconds', 'bench', ('handler',))
+    counter = metrics.Counter('bench_total', 'bench', ('cache', 'result'))
+    def timed(metric):
+        with metric.time('rank'):
+            pass
+    cases = {
+        'noop time': lambda: timed(metrics.NOOP),
+        'noop inc': lambda: metrics.NOOP.labels('hero_card', 'hit').inc(),
+        'histogram time': lambda: timed(hist),
+        'counter inc': lambda: counter.labels('hero_card', 'hit').inc(),
+    }
+    for name, func in cases.items():
+        print(f'{name:>15}: {timeit.timeit(func, number=number) / number * 1e9:.0f}ns')
+
+
+def bench_logging(number=20000, path='/tmp/bench_log.json', io_delay=0):
+    '''请求线程中单条日志的耗时: 同步写文件 对比 入队由后台线程写出(含写完队列的总耗时)
+    io_delay: 模拟慢盘/阻塞的stdout, 每条日志写出时额外sleep 的秒数
+    '''
+    import logging
+    import time
+    from utils.log_util import AsyncPipeline, JsonFormatter, SamplingFilter, _SinkHandler
+    handler = logging.FileHandler(path, 'w')
+    handler.setFormatter(JsonFormatter())
+    if io_delay:
+        emit = handler.emit
+        handler.emit = lambda record: (time.sleep(io_delay), emit(record))
+    logger = logging.getLogger('bench_logging')
+    logger.propagate = False
+    def run():
+        begin = time.perf_counter()
+        for i in range(number):
+            logger.info('pick hero %d for %s', i, 'user')
+        return (time.perf_counter() - begin) / number * 1e6
+    logger.handlers = [handler]
+    print(f'sync : {run():.1f}us/call')
+    pipeline = AsyncPipeline()
+    pipeline.sinks[logger.name] = [handler]
+    queue_handler = _SinkHandler(pipeline, logger.name)
+    queue_handler.addFilter(SamplingFilter(pipeline))
+    logger.handlers = [queue_handler]
+    pipeline.start()
+    begin = time.perf_counter()
+    caller = run()
+    pipeline.stop()
+    print(f'async: {caller:.1f}us/call, drained in {(time.perf_counter() - begin) * 1000:.0f}ms')
+    handler.close()
+
+
+def bench_robot(heros=12, port=18999):
+    '''本地假webhook 上对比: 逐个武将requests.post(每次新连接、重新签名) 与RobotClient.send_many(合并、复用连接)
+    '''
+    import http.server, threading, time
+    from sgs.heros import hero_mgr
+    from utils.robot_adapter import RobotClient, get_content_dict
+    class Hook(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        def do_POST(self):
+            size = int(self.headers['Content-Length'])
+            self.rfile.read(size)
+            posts.append((self.client_address, size))
+            self.send_response(200)
+            self.send_header('Content-Length', '10')
+            self.end_headers()
+            self.wfile.write(b'{"code":0}')
+        def log_message(self, *args):
+            pass
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', port), Hook)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{port}/hook'
+    sample = hero_mgr.heros[:heros]
+
+    posts = []
+    begin = time.perf_counter()
+    for hero in sample:
+        requests.post(url, json={**get_content_dict(hero, None), 'timestamp': '0', 'sign': ''})
+    print(f'per hero : {len(posts)} posts, {len({a for a, _ in posts})} connections, {sum(s for _, s in posts)}B, '
+          f'{(time.perf_counter() - begin) * 1000:.0f}ms')
+
+    posts = []
+    client = RobotClient({'HookUrl': url, 'Token': 'bench'})
+    begin = time.perf_counter()
+    client.send_many(sample)
+    queued = time.perf_counter() - begin
+    client.flush()
+    print(f'send_many: {len(posts)} posts, {len({a for a, _ in posts})} connections, {sum(s for _, s in posts)}B, '
+          f'handler waits {queued * 1000:.1f}ms, delivered in {(time.perf_counter() - begin) * 1000:.0f}ms')
+    server.shutdown()
+
+
+def bench_fs_card(players=10, heros=5, number=200):
+    '''一局players 人的选将卡片: dataclasses.asdict 对比 预生成的序列化函数(含Header/Confirm 的缓存)
+    '''
+    import time
+    from dataclasses import asdict
+    from utils.fs_template.cards import CommonCard, FsCard, pick_hero_card, to_dict
+    cards = [(f'room{i}', pos, [(pos * heros + j, f'界武将{pos * heros + j}') for j in range(heros)])
+             for i in range(number) for pos in range(1, players + 1)]
+    def build(convert):
+        CommonCard.to_dict = lambda card: convert(FsCard(card.header, card.elements))
+        begin = time.perf_counter()
+        out = [pick_hero_card(*args) for args in cards]
+        return out, (time.perf_counter() - begin) / number * 1000
+    origin = CommonCard.to_dict
+    try:
+        slow, slow_ms = build(asdict)
+        fast, fast_ms = build(to_dict)
+    finally:
+        CommonCard.to_dict = origin
+    assert json.dumps(slow) == json.dumps(fast)
+    print(f'asdict : {slow_ms:.2f}ms per {players} cards')
+    print(f'to_dict: {fast_ms:.2f}ms per {players} cards ({slow_ms / fast_ms:.1f}x)')
+
+
+def bench_card_template(players=10, heros=5, number=200):
+    '''一局players 人的选将卡片消息内容: 逐张构造并json.dumps 对比 本地模板一次渲染所有座位
+    '''
+    import time
+    from utils.fs_template.cards import pick_hero_card, pick_hero_contents
+    games = [(f'room{i}', [[(pos * heros + j, f'界武将{pos * heros + j}') for j in range(heros)]
+                           for pos in range(1, players + 1)]) for i in range(number)]
+    begin = time.perf_counter()
+    built = [[json.dumps(pick_hero_card(room_id, pos, seat)) for pos, seat in enumerate(seats, 1)]
+             for room_id, seats in games]
+    build_ms = (time.perf_counter() - begin) / number * 1000
+    begin = time.perf_counter()
+    rendered = [pick_hero_contents(room_id, seats) for room_id, seats in games]
+    render_ms = (time.perf_counter() - begin) / number * 1000
+    assert all(json.loads(a) == json.loads(b) for x, y in zip(built, rendered) for a, b in zip(x, y))
+    print(f'build + dumps: {build_ms:.2f}ms per game, {sum(map(len, built[0]))}B')
+    print(f'template     : {render_ms:.2f}ms per game, {sum(map(len, rendered[0]))}B ({build_ms / render_ms:.1f}x)')
+
+
 def test_card():
     from sgs.cards.region import CardHeap
     ch = CardHeap()
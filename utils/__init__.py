@@ -1,5 +1,6 @@
 class classproperty:
     '''类属性装饰器, 支持缓存, 但不支持缓存生成器函数结果(因为生成器只能一次性消费)
+    缓存按访问的类分别保存, 子类不会拿到父类(或兄弟类) 算出的值
     '''
     def __init__(self, method_or_cached):
         if callable(method_or_cached):
@@ -7,6 +8,7 @@ class classproperty:
             self.cached = False
         else:
             self.cached = bool(method_or_cached)
+        self._cache = {}
     
     def __call__(self, method):
         self.method = method
@@ -18,9 +20,10 @@ class classproperty:
     def __get__(self, ins, owner):
         if not self.cached:
             return self.method(owner)
-        if not hasattr(self, '_cache'):
-            self._cache = self.method(owner)
-        return self._cache
+        try:
+            return self._cache[owner]
+        except KeyError:
+            return self._cache.setdefault(owner, self.method(owner))
     
     from collections import namedtuple
     property_val = namedtuple('property_val', 'value cached')
@@ -30,11 +33,12 @@ class classproperty:
             value = value.value
         if callable(value):
             self.method = value
+            self._cache.clear()
         elif self.cached:
-            self._cache = value
+            self._cache[type(ins)] = value
         else:
             self.method = lambda c: value
 
     def __delete__(self, ins):
         if self.cached:
-            del self._cache
\ No newline at end of file
+            del self._cache[type(ins)]
\ No newline at end of file
@@ -1,6 +1,7 @@
 from dataclasses import field
-from functools import partial
+from functools import lru_cache, partial
 from .components import *
+from .registry import get_template, register, var
 
 @dataclass
 class CommonCard:
@@ -16,7 +17,7 @@ class CommonCard:
         return self
 
     def to_dict(self):
-        return asdict(FsCard(self.header, self.elements))
+        return to_dict(FsCard(self.header, self.elements))
     
     @staticmethod
     def btn_value(cmd, room_id, **kwargs):
@@ -27,29 +28,53 @@ class CommonCard:
         }
     
     @staticmethod
+    @lru_cache(maxsize=1024)
     def confirm(title, text):
         return Confirm(Text(title), Text(text))
 
 
-def pick_hero_card(room_id, pos, names):
+def pick_hero_card(room_id, pos, heros):
+    '''heros: 候选武将的uni_name, 或(hero id, uni_name); 带hero id 时按钮回传hero_id, 选将无需按名字搜索
+    '''
+    heros = [hero if isinstance(hero, tuple) else (None, hero) for hero in heros]
     btn_value = partial(CommonCard.btn_value, 'pick_hero', room_id)
     confirm = partial(CommonCard.confirm, '确认选择武将')
+    def button(hid, name, btn_type):
+        value = btn_value(uname=name) if hid is None else btn_value(uname=name, hero_id=hid)
+        return Button(Text(name), btn_type, value, confirm(name))
     card = CommonCard(room_id, [
-        Markdown(f'你的位置是 {pos} 号位，你的可选武将有 {len(names)} 个，请选择：')
+        Markdown(f'你的位置是 {pos} 号位，你的可选武将有 {len(heros)} 个，请选择：')
     ])
-    actions = [Action([
-        Button(Text(name), 'primary', btn_value(uname=name), confirm(name))
-        for name in names[:3]
-    ])]
-    if len(names) > 3:
-        actions.append(Action([
-            Button(Text(name), 'default', btn_value(uname=name), confirm(name))
-            for name in names[3:]
-        ]))
+    actions = [Action([button(hid, name, 'primary') for hid, name in heros[:3]])]
+    if len(heros) > 3:
+        actions.append(Action([button(hid, name, 'default') for hid, name in heros[3:]]))
     return card.add_ele(*actions).to_dict()
 
 
 def simple_card(room_id, cont):
     return CommonCard(room_id, [
         TextBlock(Text(cont))
-    ]).to_dict()
\ No newline at end of file
+    ]).to_dict()
+
+
+@register('pick_hero')
+def pick_hero_layout(n):
+    return pick_hero_card(var('room_id'), var('pos'), [(var(f'hero_id{i}'), var(f'uname{i}')) for i in range(n)])
+
+
+def pick_hero_contents(room_id, seats):
+    '''一局所有座位的选将卡片json, seats: 各座位(按位置顺序) 的候选 [(hero id, uni_name)]
+    候选个数相同的座位共用一个模板, 一次渲染
+    '''
+    groups = {}
+    for pos, heros in enumerate(seats, 1):
+        values = {'room_id': room_id, 'pos': pos}
+        for i, (hid, name) in enumerate(heros):
+            values[f'hero_id{i}'] = hid
+            values[f'uname{i}'] = name
+        groups.setdefault(len(heros), []).append((pos, values))
+    cards = [None] * len(seats)
+    for n, rows in groups.items():
+        for (pos, _), card in zip(rows, get_template('pick_hero', n).render_many(values for _, values in rows)):
+            cards[pos - 1] = card
+    return cards
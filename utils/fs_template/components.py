@@ -1,21 +1,62 @@
-from dataclasses import asdict, dataclass
+'''飞书卡片的组件
+to_dict 把组件树转为可直接json 序列化的dict: 每个组件类首次序列化时生成专用的函数(按字段直接取值构造dict),
+不再像dataclasses.asdict 那样逐层反射字段并deepcopy
+不可变的组件(frozen, 如Text/Header/Confirm) 的结果按值缓存, 多张卡片共享同一个dict, 使用方不要修改
+'''
+from dataclasses import asdict, dataclass, fields, is_dataclass
+from functools import lru_cache
 import json
-from typing import Literal
-
-
-@dataclass
+from typing import Literal, get_origin
+
+_serializers = {}
+
+
+def to_dict(obj):
+    '''组件(树) 转dict; list/tuple 转为list, dict 复制一层并转换其值, 其余原样返回
+    '''
+    if (serializer := _serializers.get(type(obj))) is not None:
+        return serializer(obj)
+    if isinstance(obj, (list, tuple)):
+        return [to_dict(v) for v in obj]
+    if isinstance(obj, dict):
+        return {k: to_dict(v) for k, v in obj.items()}
+    if is_dataclass(obj):
+        return compile_serializer(type(obj))(obj)
+    return obj
+
+
+def compile_serializer(cls):
+    '''生成cls 的序列化函数, 如Text: lambda o: {'content': o.content, 'tag': o.tag}
+    str/int/Literal 等标量字段直接取值, 其余字段交给to_dict
+    '''
+    items = []
+    for f in fields(cls):
+        value = f'o.{f.name}'
+        if not (f.type in (str, int, float, bool) or get_origin(f.type) is Literal):
+            value = f'to_dict({value})'
+        items.append(f'{f.name!r}: {value}')
+    namespace = {'to_dict': to_dict}
+    exec(f'def serialize(o):\n    return {{{", ".join(items)}}}', namespace)
+    serializer = namespace['serialize']
+    if cls.__dataclass_params__.frozen:
+        serializer = lru_cache(maxsize=1024)(serializer)
+    _serializers[cls] = serializer
+    return serializer
+
+
+@dataclass(frozen=True)
 class Text:
     content: str
     tag: str = 'plain_text'
 
 
-@dataclass
+@dataclass(frozen=True)
 class Header:
     title: Text
     template: str = 'blue'
 
 
-@dataclass
+@dataclass(frozen=True)
 class Markdown(Text):
     tag: str = 'markdown'
 
@@ -36,7 +77,7 @@ class Action:
         return cls(actions)
     
 
-@dataclass
+@dataclass(frozen=True)
 class Confirm:
     title: Text
     text: Text
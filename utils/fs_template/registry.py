@@ -0,0 +1,85 @@
+'''本地卡片模板
+布局函数(如pick_hero_card) 以占位变量 var(name) 调用一次, 生成的卡片json 编译为静态片段 + 变量槽,
+之后每次发送只把变量值填入槽中, 直接得到卡片的json 文本, 不再构造组件、转dict、json.dumps
+
+卡片结构随参数变化的(如候选武将个数), 以这些参数作为模板的形状, 每种形状编译一次:
+    @register('pick_hero')
+    def pick_hero_layout(n): ...
+    get_template('pick_hero', 5).render(room_id=..., pos=..., hero_id0=..., uname0=...)
+'''
+from functools import lru_cache
+import json
+from json.encoder import encode_basestring
+import re
+
+SLOT_PATTERN = re.compile(r'"\$\{(\w+)\}"|\$\{(\w+)\}')
+
+_layouts = {}
+
+
+def var(name):
+    '''布局中的占位变量; 整个json 字符串值都是占位时可填入任意json 值(如数字), 否则填入值的字符串形式
+    '''
+    return '${%s}' % name
+
+
+class CardJson(str):
+    '''已渲染的卡片json 文本, send_card 直接作为消息内容发送
+    '''
+
+
+class CardTemplate:
+    '''pieces: 静态的json 片段, 变量槽的位置先放空串
+    slots: [(pieces 中的下标, 变量名, 是否整个json 值)]
+    '''
+    def __init__(self, card: dict):
+        self.pieces = []
+        self.slots = []
+        text = json.dumps(card, ensure_ascii=False)
+        pos = 0
+        for m in SLOT_PATTERN.finditer(text):
+            self.pieces.append(text[pos:m.start()])
+            self.slots.append((len(self.pieces), m.group(1) or m.group(2), m.group(1) is not None))
+            self.pieces.append('')
+            pos = m.end()
+        self.pieces.append(text[pos:])
+
+    @property
+    def variables(self):
+        return {name for _, name, _ in self.slots}
+
+    def render(self, **values) -> CardJson:
+        return self.render_many((values,))[0]
+
+    def render_many(self, rows) -> list:
+        '''rows: 每张卡片的变量dict, 一次渲染多张(如一局中所有座位)
+        '''
+        pieces, slots = self.pieces, self.slots
+        cards = []
+        for values in rows:
+            out = pieces[:]
+            for i, name, whole in slots:
+                value = values[name]
+                if type(value) is str:
+                    # encode_basestring 是json 的C 实现的字符串转义(不转义非ASCII), 带引号
+                    out[i] = encode_basestring(value) if whole else encode_basestring(value)[1:-1]
+                elif whole:
+                    out[i] = json.dumps(value, ensure_ascii=False)
+                else:
+                    out[i] = encode_basestring(str(value))[1:-1]
+            cards.append(CardJson(''.join(out)))
+        return cards
+
+
+def register(name):
+    '''注册布局函数: 参数是模板的形状, 返回以var 占位的卡片dict
+    '''
+    def wrapper(layout):
+        _layouts[name] = layout
+        return layout
+    return wrapper
+
+
+@lru_cache(maxsize=64)
+def get_template(name, *shape) -> CardTemplate:
+    return CardTemplate(_layouts[name](*shape))
@@ -1,13 +1,27 @@
 import base64
+import hashlib
 from inspect import isclass
 import json
+import logging
+import re
 import time
 from requests import HTTPError, get, post
 
 from common import conf
-from utils import classproperty
+from utils import classproperty, metrics
+from utils.fs_template.registry import CardJson
 from utils.redis_util import cache_token
 
+FS_API_LATENCY = metrics.histogram('sgs_feishu_api_seconds', '飞书开放接口的调用耗时',
+                                   ('method', 'endpoint', 'status'))
+ID_SEGMENT = re.compile(r'(?!v\d+$).*\d.*|.{20,}')
+
+def endpoint_of(path: str):
+    '''接口路径中的id 段(含数字或很长, 版本号v1 等除外) 替换为:id, 避免指标的标签无限增长
+    '''
+    path, _, _ = path.partition('?')
+    return '/'.join(':id' if ID_SEGMENT.fullmatch(seg) else seg for seg in path.split('/'))
+
 class FsClient:
     host = 'https://open.feishu.cn/open-apis'
 
@@ -30,7 +44,13 @@ class FsClient:
 
     @classmethod
     def common_request(cls, method, path, res_key=None, **kwargs):
-        resp = cls.raw_request(method, path, **kwargs)
+        begin = time.perf_counter()
+        status = 'exception'
+        try:
+            resp = cls.raw_request(method, path, **kwargs)
+            status = str(resp.status_code)
+        finally:
+            FS_API_LATENCY.labels(method.__name__.upper(), endpoint_of(path), status).observe(time.perf_counter() - begin)
         if resp.ok:
             r = resp.json()
             if r['code'] != 0:
@@ -43,7 +63,7 @@ class FsClient:
             else:
                 return r
         else:
-            print(resp.text)
+            logging.getLogger(__name__).error('%s %s failed %s: %s', method.__name__.upper(), path, resp.status_code, resp.text)
             resp.raise_for_status()
 
 
@@ -52,20 +72,26 @@ def mock_test(func):
 
 @mock_test
 def send_card(receive_id, card_id_or_cont, id_type='chat_id', **kwargs):
-    if isinstance(card_id_or_cont, str):
-        card_id_or_cont = {
-            'type': 'template',
-            'data': {
-                'template_id': card_id_or_cont,
-                'template_variable': kwargs
+    '''card_id_or_cont: 飞书卡片模板id(kwargs 为模板变量), 卡片dict, 或本地模板渲染的CardJson
+    '''
+    if isinstance(card_id_or_cont, CardJson):
+        content = card_id_or_cont
+    else:
+        if isinstance(card_id_or_cont, str):
+            card_id_or_cont = {
+                'type': 'template',
+                'data': {
+                    'template_id': card_id_or_cont,
+                    'template_variable': kwargs
+                }
             }
-        }
+        content = json.dumps(card_id_or_cont)
     return FsClient.common_request(post, '/im/v1/messages', params={
         'receive_id_type': id_type
     }, json={
         "receive_id": receive_id,
         "msg_type": "interactive",
-        "content": json.dumps(card_id_or_cont)
+        "content": content
     })
 
 @mock_test
@@ -80,18 +106,59 @@ def send_msg(receive_id, msg, id_type='chat_id'):
         })
     })
 
-def get_image_stream(msg_id, image_key):
+class Base64JsonBody:
+    '''{"key": "<data 的base64>"} 形式的请求体, 发送时分块编码, 不生成整个base64 副本
+    requests 由__len__ 得到Content-Length, 再按read 流式发送
+    '''
+    def __init__(self, key, data, block=48 * 1024):
+        self.head = json.dumps({key: ''})[:-2].encode()
+        self.tail = b'"}'
+        self.data = memoryview(data)
+        self.block = block - block % 3      # 3 字节对齐, 各块的编码可直接拼接
+        self._chunks = self._encode()
+
+    def __len__(self):
+        return len(self.head) + (len(self.data) + 2) // 3 * 4 + len(self.tail)
+
+    def _encode(self):
+        yield self.head
+        for pos in range(0, len(self.data), self.block):
+            yield base64.b64encode(self.data[pos:pos + self.block])
+        yield self.tail
+
+    def read(self, size=-1):
+        return next(self._chunks, b'')
+
+    def __iter__(self):
+        return iter(self.read, b'')
+
+
+def download_image(msg_id, image_key, chunk_size=64 * 1024):
+    '''流式下载消息中的图片, 边下载边计算sha256, 返回(hex 摘要, 图片bytearray)
+    '''
     resp = FsClient.raw_request(get, f'/im/v1/messages/{msg_id}/resources/{image_key}', params={
-        'type': 'image'})
-    if resp.ok:
-        image_bytes = resp.content
-        image_base64 = base64.b64encode(image_bytes)
-        return FsClient.common_request(post, '/optical_char_recognition/v1/image/basic_recognize', 'text_list', json={
-            'image': image_base64.decode('utf8'),
-        })
-    else:
-        print(resp.text)
-        resp.raise_for_status()
+        'type': 'image'}, stream=True)
+    with resp:
+        if not resp.ok:
+            logging.getLogger(__name__).error('get image %s failed %s: %s', image_key, resp.status_code, resp.text)
+            resp.raise_for_status()
+        digest = hashlib.sha256()
+        data = bytearray()
+        for chunk in resp.iter_content(chunk_size):
+            digest.update(chunk)
+            data += chunk
+    return digest.hexdigest(), data
+
+def recognize_image(data):
+    '''OCR 识别图片, 返回文本行列表; 请求体流式编码, 见Base64JsonBody
+    '''
+    return FsClient.common_request(post, '/optical_char_recognition/v1/image/basic_recognize', 'text_list',
+                                   data=Base64JsonBody('image', data),
+                                   headers={'Content-Type': 'application/json; charset=utf-8'})
+
+def get_image_stream(msg_id, image_key):
+    _, data = download_image(msg_id, image_key)
+    return recognize_image(data)
 
 def get_doc_block(doc_id, block_id):
     return FsClient.common_request(get, f'/docx/v1/documents/{doc_id}/blocks/{block_id}', 'block')
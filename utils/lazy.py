@@ -0,0 +1,149 @@
+'''延迟初始化的组件
+重量级的子系统(武将md 解析、牌库等) 以LazyProxy 的形式在模块中暴露, 首次访问属性时才真正构造,
+或者由warm_up 在后台线程中提前构造, 不再拖慢import 和启动
+
+命令行查看各模块的import 耗时, 以及导入后各延迟组件的构造耗时:
+python -m utils.lazy [module] [top]
+'''
+import logging
+import os
+import re
+import subprocess
+import sys
+import threading
+import time
+
+_NOT_RESOLVED = object()
+
+
+class LazyProxy:
+    '''首次访问属性时调用factory 构造目标对象, 之后的属性读写都转发给目标
+    构造是线程安全的, 只会执行一次; fork 出的子进程中重置锁(父进程可能正在构造)
+    代理自身不提供公开方法(避免遮住目标的属性), 相关操作见模块函数 is_resolved/on_resolve/warm_up
+    '''
+    __slots__ = ('_factory', '_name', '_target', '_lock', '_callbacks', '_cost')
+    _registry = []
+
+    def __init__(self, factory, name=None):
+        object.__setattr__(self, '_factory', factory)
+        object.__setattr__(self, '_name', name or getattr(factory, '__qualname__', repr(factory)))
+        object.__setattr__(self, '_target', _NOT_RESOLVED)
+        object.__setattr__(self, '_lock', threading.Lock())
+        object.__setattr__(self, '_callbacks', [])
+        object.__setattr__(self, '_cost', None)
+        self._registry.append(self)
+
+    def _resolve(self):
+        if (target := self._target) is not _NOT_RESOLVED:
+            return target
+        with self._lock:
+            if (target := self._target) is not _NOT_RESOLVED:
+                return target
+            begin = time.perf_counter()
+            target = self._factory()
+            object.__setattr__(self, '_cost', time.perf_counter() - begin)
+            object.__setattr__(self, '_target', target)
+            callbacks = self._callbacks[:]
+            self._callbacks.clear()
+        logging.getLogger(__name__).info('%s initialized in %.0fms', self._name, self._cost * 1000)
+        for callback in callbacks:
+            callback(target)
+        return target
+
+    def __getattr__(self, name):
+        return getattr(self._resolve(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._resolve(), name, value)
+
+    def __delattr__(self, name):
+        delattr(self._resolve(), name)
+
+    def __repr__(self):
+        if self._target is _NOT_RESOLVED:
+            return f'<LazyProxy {self._name} (not initialized)>'
+        return repr(self._target)
+
+    @classmethod
+    def _after_fork(cls):
+        for proxy in cls._registry:
+            object.__setattr__(proxy, '_lock', threading.Lock())
+
+
+os.register_at_fork(after_in_child=LazyProxy._after_fork)
+
+
+def is_resolved(proxy: LazyProxy):
+    return proxy._target is not _NOT_RESOLVED
+
+
+def on_resolve(proxy: LazyProxy, callback):
+    '''目标构造完成后调用callback(target); 已构造则立即调用
+    '''
+    with proxy._lock:
+        if proxy._target is _NOT_RESOLVED:
+            proxy._callbacks.append(callback)
+            return
+    callback(proxy._target)
+
+
+def warm_up(*tasks):
+    '''在后台线程中依次执行tasks, 返回该线程
+    task 是LazyProxy(构造之) 或无参的函数; 不给tasks 时构造所有已注册的LazyProxy
+    单个task 失败只记录日志, 之后首次使用时会再次尝试构造
+    '''
+    tasks = tasks or tuple(LazyProxy._registry)
+    def run():
+        logger = logging.getLogger(__name__)
+        for task in tasks:
+            try:
+                task._resolve() if isinstance(task, LazyProxy) else task()
+            except Exception as e:
+                logger.error('warm up %s failed %s', task, e, exc_info=True)
+    thread = threading.Thread(target=run, name='lazy_warm_up', daemon=True)
+    thread.start()
+    return thread
+
+
+IMPORT_TIME_PATTERN = re.compile(r'import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)')
+
+def import_report(module='app', top=20):
+    '''在子进程中以 -X importtime 导入module, 返回 (总耗时us, 按自身耗时排序的[(模块, 自身us, 累计us)], 按顶层包汇总的[(包, 自身us)])
+    '''
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                          capture_output=True, text=True, cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    if proc.returncode:
+        raise RuntimeError(proc.stderr.strip().splitlines()[-1])
+    modules = []
+    packages = {}
+    total = 0
+    for line in proc.stderr.splitlines():
+        if m := IMPORT_TIME_PATTERN.match(line):
+            self_us, cumulative, indent, name = int(m.group(1)), int(m.group(2)), len(m.group(3)), m.group(4)
+            modules.append((name, self_us, cumulative))
+            package = name.partition('.')[0]
+            packages[package] = packages.get(package, 0) + self_us
+            if indent == 1 and name == module:
+                total = cumulative
+    modules.sort(key=lambda m: m[1], reverse=True)
+    return total, modules[:top], sorted(packages.items(), key=lambda p: p[1], reverse=True)[:top]
+
+
+if __name__ == '__main__':
+    module = sys.argv[1] if len(sys.argv) > 1 else 'app'
+    top = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    total, modules, packages = import_report(module, top)
+    print(f'import {module}: {total/1000:.1f}ms')
+    print(f'\n{"module":<48}{"self(ms)":>10}{"cumulative(ms)":>16}')
+    for name, self_us, cumulative in modules:
+        print(f'{name:<48}{self_us/1000:>10.1f}{cumulative/1000:>16.1f}')
+    print(f'\n{"package":<48}{"self(ms)":>10}')
+    for name, self_us in packages:
+        print(f'{name:<48}{self_us/1000:>10.1f}')
+    __import__(module)
+    # 以-m 运行时本文件是__main__, 被导入模块注册的是utils.lazy 中的LazyProxy
+    from utils.lazy import LazyProxy as RegisteredProxy
+    print(f'\n{"lazy component":<48}{"init(ms)":>10}')
+    for proxy in RegisteredProxy._registry:
+        proxy._resolve()
+        print(f'{proxy._name:<48}{proxy._cost*1000:>10.1f}')
@@ -0,0 +1,186 @@
+'''结构化的异步日志
+log/log_conf.ini 中的logger/handler 照常配置, setup 之后:
+- 每条日志带上request_id(飞书message_id 等, 见request_context), 进程池任务沿用提交时的request_id(见process_pool.submit)
+- 文件日志用JsonFormatter 一行一个json
+- 异步模式下各logger 原有的handler 换成同一个队列的QueueHandler, 由后台线程(QueueListener) 写出,
+  请求线程只做一次入队; 队列积压超过busy_size 时, rates 中列出的级别按比例采样, 丢弃的条数记在dropped
+
+本模块在common 中配置日志时导入, 不能依赖common
+'''
+import atexit
+from collections import Counter
+from contextlib import contextmanager
+import contextvars
+import copy
+import json
+import logging
+from logging.handlers import QueueHandler, QueueListener
+import os
+import queue
+import random
+import uuid
+
+request_id = contextvars.ContextVar('request_id', default='-')
+
+
+@contextmanager
+def request_context(rid=None):
+    '''with 语句内(及其中提交的进程池任务) 的日志都带上rid, 不给则生成一个
+    '''
+    token = request_id.set(rid or uuid.uuid4().hex[:16])
+    try:
+        yield request_id.get()
+    finally:
+        request_id.reset(token)
+
+
+class JsonFormatter(logging.Formatter):
+    '''一行一个json: time, level, logger, request_id, pid, thread, msg, 以及exc/stack
+    extra={'fields': {...}} 给出的字段并入json
+    '''
+    def format(self, record):
+        entry = {
+            'time': '%s.%03d' % (self.formatTime(record, self.datefmt), record.msecs),
+            'level': record.levelname,
+            'logger': record.name,
+            'request_id': getattr(record, 'request_id', '-'),
+            'pid': record.process,
+            'thread': record.threadName,
+            'msg': record.getMessage(),
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        if record.stack_info:
+            entry['stack'] = record.stack_info
+        if fields := getattr(record, 'fields', None):
+            entry.update(fields)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class _SinkHandler(QueueHandler):
+    '''替换某个logger 原有的handlers: 记录标上sink(该logger 的名字) 入队, 监听线程再交给原handlers
+    '''
+    def __init__(self, pipeline, sink):
+        super().__init__(pipeline.queue)
+        self.pipeline = pipeline
+        self.sink = sink
+
+    def enqueue(self, record):
+        self.pipeline.queue.put_nowait(record)
+
+    def prepare(self, record):
+        '''在调用线程中算好消息和异常文本, 入队的record 不再引用调用方的参数和栈帧
+        与QueueHandler.prepare 不同, 不把异常并入msg, 留给各handler 的formatter
+        '''
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = _exc_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        record.sink = self.sink
+        return record
+
+
+_exc_formatter = logging.Formatter()
+
+
+class SamplingFilter(logging.Filter):
+    '''队列积压(qsize >= busy_size) 时按级别采样: rates 为 级别 -> 保留比例, 未列出的级别全部保留
+    '''
+    def __init__(self, pipeline):
+        super().__init__()
+        self.pipeline = pipeline
+
+    def filter(self, record):
+        p = self.pipeline
+        rate = p.rates.get(record.levelno)
+        if rate is None or p.queue.qsize() < p.busy_size or random.random() < rate:
+            return True
+        p.dropped[record.levelname] += 1
+        return False
+
+
+class AsyncPipeline:
+    '''sinks: logger 名 -> 原handlers
+    dropped: 级别名 -> 采样丢弃的条数
+    '''
+    def __init__(self, busy_size=1000, rates=None):
+        self.busy_size = busy_size
+        self.rates = rates or {}
+        self.dropped = Counter()
+        self.sinks = {}
+        self.queue = queue.SimpleQueue()
+        self.listener = None
+
+    def install(self):
+        loggers = [logging.getLogger(), *(l for l in logging.Logger.manager.loggerDict.values()
+                                          if isinstance(l, logging.Logger))]
+        for logger in loggers:
+            if logger.handlers and not isinstance(logger.handlers[0], _SinkHandler):
+                self.sinks[logger.name] = logger.handlers[:]
+                handler = _SinkHandler(self, logger.name)
+                handler.addFilter(SamplingFilter(self))
+                logger.handlers = [handler]
+        self.start()
+        atexit.register(self.stop)
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def start(self):
+        self.listener = QueueListener(self.queue, self)
+        self.listener.start()
+
+    def stop(self):
+        '''写出队列中剩余的日志
+        '''
+        if self.listener:
+            self.listener.stop()
+            self.listener = None
+
+    def handle(self, record):
+        '''监听线程中调用: 交给record 所属logger 原有的handlers
+        '''
+        for handler in self.sinks.get(record.sink, ()):
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+    def _after_fork(self):
+        '''子进程中没有监听线程, 换一个新队列重新启动(父进程队列中未写出的日志由父进程负责)
+        进程池worker 退出时不执行atexit, 另由multiprocessing 的退出清理写出剩余日志
+        '''
+        from multiprocessing.util import Finalize
+        self.queue = queue.SimpleQueue()
+        self.dropped = Counter()
+        self.start()
+        Finalize(None, self.stop, exitpriority=0)
+
+
+pipeline: AsyncPipeline = None
+
+
+def parse_rates(rates: str):
+    '''"DEBUG:0.01,INFO:0.1" -> {10: 0.01, 20: 0.1}
+    '''
+    parsed = {}
+    for item in filter(None, map(str.strip, rates.split(','))):
+        level, _, rate = item.partition(':')
+        parsed[logging.getLevelName(level.strip().upper())] = float(rate)
+    return parsed
+
+
+def setup(async_=True, busy_size=1000, rates='DEBUG:0.01,INFO:0.1'):
+    '''在logging.config.fileConfig 之后调用
+    '''
+    global pipeline
+    factory = logging.getLogRecordFactory()
+    def record_factory(*args, **kwargs):
+        record = factory(*args, **kwargs)
+        record.request_id = request_id.get()
+        return record
+    logging.setLogRecordFactory(record_factory)
+    if async_:
+        pipeline = AsyncPipeline(busy_size, parse_rates(rates))
+        pipeline.install()
+    return pipeline
@@ -0,0 +1,264 @@
+'''进程内的指标(Prometheus 文本格式), 由app 的 /metrics 暴露
+conf 中 [Metrics] Enabled=1 时开启; 关闭时counter/gauge/histogram 返回同一个空操作对象,
+埋点处只多一次方法调用, 不加锁也不计时
+
+counter(name, doc, labels): 只增的计数
+gauge(name, doc, labels, func): 可增减的数值; 给定func 时在抓取时调用func() 取值
+histogram(name, doc, labels, buckets): 分桶统计(如耗时), .time(*label_values) 可用作计时的with 语句
+'''
+from bisect import bisect_left
+import threading
+import time
+
+from common import conf
+
+enabled = conf.getboolean('Metrics', 'Enabled', fallback=False)
+
+LATENCY_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+_registry = {}
+_lock = threading.Lock()
+
+
+class _Noop:
+    '''关闭指标时的空操作, 同时充当所有类型的指标、带标签的子指标和计时上下文
+    '''
+    def labels(self, *values):
+        return self
+
+    def inc(self, amount=1):
+        pass
+
+    def dec(self, amount=1):
+        pass
+
+    def set(self, value):
+        pass
+
+    def observe(self, value):
+        pass
+
+    def time(self, *values):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+NOOP = _Noop()
+
+
+class _Metric:
+    '''带标签的指标, labels(*values) 返回(并缓存) 该组标签值的子指标
+    '''
+    kind = ''
+
+    def __init__(self, name, doc, labels=()):
+        self.name = name
+        self.doc = doc
+        self.label_names = tuple(labels)
+        self._children = {}
+
+    def labels(self, *values):
+        if (child := self._children.get(values)) is None:
+            assert len(values) == len(self.label_names), f'{self.name} expects labels {self.label_names}'
+            with _lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def label_str(self, values, extra=''):
+        pairs = [f'{k}="{escape(str(v))}"' for k, v in zip(self.label_names, values)]
+        if extra:
+            pairs.append(extra)
+        return '{' + ','.join(pairs) + '}' if pairs else ''
+
+    def render(self):
+        yield f'# HELP {self.name} {self.doc}'
+        yield f'# TYPE {self.name} {self.kind}'
+        for values, child in list(self._children.items()):
+            yield from self._render_child(values, child)
+
+
+class _Value:
+    __slots__ = ('value', 'lock')
+
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        with self.lock:
+            self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def _render_child(self, values, child):
+        yield f'{self.name}{self.label_str(values)} {child.value}'
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def __init__(self, name, doc, labels=(), func=None):
+        '''func: 无标签时返回数值, 有标签时返回 {标签值元组: 数值}
+        '''
+        super().__init__(name, doc, labels)
+        self.func = func
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def dec(self, amount=1):
+        self.labels().dec(amount)
+
+    def set(self, value):
+        self.labels().set(value)
+
+    def render(self):
+        if self.func:
+            try:
+                values = self.func()
+            except Exception:
+                return      # 取值失败(如进程池未创建) 时不输出
+            if not self.label_names:
+                values = {(): values}
+            yield f'# HELP {self.name} {self.doc}'
+            yield f'# TYPE {self.name} {self.kind}'
+            for label_values, value in values.items():
+                yield f'{self.name}{self.label_str(label_values)} {value}'
+        else:
+            yield from super().render()
+
+    def _render_child(self, values, child):
+        yield f'{self.name}{self.label_str(values)} {child.value}'
+
+
+class _HistogramValue:
+    '''counts 是各桶的非累计计数(最后一个是+Inf), 输出时再累加
+    '''
+    __slots__ = ('buckets', 'counts', 'sum', 'lock')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    def time(self):
+        return _Timer(self)
+
+
+class _Timer:
+    __slots__ = ('target', 'begin')
+
+    def __init__(self, target):
+        self.target = target
+
+    def __enter__(self):
+        self.begin = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.target.observe(time.perf_counter() - self.begin)
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, doc, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, doc, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def time(self, *values):
+        return _Timer(self.labels(*values))
+
+    def _render_child(self, values, child):
+        with child.lock:
+            counts, total = child.counts[:], child.sum
+        acc = 0
+        for bound, n in zip((*self.buckets, '+Inf'), counts):
+            acc += n
+            le = 'le="%s"' % bound
+            yield f'{self.name}_bucket{self.label_str(values, le)} {acc}'
+        yield f'{self.name}_sum{self.label_str(values)} {total}'
+        yield f'{self.name}_count{self.label_str(values)} {acc}'
+
+
+def escape(value: str):
+    return value.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _register(cls, name, *args, **kwargs):
+    '''同名指标只创建一次(模块被重复导入或多处埋点共用)
+    '''
+    if not enabled:
+        return NOOP
+    with _lock:
+        if (metric := _registry.get(name)) is None:
+            metric = _registry[name] = cls(name, *args, **kwargs)
+    return metric
+
+
+def counter(name, doc, labels=()) -> Counter:
+    return _register(Counter, name, doc, labels)
+
+
+def gauge(name, doc, labels=(), func=None) -> Gauge:
+    return _register(Gauge, name, doc, labels, func)
+
+
+def histogram(name, doc, labels=(), buckets=LATENCY_BUCKETS) -> Histogram:
+    return _register(Histogram, name, doc, labels, buckets)
+
+
+def render() -> str:
+    '''所有指标的Prometheus 文本格式
+    '''
+    lines = []
+    for metric in list(_registry.values()):
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+CACHE_REQUESTS = counter('sgs_cache_requests_total', '缓存查询次数', ('cache', 'result'))
+
+def cache_access(cache, hit: bool):
+    '''记录一次缓存命中/未命中, 命中率 = hit / (hit + miss)
+    '''
+    CACHE_REQUESTS.labels(cache, 'hit' if hit else 'miss').inc()
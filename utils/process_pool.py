@@ -0,0 +1,107 @@
+'''进程池任务的提交与度量
+任务统一用模块级函数 + 小参数(id、字符串) 提交, 不再pickle 绑定方法及其背后的整个对象图
+task_stats: 任务名 -> [提交次数, 参数总字节数, 单次最大字节数], 仅在启用度量([Metrics] Enabled) 时统计
+'''
+import contextvars
+import gc
+import logging
+from multiprocessing.reduction import ForkingPickler
+
+import common
+from utils import metrics
+from utils.lazy import warm_up, LazyProxy
+from utils.log_util import request_context, request_id
+
+task_stats = {}
+_synced = []    # [(主进程中取版本的函数, worker 中同步到该版本的函数)]
+
+TASK_BYTES = metrics.histogram('sgs_pool_task_bytes', '进程池任务发往worker 的序列化字节数', ('task',),
+                               buckets=(128, 256, 512, 1024, 4096, 16384, 65536, 262144))
+
+
+def preload(*tasks):
+    '''fork 进程池前在主进程中同步执行tasks(LazyProxy 则构造之), 然后gc.freeze
+    worker 直接继承已加载的数据; freeze 后这些对象不再被gc 追踪, worker 中的回收不会写它们的对象头,
+    对应的内存页保持父子进程共享(copy-on-write 不触发)
+    单个task 失败只记录日志, 不影响启动, 之后首次使用时会再次尝试
+    '''
+    for task in tasks:
+        try:
+            task._resolve() if isinstance(task, LazyProxy) else task()
+        except Exception as e:
+            logging.getLogger(__name__).error('preload %s failed %s', task, e, exc_info=True)
+    gc.collect()
+    gc.freeze()
+
+
+def init_worker(*tasks):
+    '''worker 的initializer, 在后台线程执行tasks: fork 前已加载的LazyProxy 直接跳过, 否则在worker 中加载
+    '''
+    warm_up(*tasks)
+
+
+def sync_state(version, apply):
+    '''注册随任务下发的状态版本: submit 时在主进程中取version(), worker 执行任务前调用apply(该版本)
+    主进程中的状态更新(如武将md 的重新加载) 由此在worker 的下一个任务开始前生效, worker 无需各自轮询
+    apply 在版本未变时应立即返回; 须在fork 进程池前(模块导入时) 注册
+    '''
+    _synced.append((version, apply))
+
+
+def _run(rid, versions, func, args):
+    '''worker 中先同步主进程的状态版本, 再以提交时的request_id 执行任务
+    '''
+    with request_context(rid):
+        for (_, apply), version in zip(_synced, versions):
+            apply(version)
+        return func(*args)
+
+
+def submit(func, *args, callback=None, error_callback=None):
+    '''向common.process_pool 提交func(*args), 启用度量时记录任务发往worker 时序列化的字节数
+    (需要额外序列化一次, 未启用时不统计)
+    任务和回调(主进程的结果线程中执行) 的日志沿用提交时的request_id, 任务带上sync_state 注册的状态版本
+    '''
+    task = (request_id.get(), tuple(version() for version, _ in _synced), func, args)
+    if metrics.enabled:
+        size = len(ForkingPickler.dumps((_run, task)))
+        stat = task_stats.setdefault(func.__qualname__, [0, 0, 0])
+        stat[0] += 1
+        stat[1] += size
+        stat[2] = max(stat[2], size)
+        TASK_BYTES.labels(func.__qualname__).observe(size)
+    ctx = contextvars.copy_context()
+    return common.process_pool.apply_async(_run, task,
+                                           callback=callback and (lambda res: ctx.run(callback, res)),
+                                           error_callback=error_callback and (lambda e: ctx.run(error_callback, e)))
+
+
+def memory_usage(pid):
+    '''进程的内存(KiB), 取自/proc/<pid>/smaps_rollup: rss, pss(共享页按进程数均摊), shared, private
+    '''
+    usage = {}
+    with open(f'/proc/{pid}/smaps_rollup') as f:
+        for line in f:
+            key, _, value = line.partition(':')
+            if key in ('Rss', 'Pss', 'Shared_Clean', 'Shared_Dirty', 'Private_Clean', 'Private_Dirty'):
+                usage[key] = int(value.split()[0])
+    return {
+        'rss': usage['Rss'],
+        'pss': usage['Pss'],
+        'shared': usage['Shared_Clean'] + usage['Shared_Dirty'],
+        'private': usage['Private_Clean'] + usage['Private_Dirty'],
+    }
+
+
+def worker_memory(pool=None):
+    '''进程池各worker 的内存, pid -> memory_usage
+    '''
+    pool = pool or common.process_pool
+    return {p.pid: memory_usage(p.pid) for p in pool._pool if p.is_alive()}
+
+
+# 进程池的任务结果表(_cache) 中是已提交未完成的任务
+metrics.gauge('sgs_pool_pending_tasks', '进程池中已提交未完成的任务数', func=lambda: len(common.process_pool._cache))
+metrics.gauge('sgs_pool_worker_memory_bytes', '进程池各worker 的内存', ('pid', 'kind'),
+              func=lambda: {(pid, kind): kib * 1024
+                            for pid, usage in worker_memory().items() for kind, kib in usage.items()})
@@ -0,0 +1,161 @@
+'''慢命令的性能剖析
+开启后route_todo 的每次调用都被剖析, 耗时超过阈值的保留最近keep 条(命令、参数、耗时、剖析结果), 由管理接口查看
+conf 中 [Profiler] 配置初始值, 运行时可通过管理接口修改, 无需重启:
+    Enabled: 是否开启, 默认0
+    Mode: sample(默认, 后台线程定时采样请求线程的调用栈, 开销小) 或 cprofile(逐函数统计, 更精确但更慢)
+    ThresholdMs: 保留的耗时阈值, 默认500
+    Keep: 保留的条数, 默认20
+    IntervalMs: sample 模式的采样间隔, 默认5
+'''
+from collections import Counter, deque
+import cProfile
+from contextlib import contextmanager
+import hashlib
+import io
+import pstats
+import sys
+import threading
+import time
+
+from common import conf
+
+MODES = ('sample', 'cprofile')
+# 慢命令记录中原样保留的参数
+TRACE_KWARGS = frozenset(('room_id', 'hero_id', 'uname', 'pos', 'image_key', 'create_time_ms'))
+
+
+def redact(kwargs):
+    '''慢命令记录的参数: TRACE_KWARGS 中的保留原值, 其余以_id 结尾的(用户、会话、消息的id) 只记摘要,
+    其他参数(卡片回调的token、发送者等) 不记录
+    '''
+    kept = {}
+    for k, v in kwargs.items():
+        if k in TRACE_KWARGS:
+            kept[k] = repr(v)[:200]
+        elif k.endswith('_id'):
+            kept[k] = 'h:' + hashlib.blake2b(str(v).encode(), digest_size=6).hexdigest()
+    return kept
+
+
+class StackSampler:
+    '''后台线程每interval 秒采样一次已登记线程的调用栈
+    栈折叠为 "文件:函数:行;...;文件:函数:行" 的字符串(与flamegraph.pl 的输入格式相同) 并计数
+    只在有登记的线程时运行, 没有请求时线程退出
+    '''
+    def __init__(self, interval):
+        self.interval = interval
+        self.active = {}        # 线程id -> Counter(折叠的栈)
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def register(self, thread_id):
+        samples = Counter()
+        with self.lock:
+            self.active[thread_id] = samples
+            if not (self.thread and self.thread.is_alive()):
+                self.thread = threading.Thread(target=self.run, name='stack_sampler', daemon=True)
+                self.thread.start()
+        return samples
+
+    def unregister(self, thread_id):
+        with self.lock:
+            self.active.pop(thread_id, None)
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            with self.lock:
+                if not self.active:
+                    self.thread = None
+                    return
+                active = dict(self.active)
+            frames = sys._current_frames()
+            for thread_id, samples in active.items():
+                if frame := frames.get(thread_id):
+                    samples[self.collapse(frame)] += 1
+
+    @staticmethod
+    def collapse(frame):
+        stack = []
+        while frame:
+            code = frame.f_code
+            stack.append(f'{code.co_filename}:{code.co_name}:{frame.f_lineno}')
+            frame = frame.f_back
+        return ';'.join(reversed(stack))
+
+
+class Profiler:
+    '''traces: 最近的慢命令, 每条为dict: time, cmd, kwargs(见redact), elapsed_ms, mode, profile
+    sample 模式的profile 是 [(折叠的栈, 采样数)] (按采样数降序), cprofile 模式是pstats 的文本
+    '''
+    def __init__(self, enabled=False, mode='sample', threshold_ms=500, keep=20, interval_ms=5, top=30):
+        self.traces = deque(maxlen=keep)
+        self.top = top
+        self.sampler = StackSampler(interval_ms / 1000)
+        self.configure(enabled=enabled, mode=mode, threshold_ms=threshold_ms)
+
+    def configure(self, enabled=None, mode=None, threshold_ms=None, keep=None):
+        '''运行时修改配置, 未给出的项保持不变
+        '''
+        if mode is not None:
+            if mode not in MODES:
+                raise ValueError(f'unknown profile mode {mode}')
+            self.mode = mode
+        if threshold_ms is not None:
+            self.threshold = float(threshold_ms) / 1000
+        if keep is not None:
+            self.traces = deque(self.traces, maxlen=int(keep))
+        if enabled is not None:
+            self.enabled = bool(enabled)
+
+    def settings(self):
+        return {'enabled': self.enabled, 'mode': self.mode,
+                'threshold_ms': self.threshold * 1000, 'keep': self.traces.maxlen}
+
+    @contextmanager
+    def profile(self, cmd, kwargs):
+        '''剖析with 语句内的执行, 超过阈值则保留; 未开启时没有额外开销
+        '''
+        if not self.enabled:
+            yield
+            return
+        mode = self.mode
+        begin = time.perf_counter()
+        if mode == 'cprofile':
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError:      # 3.12 起同一时刻只能有一个cProfile 在运行(并发的请求), 退回采样
+                mode = 'sample'
+        if mode == 'sample':
+            thread_id = threading.get_ident()
+            samples = self.sampler.register(thread_id)
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - begin
+            if mode == 'cprofile':
+                profiler.disable()
+            else:
+                self.sampler.unregister(thread_id)
+            if elapsed >= self.threshold:
+                self.traces.append({
+                    'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+                    'cmd': cmd,
+                    'kwargs': redact(kwargs),
+                    'elapsed_ms': round(elapsed * 1000, 1),
+                    'mode': mode,
+                    'profile': self.cprofile_text(profiler) if mode == 'cprofile' else samples.most_common(self.top),
+                })
+
+    def cprofile_text(self, profiler):
+        out = io.StringIO()
+        pstats.Stats(profiler, stream=out).sort_stats('cumulative').print_stats(self.top)
+        return out.getvalue()
+
+
+profiler = Profiler(enabled=conf.getboolean('Profiler', 'Enabled', fallback=False),
+                    mode=conf.get('Profiler', 'Mode', fallback='sample'),
+                    threshold_ms=conf.getfloat('Profiler', 'ThresholdMs', fallback=500),
+                    keep=conf.getint('Profiler', 'Keep', fallback=20),
+                    interval_ms=conf.getfloat('Profiler', 'IntervalMs', fallback=5))
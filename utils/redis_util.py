@@ -3,12 +3,28 @@ import json
 import time
 from urllib.parse import parse_qs, urlencode, urlparse, urlunparse
 from click import Path
-from redis import Redis, from_url as redis_from_url
+from redis import Redis
+
+from utils import metrics
+
+REDIS_LATENCY = metrics.histogram('sgs_redis_command_seconds', 'Redis 命令的耗时(含网络往返)', ('command',))
+
+
+class MeteredRedis(Redis):
+    '''记录每个命令耗时的Redis 客户端(pipeline 只在execute 时整体往返, 不逐条记录)
+    '''
+    def execute_command(self, *args, **options):
+        with REDIS_LATENCY.time(str(args[0]).upper()):
+            return super().execute_command(*args, **options)
+
+
+# 关闭指标时直接用原始客户端, 没有额外开销
+redis_class = MeteredRedis if metrics.enabled else Redis
 
 
 class RedisClient:
     def __init__(self):
-        self.client = Redis()
+        self.client = redis_class()
 
     def idempotent(self, key, timeout=60):
         '''return:
@@ -48,7 +64,7 @@ def cache_token(target: str, token_key, expire_key, r_token_key=None):
         key = q_dict.pop('key')[0]
         if up.netloc:
             url = urlunparse(up._replace(query=urlencode(q_dict)))
-            f = redis_from_url(url)
+            f = redis_class.from_url(url)
         else:
             f = RedisClient().client
     if not f:
@@ -1,12 +1,24 @@
+import atexit
 import base64
+from collections import deque
+import contextvars
 import hashlib
 import hmac
 from itertools import chain, repeat
+import json
+import logging
+import os
+import queue
+import threading
 import time
 
 import requests
 from common import conf, runtime_env
 from sgs.heros.hero import Hero
+from utils import metrics
+from utils.metrics import cache_access
+
+ROBOT_LATENCY = metrics.histogram('sgs_robot_post_seconds', '机器人webhook 的发送耗时')
 
 
 def get_content_dict(content, at):
@@ -21,52 +33,201 @@ def get_content_dict(content, at):
             }
         }
     elif isinstance(content, Hero):
-        hp = f' {content.hp}/{content.hp_max}' if content.hp or content.hp_max else ''
-        conts = []
+        card = hero_card(content)
         if at:
-            conts.append(f'<at id="">{at}</at>')
-        conts.extend([
-            f'性别: {content.gender}',
-            f'势力: {content.camp.value}',
-            f'定位: {content.position}',
-            '技能: ', *chain(*zip(filter(None, content.skills), repeat('***'))),
-            *(c.md_format(line_break='\n') for c in content.contents),
-            '台词: ', *chain(*zip(repeat('***'), filter(None, content.lines))),
-        ])
+            card = {**card, 'elements': [md_element(f'<at id="">{at}</at>'), *card['elements']]}
         return {
             'msg_type': 'interactive',
-            'card': {
-                'header': {
-                    'title': {
-                        'content': f'{content.pack} {content.name}{hp} {content.title}',
-                        'tag': "plain_text"
-                    }
-                },
-                'elements': [{'tag': 'hr'} if cont == '***' else
-                    {
-                        'tag': 'div',
-                        'text': {
-                            'tag': 'lark_md',
-                            'content': cont
-                        }
-                    } for cont in conts
-                ]
-            }
+            'card': card
+        }
+
+
+def md_element(cont):
+    return {'tag': 'hr'} if cont == '***' else {
+        'tag': 'div',
+        'text': {
+            'tag': 'lark_md',
+            'content': cont
+        }
+    }
+
+
+def hero_card(hero: Hero):
+    '''渲染武将卡片(不含at), 结果缓存在hero.card_cache
+    hero 重新抓取到新内容时缓存失效(见Hero.crawl_by_name)
+    缓存会被多次请求共享, 使用方不要修改
+    '''
+    cache_access('hero_card', (card := vars(hero).get('card_cache')) is not None)
+    if card is None:
+        hp = f' {hero.hp}/{hero.hp_max}' if hero.hp or hero.hp_max else ''
+        conts = [
+            f'性别: {hero.gender}',
+            f'势力: {hero.camp.value}',
+            f'定位: {hero.position}',
+            '技能: ', *chain(*zip(filter(None, hero.skills), repeat('***'))),
+            *(c.md_format(line_break='\n') for c in hero.contents),
+            '台词: ', *chain(*zip(repeat('***'), filter(None, hero.lines))),
+        ]
+        card = {
+            'header': {
+                'title': {
+                    'content': f'{hero.pack} {hero.name}{hp} {hero.title}',
+                    'tag': "plain_text"
+                }
+            },
+            'elements': [md_element(cont) for cont in conts]
+        }
+        hero.card_cache = card
+    return card
+
+
+class RobotClient:
+    '''飞书自定义机器人webhook 的客户端
+    - 复用一个requests.Session(keep-alive 连接池), fork 出的子进程中重建
+    - 签名只与秒级时间戳和token 有关, 同一秒内复用
+    - send/send_many 只是入队, 由后台线程按顺序发送, 处理函数不等待; flush 等待已入队的发送完
+    - send_many 把多张武将卡片合并成少量卡片消息, 每条请求体不超过MAX_BODY
+    平台限制: 请求体20KB, 每个机器人 5次/秒、100次/分钟; 发送线程按RATE_LIMIT 限速
+    '''
+    MAX_BODY = 20 * 1024
+    RATE_LIMIT = ((5, 1), (100, 60))    # (次数, 秒)
+
+    def __init__(self, conf_section=None):
+        '''conf_section: 含HookUrl、Token, 不给则按运行环境取 [ChatRobot.debug] 或 [ChatRobot]
+        '''
+        self._conf_section = conf_section
+        self._sign = (None, None, None)     # (时间戳, token, 签名)
+        self._reset()
+        os.register_at_fork(after_in_child=self._reset)
+        atexit.register(self.flush)
+
+    def _reset(self):
+        self.session = requests.Session()
+        self.queue = queue.SimpleQueue()
+        self.thread = None
+        self.sent = deque(maxlen=max(n for n, _ in self.RATE_LIMIT))     # 最近的发送时间
+        self.lock = threading.Lock()
+
+    @property
+    def conf_section(self):
+        if self._conf_section:
+            return self._conf_section
+        return conf["ChatRobot.debug"] if runtime_env.get('debug', True) else conf['ChatRobot']
+
+    def sign(self, token):
+        timestamp = int(time.time())
+        if self._sign[:2] != (timestamp, token):
+            hmac_code = hmac.new(f'{timestamp}\n{token}'.encode("utf-8"), digestmod=hashlib.sha256).digest()
+            self._sign = (timestamp, token, base64.b64encode(hmac_code).decode('utf-8'))
+        return timestamp, self._sign[2]
+
+    def send(self, content, at=None):
+        self._put(get_content_dict(content, at))
+
+    def send_many(self, contents, at=None):
+        '''武将合并为卡片消息(见merge_cards), 其余内容逐条发送
+        '''
+        heros = []
+        for content in contents:
+            if isinstance(content, Hero):
+                heros.append(content)
+            else:
+                self.send(content, at)
+        for card in merge_cards(heros, self.MAX_BODY - 512):   # 留出签名等字段的余量
+            if at:
+                card['elements'].insert(0, md_element(f'<at id="">{at}</at>'))
+            self._put({'msg_type': 'interactive', 'card': card})
+
+    def flush(self, timeout=10):
+        '''等待已入队的消息发送完, 返回是否在timeout 内完成
+        '''
+        if not (self.thread and self.thread.is_alive()):
+            return True
+        done = threading.Event()
+        self.queue.put(done)
+        return done.wait(timeout)
+
+    def _put(self, cont_dict):
+        # 发送线程中沿用入队时的上下文(日志的request_id)
+        self.queue.put((contextvars.copy_context(), cont_dict))
+        with self.lock:
+            if not (self.thread and self.thread.is_alive()):
+                self.thread = threading.Thread(target=self._run, name='robot_sender', daemon=True)
+                self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if isinstance(item, threading.Event):
+                item.set()
+                continue
+            ctx, cont_dict = item
+            try:
+                ctx.run(self.post, cont_dict)
+            except Exception as e:
+                logging.getLogger(__name__).error('robot post failed %s', e, exc_info=True)
+
+    def _throttle(self):
+        now = time.monotonic()
+        for n, seconds in self.RATE_LIMIT:
+            if len(self.sent) >= n and (wait := self.sent[-n] + seconds - now) > 0:
+                time.sleep(wait)
+                now = time.monotonic()
+        self.sent.append(now)
+
+    def post(self, cont_dict):
+        '''同步发送一条消息
+        '''
+        conf_section = self.conf_section
+        timestamp, sign = self.sign(conf_section['Token'])
+        body = json.dumps({**cont_dict, 'timestamp': str(timestamp), 'sign': sign}, ensure_ascii=False).encode('utf-8')
+        self._throttle()
+        with ROBOT_LATENCY.time():
+            resp = self.session.post(conf_section['HookUrl'], data=body,
+                                     headers={'Content-Type': 'application/json; charset=utf-8'}, timeout=10)
+        if resp.ok:
+            logging.getLogger(__name__).debug('robot response: %s', resp.text)
+        else:
+            logging.getLogger(__name__).error('robot failed %s: %s', resp.status_code, resp.text)
+        return resp
+
+
+def merge_cards(heros, max_size):
+    '''把武将卡片依次合并, 每张合并后的卡片序列化(utf-8) 后不超过max_size; 单个武将超过时独占一张
+    各武将的卡片是共享缓存(见hero_card), 这里只组合其elements, 不修改
+    '''
+    parts = []
+    for hero in heros:
+        card = hero_card(hero)
+        elements = [md_element(f"**{card['header']['title']['content']}**"), *card['elements']]
+        parts.append((elements, len(json.dumps(elements, ensure_ascii=False).encode('utf-8'))))
+    groups = []
+    size = max_size
+    for elements, part_size in parts:
+        if size + part_size > max_size:
+            groups.append([])
+            size = 200      # header 等
+        if groups[-1]:
+            groups[-1].append({'tag': 'hr'})
+        groups[-1].extend(elements)
+        size += part_size + 20
+    for i, elements in enumerate(groups, 1):
+        title = f'搜索到{len(heros)}个武将' + (f' ({i}/{len(groups)})' if len(groups) > 1 else '')
+        yield {
+            'header': {
+                'title': {
+                    'content': title,
+                    'tag': "plain_text"
+                }
+            },
+            'elements': elements
         }
 
 
+robot_client = RobotClient()
+
+
 def robot(content, at=None):
-    conf_section = conf["ChatRobot.debug"] if runtime_env.get('debug', True) else conf['ChatRobot']
-    timestamp = int(time.time())
-    sign = f'{timestamp}\n{conf_section["Token"]}'
-    hmac_code = hmac.new(sign.encode("utf-8"), digestmod=hashlib.sha256).digest()
-
-    cont_dict = get_content_dict(content, at)
-    cont_dict.update({
-        'timestamp': str(timestamp),
-        'sign': base64.b64encode(hmac_code).decode('utf-8')})
-    resp = requests.post(conf_section['HookUrl'], json=cont_dict)
-    if resp.ok:
-        print(resp.json())
-    else:
-        print(resp.text)
\ No newline at end of file
+    '''异步发送一条消息, 见RobotClient
+    '''
+    robot_client.send(content, at)
@@ -1,5 +1,12 @@
 from enum import Enum, auto
 import re
+import time
+
+from utils import metrics
+from utils.profiler import profiler
+
+ROUTE_DISPATCH = metrics.histogram('sgs_route_dispatch_seconds', '命令查找处理函数的耗时', ('match_type',))
+HANDLER_LATENCY = metrics.histogram('sgs_handler_seconds', '命令处理函数的耗时', ('handler',))
 
 class MatchType(Enum):
     '''路由匹配类型枚举
@@ -25,13 +32,19 @@ class MatchType(Enum):
         self._value_ = value
         self.finder = finder
 
-    def process(self, mapper, cmd, *args, **kwargs):
+    def process(self, mapper, cmd, *args, dispatch_begin=None, **kwargs):
         '''找到target函数则第一返回值为true, 否则为false
         第二返回值即是调用target函数的返回值
+        dispatch_begin: 开始查找的时间, 找到target 时据此记录查找耗时
         '''
         try:
             f, *ctx = self.finder(mapper, cmd)
-            return (True, f(cmd, ctx, *args, **kwargs)) if f else (False, None)
+            if not f:
+                return (False, None)
+            if dispatch_begin is not None:
+                ROUTE_DISPATCH.labels(self.name).observe(time.perf_counter() - dispatch_begin)
+            with HANDLER_LATENCY.time(f.__name__):
+                return (True, f(cmd, ctx, *args, **kwargs))
         except StopIteration:
             return (False, None)
 
@@ -55,10 +68,13 @@ def route(cmd, match_type=MatchType.FULL_MATCH):
 def route_todo(cmd:str, *args, **kwargs):
     '''根据命令行进行路由到target 函数进行处理
     '''
-    for mt in MatchType:
-        b, res = mt.process(_router[mt], cmd, *args, **kwargs)
-        if b:
-            return res
-    raise NotImplementedError(f'{cmd} is not registered')
+    with profiler.profile(cmd, kwargs):
+        begin = time.perf_counter()
+        for mt in MatchType:
+            b, res = mt.process(_router[mt], cmd, *args, dispatch_begin=begin, **kwargs)
+            if b:
+                return res
+        ROUTE_DISPATCH.labels('NOT_FOUND').observe(time.perf_counter() - begin)
+        raise NotImplementedError(f'{cmd} is not registered')
 
 
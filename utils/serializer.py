@@ -0,0 +1,88 @@
+'''带schema 版本的二进制序列化(msgpack)
+取代pickle: 落盘数据不再绑定类的内存布局, 加载时也不会执行任意代码
+
+被注册的类序列化为msgpack 的ExtType(type_id, [schema_ver, record])
+record 只包含基础类型, 由类自己的to_record/from_record 负责转换
+'''
+import struct
+
+import msgpack
+
+MAGIC = b'SGS\x01'
+FRAME_HEAD = struct.Struct('<I')
+
+_types = {}
+
+
+def serializable(type_id: int, version: int = 1):
+    '''注册可序列化类的装饰器
+    被装饰类需实现 to_record(self) 和 classmethod from_record(cls, record, version)
+    子类未单独注册时, 沿用父类的type_id
+    '''
+    def outer(cls):
+        assert type_id not in _types, f'duplicated type_id {type_id}'
+        cls.serial_type = (type_id, version)
+        _types[type_id] = cls
+        return cls
+    return outer
+
+
+def _default(obj):
+    if serial_type := getattr(obj, 'serial_type', None):
+        type_id, version = serial_type
+        return msgpack.ExtType(type_id, _packb([version, obj.to_record()]))
+    if isinstance(obj, (tuple, set, frozenset)):
+        return list(obj)
+    if isinstance(obj, str):
+        return str(obj)
+    if isinstance(obj, dict):
+        return dict(obj)
+    raise TypeError(f'{type(obj)} is not serializable')
+
+
+def _ext_hook(type_id, data):
+    version, record = _unpackb(data)
+    return _types[type_id].from_record(record, version)
+
+
+def _packb(obj):
+    # strict_types 使得str 的子类(如crawler.Text) 也交给_default 处理
+    return msgpack.packb(obj, default=_default, strict_types=True)
+
+
+def _unpackb(data):
+    return msgpack.unpackb(data, ext_hook=_ext_hook, raw=False)
+
+
+def is_packed(data: bytes):
+    return data[:len(MAGIC)] == MAGIC
+
+
+def dumps(obj) -> bytes:
+    return MAGIC + _packb(obj)
+
+
+def loads(data: bytes):
+    if not is_packed(data):
+        raise ValueError('unknown serialization format')
+    return _unpackb(memoryview(data)[len(MAGIC):])
+
+
+def frame(obj) -> bytes:
+    '''追加写日志用的帧: 4 字节小端长度 + msgpack
+    '''
+    data = _packb(obj)
+    return FRAME_HEAD.pack(len(data)) + data
+
+
+def iter_frames(f):
+    '''依次读取文件中的帧, 生成(对象, 该帧结束的偏移)
+    末尾不完整的帧(写入中途崩溃) 直接结束, 由调用方按最后的偏移截断
+    '''
+    offset = f.tell()
+    while len(head := f.read(FRAME_HEAD.size)) == FRAME_HEAD.size:
+        size, = FRAME_HEAD.unpack(head)
+        if len(data := f.read(size)) < size:
+            return
+        offset += FRAME_HEAD.size + size
+        yield _unpackb(data), offset